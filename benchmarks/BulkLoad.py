@@ -0,0 +1,80 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from pathlib import Path
+from dotenv import load_dotenv
+
+
+def arguments():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.BulkLoad', description='Facts insert paths of the PostGres driver against a real cloud database')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--batch', type=int, default=100000, help='Rows handed to the driver per call')
+    parser.add_argument('--tags', type=int, default=20000)
+    return parser.parse_args()
+
+
+def rows(count, tags):
+    # Epoch millisecond stamps one second apart per tag, the same shape the forwarder sends
+    start = int(time.time() * 1000) - count // tags * 1000
+    generator = random.Random(0)
+    return [(i % tags, start + i // tags * 1000, generator.uniform(-100.0, 100.0)) for i in range(count)]
+
+
+def timed(fn, records, batch):
+    start = time.perf_counter()
+
+    for i in range(0, len(records), batch):
+        fn(records[i:i + batch])
+
+    return time.perf_counter() - start
+
+
+def main():
+    args = arguments()
+    load_dotenv(dotenv_path=str(Path(__file__).parents[1]) + '/im_core/.env')
+
+    import im_core.drivers
+
+    db = im_core.drivers.PostGres(
+        os.environ.get('DB_HOST'), os.environ.get('DB_PORT'), os.environ.get('DB_DATABASE'), os.environ.get('DB_USERNAME'), os.environ.get('DB_PASSWORD')
+    )
+    records = rows(args.rows, args.tags)
+    table = 'bulkload_facts'
+    paths = {
+        'executeValues': lambda batch: db.executeValues(
+            'INSERT INTO ' + table + ' (tag_id, time, val) VALUES %s ON CONFLICT (tag_id, time) DO NOTHING',
+            batch,
+            template='(%s, to_timestamp(%s / 1000.0), %s)'
+        ),
+        'copyMerge': lambda batch: db.copyMerge(
+            table + '_staging',
+            [('tag_id', 'INT'), ('time', 'BIGINT'), ('val', 'DOUBLE PRECISION')],
+            batch,
+            'INSERT INTO ' + table + ' (tag_id, time, val) SELECT tag_id, to_timestamp(time / 1000.0), val FROM ' + table + '_staging '
+            'ON CONFLICT (tag_id, time) DO NOTHING'
+        )
+    }
+    report = {'rows': args.rows, 'batch': args.batch, 'paths': {}}
+
+    # Each path loads into an empty table with the same unique index as facts
+    for name, fn in paths.items():
+        db.execute('DROP TABLE IF EXISTS ' + table)
+        db.execute('CREATE TABLE ' + table + ' (tag_id INT NOT NULL, time TIMESTAMPTZ NOT NULL, val DOUBLE PRECISION NOT NULL, UNIQUE (tag_id, time))')
+
+        elapsed = timed(fn, records, args.batch)
+        report['paths'][name] = {
+            'seconds': round(elapsed, 3),
+            'rowsPerSecond': round(args.rows / elapsed, 1),
+            'loaded': db.execute('SELECT COUNT(*) FROM ' + table)[0][0]
+        }
+
+    db.execute('DROP TABLE IF EXISTS ' + table)
+    json.dump(report, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from contextlib import contextmanager
+from psycopg2 import OperationalError
+
+
+class FakeCloud:
+    # Local stand-in for the cloud database, it answers the subset of SQL the daemon sends to PostGres
+    schema = (
+        "CREATE TABLE daemons (id INTEGER PRIMARY KEY, config_key TEXT, active BOOLEAN, last_communication TEXT)",
+        "CREATE TABLE sources (id INTEGER PRIMARY KEY, daemon_id INT, active BOOLEAN, address TEXT, driver TEXT, last_communication TEXT)",
+        "CREATE TABLE tags (id INTEGER PRIMARY KEY, name TEXT NOT NULL, data_type_name TEXT, source_id INT NOT NULL, "
+        "monitor BOOLEAN DEFAULT false, record_mode TEXT, deadband DOUBLE, deadband_type TEXT, max_interval DOUBLE, "
+        "scan_rate DOUBLE, forward_raw BOOLEAN, created_at TEXT, updated_at TEXT, UNIQUE (name, source_id))",
+        "CREATE TABLE facts (tag_id INT, time TEXT, val DOUBLE, UNIQUE (tag_id, time))",
+        "CREATE TABLE rollups (tag_id INT, period INT, time TEXT, min DOUBLE, max DOUBLE, avg DOUBLE, count INT, "
+        "first DOUBLE, last DOUBLE, UNIQUE (tag_id, period, time))",
+        "CREATE TABLE logs (id INTEGER PRIMARY KEY, time TEXT, message TEXT, level TEXT, daemon_id INT)"
+    )
+
+    def __init__(self, path, latency=0.0, latencyPerRow=0.0):
+        # Settings
+        self.latency = latency
+        self.latencyPerRow = latencyPerRow
+        self.outage = False
+
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.create_function('LEAST', -1, min)
+        self.conn.create_function('GREATEST', -1, max)
+        self.conn.create_function('to_timestamp', 1, lambda seconds: datetime.fromtimestamp(seconds, timezone.utc).isoformat(sep=' '))
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = OFF')
+        self._lock = threading.RLock()
+        self._inUse = 0
+        self._listeners = []
+
+        for query in self.schema:
+            self.conn.execute(query)
+
+        # Statistics
+        self.rowsReceived = 0
+        self.reads = 0
+
+    def seed(self, configKey, sources):
+        now = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.conn.execute("INSERT INTO daemons (id, config_key, active, last_communication) VALUES (1, ?, true, ?)", [configKey, now])
+
+        for sid in range(1, sources + 1):
+            self.conn.execute(
+                "INSERT INTO sources (id, daemon_id, active, address, driver) VALUES (?, 1, true, ?, 'Logix')",
+                [sid, '10.0.0.' + str(sid)]
+            )
+
+    @staticmethod
+    def _translate(query):
+        query = query.replace('%s', '?').replace(' ON COMMIT DROP', '')
+
+        # SQLite needs a WHERE clause to tell an upsert apart from a join in INSERT ... SELECT
+        if 'SELECT' in query and 'ON CONFLICT' in query and ' WHERE ' not in query.split('ON CONFLICT')[0]:
+            query = query.replace(' ON CONFLICT', ' WHERE true ON CONFLICT', 1)
+
+        return query
+
+    def _call(self, rows=1):
+        if self.outage:
+            raise OperationalError('Simulated cloud outage')
+
+        if self.latency > 0 or self.latencyPerRow > 0:
+            time.sleep(self.latency + self.latencyPerRow * rows)
+
+    def usage(self):
+        return self._inUse, 0
+
+    def execute(self, query, values=None):
+        self._call()
+
+        with self._lock:
+            rows = self.conn.execute(self._translate(query), values or []).fetchall()
+
+        if 'SELECT' in query:
+            self.reads += 1
+            return rows
+        return True
+
+    def executePrepared(self, name, query, values=None):
+        return self.execute(query, values)
+
+    def executeMany(self, query, values, pageSize=1000):
+        values = list(values)
+        self._call(len(values))
+
+        with self.transaction() as cursor:
+            cursor.executemany(self._translate(query), values)
+            self.rowsReceived += len(values)
+
+        return True
+
+    def _executeValues(self, cursor, query, values, template=None):
+        values = list(values)
+
+        if len(values) == 0:
+            return 0
+
+        template = self._translate(template) if template is not None else '(' + ', '.join('?' * len(values[0])) + ')'
+        query = self._translate(query).replace('VALUES ?', 'VALUES ' + template, 1)
+        cursor.executemany(query, values)
+        self.rowsReceived += len(values)
+        return len(values)
+
+    def executeValues(self, query, values, pageSize=1000, template=None):
+        values = list(values)
+        self._call(len(values))
+
+        with self.transaction() as cursor:
+            self._executeValues(cursor, query, values, template)
+
+        return True
+
+    @contextmanager
+    def transaction(self):
+        self._call()
+
+        with self._lock:
+            self._inUse += 1
+            cursor = self.conn.cursor()
+            cursor.execute('BEGIN')
+
+            try:
+                yield cursor
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+            finally:
+                self._inUse -= 1
+                cursor.close()
+
+    def copyMerge(self, staging, columns, values, mergeQuery, mergeValues=None, pageSize=100000):
+        # The staging table is filled with plain inserts, there is no COPY in SQLite
+        values = list(values)
+        self._call(len(values))
+
+        with self.transaction() as cursor:
+            cursor.execute('CREATE TEMP TABLE ' + staging + ' (' + ', '.join(name + ' ' + columnType for name, columnType in columns) + ')')
+
+            try:
+                self._executeValues(cursor, 'INSERT INTO ' + staging + ' VALUES %s', values)
+                cursor.execute(self._translate(mergeQuery), mergeValues or [])
+                return cursor.rowcount
+            finally:
+                cursor.execute('DROP TABLE ' + staging)
+
+    @contextmanager
+    def listen(self, channel):
+        # There are no triggers here, scenarios call notify after changing the configuration
+        self._call()
+        subscription = (channel, queue.Queue())
+        self._listeners.append(subscription)
+
+        def wait(timeout):
+            try:
+                notifications = [subscription[1].get(timeout=timeout)]
+            except queue.Empty:
+                notifications = []
+
+            while not subscription[1].empty():
+                notifications.append(subscription[1].get_nowait())
+
+            if self.outage:
+                raise OperationalError('Simulated cloud outage')
+
+            return notifications
+
+        try:
+            yield wait
+        finally:
+            self._listeners.remove(subscription)
+
+    def notify(self, channel, payload):
+        for listening, notifications in list(self._listeners):
+            if listening == channel:
+                notifications.put((channel, payload))
+
+    def query(self, query, values=None):
+        # Direct access for scenarios, never affected by a simulated outage
+        with self._lock:
+            return self.conn.execute(query, values or []).fetchall()
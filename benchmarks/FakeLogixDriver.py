@@ -0,0 +1,160 @@
+import math
+import random
+import re
+import struct
+import threading
+import time
+from pycomm3 import CommError, Tag
+
+
+class FakeLogixDriver:
+    # Simulated controller, shared by every connection the daemon opens
+    profile = {
+        'tags': 20000,
+        'latency': 0.005,
+        'latencyPerTag': 0.00001,
+        'jitter': 0.2,
+        'errorRate': 0.0,
+        'invalidRate': 0.0,
+        'connectLatency': 0.05,
+        'uploadLatencyPerTag': 0.00002,
+        'offline': False,
+        'revision': 1
+    }
+
+    rangePattern = re.compile(r'^(.*)\[(\d+)\]\{(\d+)\}$')
+    indexPattern = re.compile(r'\[\d+\]$')
+
+    _definitions = None
+    _definitionsRevision = None
+    _definitionsLock = threading.Lock()
+
+    @classmethod
+    def configure(cls, **profile):
+        cls.profile = dict(cls.profile, **profile)
+
+    @classmethod
+    def _member(cls, dataType):
+        return {'data_type_name': dataType, 'data_type': dataType, 'dim': 0, 'dimensions': [0, 0, 0], 'tag_type': 'atomic'}
+
+    @classmethod
+    def definitions(cls):
+        # Half scalars, a quarter array elements and a quarter structure members, cached per program revision
+        with cls._definitionsLock:
+            if cls._definitionsRevision == cls.profile['revision']:
+                return cls._definitions
+
+            count = cls.profile['tags']
+            types = ('REAL', 'DINT', 'BOOL', 'INT')
+            motor = {
+                'name': 'MOTOR',
+                'template': {'structure_size': 20},
+                'internal_tags': {
+                    'Speed': cls._member('REAL'),
+                    'Current': cls._member('REAL'),
+                    'Running': cls._member('BOOL'),
+                    'Faults': cls._member('DINT'),
+                    'Hours': cls._member('DINT')
+                }
+            }
+            tags = {}
+
+            for i in range(count // 2):
+                tags['Tag_' + str(i).zfill(6)] = cls._member(types[i % len(types)])
+
+            for i in range(count // 400):
+                tags['Array_' + str(i).zfill(4)] = dict(cls._member('REAL'), dim=1, dimensions=[100, 0, 0])
+
+            for i in range(count // 20):
+                tags['Motor_' + str(i).zfill(5)] = {'data_type_name': 'MOTOR', 'data_type': motor, 'dim': 0, 'dimensions': [0, 0, 0], 'tag_type': 'struct'}
+
+            cls._definitions = (tags, {'MOTOR': motor})
+            cls._definitionsRevision = cls.profile['revision']
+            return cls._definitions
+
+    def __init__(self, address, init_tags=True):
+        self.address = address
+        self.connected = False
+        self._tags = {}
+        self._data_types = {}
+        self.connection_size = 4000
+        self._random = random.Random(hash(address) ^ id(self))
+
+    @property
+    def tags(self):
+        return self._tags
+
+    @property
+    def tags_json(self):
+        return self._tags
+
+    @property
+    def data_types(self):
+        return self._data_types
+
+    @property
+    def info(self):
+        return {'serial': 'fake', 'revision': '33.11', 'name': 'Fake_' + str(self.address)}
+
+    def _wait(self, seconds):
+        jitter = self.profile['jitter']
+        time.sleep(max(0.0, seconds * self._random.uniform(1 - jitter, 1 + jitter)))
+
+    def open(self):
+        self._wait(self.profile['connectLatency'])
+
+        if self.profile['offline']:
+            raise CommError('Simulated PLC is offline')
+
+        self.connected = True
+        return True
+
+    def close(self):
+        self.connected = False
+
+    def get_tag_list(self, program=None):
+        tags, dataTypes = self.definitions()
+        self._wait(self.profile['uploadLatencyPerTag'] * len(tags))
+        self._tags = tags
+        self._data_types = dataTypes
+        return list(tags.values())
+
+    def generic_message(self, **kwargs):
+        return Tag(kwargs.get('name'), struct.pack('<I', self.profile['revision']), None, None)
+
+    def _value(self, name, now):
+        if self._random.random() < self.profile['invalidRate']:
+            return float('nan')
+
+        # Slow waves with a little noise, so change and deadband recording behave like a real process
+        phase = (hash(name) % 1000) / 1000.0
+        return round(100.0 * math.sin(now / 60.0 + phase * math.tau) + self._random.gauss(0.0, 0.5), 3)
+
+    def _read(self, name, now):
+        # Range reads return a list of elements and structures return a dict of their members
+        ranged = self.rangePattern.match(name)
+
+        if ranged is not None:
+            base, start, count = ranged.group(1), int(ranged.group(2)), int(ranged.group(3))
+            return [self._read(base + '[' + str(start + i) + ']', now) for i in range(count)]
+
+        definition = self.definitions()[0].get(self.indexPattern.sub('', name))
+
+        if definition is not None and definition['tag_type'] == 'struct':
+            return {member: self._value(name + '.' + member, now) for member in definition['data_type']['internal_tags']}
+
+        return self._value(name, now)
+
+    def read(self, *tags):
+        if not self.connected or self.profile['offline']:
+            self.connected = False
+            raise CommError('Simulated PLC connection dropped')
+
+        self._wait(self.profile['latency'] + self.profile['latencyPerTag'] * len(tags))
+
+        if self._random.random() < self.profile['errorRate']:
+            raise CommError('Simulated PLC read error')
+
+        now = time.time()
+        results = [Tag(name, self._read(name, now), 'REAL', None) for name in tags]
+        return results if len(results) > 1 else results[0]
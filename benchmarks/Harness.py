@@ -0,0 +1,286 @@
+import os
+import sys
+import time
+import random
+import resource
+import importlib
+import threading
+from benchmarks.FakeCloud import FakeCloud
+from benchmarks.FakeLogixDriver import FakeLogixDriver
+
+
+class Harness:
+    scenarios = ('steady', 'discovery', 'outage', 'churn')
+
+    def __init__(self, scenario, workdir, tags=20000, sources=1, monitored=None, duration=30.0, pollTime=1.0,
+                 latency=0.005, jitter=0.2, errorRate=0.0, cloudLatency=0.0, churn=0.05, notify=False):
+        # Settings
+        self.scenario = scenario
+        self.workdir = workdir
+        self.tags = tags
+        self.sources = sources
+        self.monitored = monitored
+        self.duration = duration
+        self.pollTime = pollTime
+        self.churn = churn
+        self.notify = notify
+        self.config = {
+            'tags': tags, 'sources': sources, 'monitored': monitored, 'duration': duration, 'pollTime': pollTime,
+            'latency': latency, 'jitter': jitter, 'errorRate': errorRate, 'cloudLatency': cloudLatency, 'churn': churn,
+            'notify': notify
+        }
+
+        # Results
+        self.results = {}
+        self._cycles = []
+        self._cyclesLock = threading.Lock()
+        self._events = {}
+        self._applySeconds = []
+
+        # The daemon reads its settings from the environment once the classes are constructed
+        os.environ.update({
+            'CONFIGURATION_KEY': 'benchmark',
+            'DB_CONNECTION': 'pgsql',
+            'DATA_PATH': workdir,
+            'POLL_TIME': str(pollTime),
+            'SCAN_TICK': str(min(0.25, pollTime)),
+            'STORE_TIME': '5',
+            'SYNC_TIME': '5' if scenario == 'churn' else '60',
+            'FORWARD_TIME': '5',
+            'CONFIG_NOTIFY': '1' if notify else '0'
+        })
+
+        FakeLogixDriver.configure(tags=tags, latency=latency, jitter=jitter, errorRate=errorRate)
+        self.cloud = FakeCloud(workdir + '/cloud.db', cloudLatency)
+        self.cloud.seed('benchmark', sources)
+        self._patch()
+
+    def _patch(self):
+        import im_core.drivers
+        import im_core.classes
+
+        # The real driver, pool and database classes run against the simulated PLC and cloud
+        for module in ('im_core.drivers.Logix', 'im_core.drivers.LogixConnectionPool'):
+            importlib.import_module(module).LogixDriver = FakeLogixDriver
+        im_core.drivers.PostGres = lambda *args: self.cloud
+
+        finish = im_core.classes.ScanClass.finish
+        harness = self
+
+        def timedFinish(scanClass, duration, tagsRead):
+            with harness._cyclesLock:
+                harness._cycles.append(duration)
+            finish(scanClass, duration, tagsRead)
+
+        im_core.classes.ScanClass.finish = timedFinish
+
+    def _startDaemon(self):
+        import im_core.classes
+
+        start = time.perf_counter()
+        self.daemon = im_core.classes.Daemon()
+
+        while len(self.daemon.sources) < self.sources:
+            if time.perf_counter() - start > 600:
+                raise RuntimeError('Sources did not start within 10 minutes')
+            time.sleep(0.05)
+
+        self.results['startupSeconds'] = time.perf_counter() - start
+        self.results['startupPhases'] = {
+            str(sid): {phase: round(duration, 4) for phase, duration in source.timings.items()}
+            for sid, source in self.daemon.sources.items()
+        }
+
+    def _monitor(self):
+        # Monitor the first tags of every source, the daemon picks them up on its next sync
+        limit = self.monitored if self.monitored is not None else -1
+        now = time.strftime('%Y-%m-%d %H:%M:%S')
+
+        for sid in self.daemon.sources.keys():
+            self.cloud.query(
+                "UPDATE tags SET monitor = true, updated_at = ? WHERE id IN (SELECT id FROM tags WHERE source_id = ? ORDER BY id LIMIT ?)",
+                [now, sid, limit]
+            )
+
+        self.daemon.syncSources()
+        self.results['monitoredTags'] = sum(len(source.driver_instance.monitoringTags) for source in self.daemon.sources.values())
+
+    def _churn(self):
+        # A share of the monitored tags change their recording settings between syncs
+        now = time.strftime('%Y-%m-%d %H:%M:%S')
+        ids = [row[0] for row in self.cloud.query("SELECT id FROM tags WHERE monitor = true")]
+        changed = random.sample(ids, int(len(ids) * self.churn))
+
+        self.cloud.query(
+            "UPDATE tags SET record_mode = CASE WHEN record_mode = 'deadband' THEN 'all' ELSE 'deadband' END, deadband = 0.5, updated_at = ? "
+            "WHERE id IN (" + ','.join('?' * len(changed)) + ")",
+            [now] + changed
+        )
+        self._events['churnedTags'] = self._events.get('churnedTags', 0) + len(changed)
+
+        if len(changed) == 0:
+            return
+
+        # The cloud triggers are simulated, one notification per source like a bulk edit in one transaction
+        if self.notify:
+            for sid, in self.cloud.query("SELECT DISTINCT source_id FROM tags WHERE id IN (" + ','.join('?' * len(changed)) + ")", changed):
+                self.cloud.notify('imcore_config', 'tags:' + str(sid))
+
+        tag = self.cloud.query("SELECT name, source_id, record_mode FROM tags WHERE id = ?", [changed[0]])[0]
+        threading.Thread(target=self._watchApply, args=(tag[0], tag[1], tag[2], time.perf_counter()), daemon=True).start()
+
+    def _watchApply(self, name, sid, mode, start):
+        # Time from a change in the cloud until the daemon records the tag with its new settings
+        while time.perf_counter() - start < self.daemon.sync_time * 2:
+            tag = self.daemon.sources[sid].driver_instance.monitoringTags.get(name)
+
+            if tag is not None and tag.mode == mode:
+                with self._cyclesLock:
+                    self._applySeconds.append(time.perf_counter() - start)
+                return
+
+            time.sleep(0.01)
+
+    def _outage(self, down):
+        self.cloud.outage = down
+        self._events['outageStart' if down else 'outageEnd'] = time.perf_counter()
+
+    def _stages(self):
+        from im_core.classes import Stage
+
+        daemon = self.daemon
+
+        def sync():
+            daemon.syncDaemon()
+            daemon.syncSources()
+
+        return [
+            Stage('poll', daemon.pollSources, daemon.scan_tick),
+            Stage('store', daemon.storeData, daemon.store_time, False),
+            Stage('sync', sync, daemon.sync_time, False),
+            Stage('forward', daemon.forwardData, daemon.forward_time, False),
+            Stage('utilities', daemon.forwardLogs, 5, False)
+        ]
+
+    def _runStages(self, duration):
+        from twisted.internet import reactor, task
+
+        stages = self._stages()
+
+        for stage in stages:
+            stage.start()
+
+        if self.scenario == 'outage':
+            reactor.callLater(duration / 3, self._outage, True)
+            reactor.callLater(duration * 2 / 3, self._outage, False)
+        elif self.scenario == 'churn':
+            # Changes land half way between syncs, the way an edit in the cloud does on average
+            churn = task.LoopingCall(self._churn)
+            reactor.callLater(self.daemon.sync_time / 2, churn.start, self.daemon.sync_time)
+
+        self._backlogPeak = 0
+
+        def watchBacklog():
+            backlog = self.daemon.store.factBacklog()
+            self._backlogPeak = max(self._backlogPeak, backlog)
+
+            # Drain time runs from the end of the outage until the backlog is forwarded
+            if 'outageEnd' in self._events and 'drainSeconds' not in self.results and backlog <= self.daemon.forward_batch_size:
+                self.results['drainSeconds'] = round(time.perf_counter() - self._events['outageEnd'], 3)
+
+        watch = task.LoopingCall(watchBacklog)
+        watch.start(1.0)
+
+        self._runStart = time.perf_counter()
+        self._readsStart = self.cloud.reads
+        reactor.callLater(duration, reactor.stop)
+        reactor.run(installSignalHandlers=False)
+        self._runEnd = time.perf_counter()
+
+        self.results['stages'] = {
+            stage.name: {'runs': stage.runs, 'skipped': stage.skipped, 'maxSeconds': round(stage.maxDuration, 4)} for stage in stages
+        }
+
+    @staticmethod
+    def _percentile(values, percentile):
+        if len(values) == 0:
+            return None
+
+        values = sorted(values)
+        return values[min(len(values) - 1, int(round(percentile / 100.0 * (len(values) - 1))))]
+
+    @staticmethod
+    def _histogramTotals(name, labels=None):
+        import im_core.classes
+
+        metric = im_core.classes.Metrics().get(name)
+        children = [child for values, child in (metric.collect() if metric is not None else []) if labels is None or values == labels]
+        return sum(child.sum for child in children), sum(child.count for child in children)
+
+    def _collect(self):
+        import im_core.classes
+
+        elapsed = self._runEnd - self._runStart
+        counter = im_core.classes.Metrics().get('imcore_tags_read_total')
+        tagsRead = sum(child.value for values, child in counter.collect()) if counter is not None else 0
+        invalid = im_core.classes.Metrics().get('imcore_invalid_values_total')
+
+        storeRows, storeCommits = self._histogramTotals('imcore_store_batch_rows')
+        storeSeconds, _ = self._histogramTotals('imcore_store_batch_seconds')
+        forwardRows, forwardBatches = self._histogramTotals('imcore_forward_batch_rows', ('facts',))
+        forwardSeconds, _ = self._histogramTotals('imcore_forward_batch_seconds', ('facts',))
+
+        self.results.update({
+            'elapsedSeconds': round(elapsed, 3),
+            'tagsRead': int(tagsRead),
+            'tagsPerSecond': round(tagsRead / elapsed, 1) if elapsed > 0 else 0.0,
+            'invalidValues': int(sum(child.value for values, child in invalid.collect())) if invalid is not None else 0,
+            'pollCycles': len(self._cycles),
+            'pollP50Seconds': self._percentile(self._cycles, 50),
+            'pollP99Seconds': self._percentile(self._cycles, 99),
+            'missedCycles': sum(scanClass.missed for source in self.daemon.sources.values() for scanClass in source.driver_instance.scanClasses.values()),
+            'storeRows': int(storeRows),
+            'storeCommits': storeCommits,
+            'storeRowsPerSecond': round(storeRows / storeSeconds, 1) if storeSeconds > 0 else None,
+            'forwardRows': int(forwardRows),
+            'forwardBatches': forwardBatches,
+            'forwardRowsPerSecond': round(forwardRows / forwardSeconds, 1) if forwardSeconds > 0 else None,
+            'backlogPeakRows': self._backlogPeak,
+            'backlogFinalRows': self.daemon.store.factBacklog(),
+            'cloudFacts': self.cloud.query("SELECT COUNT(*) FROM facts")[0][0],
+            'cloudReadsPerMinute': round((self.cloud.reads - self._readsStart) / elapsed * 60, 1) if elapsed > 0 else 0.0,
+            'peakRssBytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        })
+
+        if 'churnedTags' in self._events:
+            self.results['churnedTags'] = self._events['churnedTags']
+            self.results['churnApplyP50Seconds'] = self._percentile(self._applySeconds, 50)
+            self.results['churnApplyMaxSeconds'] = max(self._applySeconds) if self._applySeconds else None
+
+    def _discovery(self):
+        # Cold discovery happened during startup, a second pass measures the unchanged program path
+        source = next(iter(self.daemon.sources.values()))
+        start = time.perf_counter()
+        source.discoverTags()
+        self.results['rediscoverSeconds'] = round(time.perf_counter() - start, 4)
+
+        FakeLogixDriver.configure(revision=FakeLogixDriver.profile['revision'] + 1)
+        start = time.perf_counter()
+        source.discoverTags()
+        self.results['changedProgramDiscoverSeconds'] = round(time.perf_counter() - start, 4)
+
+        self.results['discoveredTags'] = len(source.driver_instance.discoveredTags)
+        self.results['cloudTags'] = self.cloud.query("SELECT COUNT(*) FROM tags")[0][0]
+        self.results['peakRssBytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+    def run(self):
+        self._startDaemon()
+
+        if self.scenario == 'discovery':
+            self._discovery()
+        else:
+            self._monitor()
+            self._runStages(self.duration)
+            self._collect()
+
+        return {'scenario': self.scenario, 'config': self.config, 'results': self.results}
@@ -0,0 +1,102 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+from datetime import datetime
+
+
+def arguments():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='End to end throughput benchmarks against a simulated PLC and cloud')
+    parser.add_argument('--scenario', default='all', choices=('all', 'steady', 'discovery', 'outage', 'churn'))
+    parser.add_argument('--tags', type=int, default=20000, help='Leaf tags on each simulated controller')
+    parser.add_argument('--sources', type=int, default=1)
+    parser.add_argument('--monitored', type=int, default=None, help='Monitored tags per source, all by default')
+    parser.add_argument('--duration', type=float, default=30.0, help='Seconds each polling scenario runs for')
+    parser.add_argument('--poll-time', type=float, default=1.0)
+    parser.add_argument('--latency', type=float, default=0.005, help='PLC round trip per read request in seconds')
+    parser.add_argument('--jitter', type=float, default=0.2, help='Relative spread of the PLC latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of PLC reads that fail')
+    parser.add_argument('--cloud-latency', type=float, default=0.0, help='Cloud round trip per statement in seconds')
+    parser.add_argument('--churn', type=float, default=0.05, help='Share of monitored tags changed per sync in the churn scenario')
+    parser.add_argument('--notify', action='store_true', help='Push configuration changes to the daemon instead of waiting for its sync poll')
+    parser.add_argument('--output', default=None, help='Write the JSON report here instead of stdout')
+    parser.add_argument('--verbose', action='store_true', help='Show the daemon log output')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def runScenario(args):
+    from benchmarks.Harness import Harness
+
+    workdir = tempfile.mkdtemp(prefix='imcore-bench-')
+
+    try:
+        harness = Harness(
+            args.scenario, workdir, args.tags, args.sources, args.monitored, args.duration, args.poll_time,
+            args.latency, args.jitter, args.error_rate, args.cloud_latency, args.churn, args.notify
+        )
+        report = harness.run()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.child, 'w') as file:
+        json.dump(report, file)
+
+    # Pools and the logger thread are left to the process exit
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def main():
+    args = arguments()
+
+    if args.child is not None:
+        runScenario(args)
+
+    # Every scenario runs in a fresh process, the daemon singletons and the reactor only start once per process
+    from benchmarks.Harness import Harness
+
+    scenarios = Harness.scenarios if args.scenario == 'all' else (args.scenario,)
+    report = {
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scenarios': []
+    }
+
+    for scenario in scenarios:
+        handle, path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        command = [sys.executable, '-m', 'benchmarks', '--scenario', scenario, '--child', path]
+
+        for name, value in vars(args).items():
+            if name in ('scenario', 'child', 'output', 'verbose') or value is None or value is False:
+                continue
+
+            command += ['--' + name.replace('_', '-')] if value is True else ['--' + name.replace('_', '-'), str(value)]
+
+        process = subprocess.run(command, stdout=None if args.verbose else subprocess.DEVNULL)
+
+        try:
+            with open(path) as file:
+                report['scenarios'].append(json.load(file))
+        except (OSError, ValueError):
+            report['scenarios'].append({'scenario': scenario, 'error': 'Scenario exited with code ' + str(process.returncode)})
+        finally:
+            os.unlink(path)
+
+    output = json.dumps(report, indent=2)
+
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,7 @@
-from im_core.classes import Daemon
-from twisted.internet import task, reactor
+import os
+from im_core.classes import Daemon, Stage, MetricsResource
+from twisted.internet import reactor
+from twisted.web.server import Site
 
 def poll():
     Daemon.pollSources()
@@ -19,6 +21,7 @@ def forward():
 
 
 def utilities():
+    Daemon.superviseWorkers()
     Daemon.forwardLogs()
 
 
@@ -26,10 +29,22 @@ if __name__ == '__main__':
     # Initialize
     Daemon = Daemon()
 
-    # Scheduling
-    task.LoopingCall(poll).start(Daemon.poll_time)
-    task.LoopingCall(store).start(Daemon.store_time, False)
-    task.LoopingCall(sync).start(Daemon.sync_time, False)
-    task.LoopingCall(forward).start(Daemon.forward_time, False)
-    task.LoopingCall(utilities).start(5, False)
+    # Scheduling, every stage runs on its own worker thread
+    stages = [
+        Stage('poll', poll, Daemon.scan_tick),
+        Stage('store', store, Daemon.store_time, False),
+        Stage('sync', sync, Daemon.sync_time, False),
+        Stage('forward', forward, Daemon.forward_time, False),
+        Stage('utilities', utilities, 5, False)
+    ]
+
+    for stage in stages:
+        stage.start()
+
+    # Metrics endpoint for Prometheus, served from the reactor thread
+    metricsPort = int(os.environ.get('METRICS_PORT', 9108))
+
+    if metricsPort > 0:
+        reactor.listenTCP(metricsPort, Site(MetricsResource()), interface=os.environ.get('METRICS_INTERFACE', ''))
+
     reactor.run()
@@ -4,7 +4,11 @@ from collections import OrderedDict
 from dotenv import load_dotenv
 from datetime import datetime
 import time
-from psycopg2 import OperationalError
+import sqlite3
+import threading
+from psycopg2 import Error, OperationalError
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import im_core.classes
 
 env_path = str(Path(__file__).parents[1]) + '/.env'
@@ -20,15 +24,39 @@ class Daemon:
         self._configKey = os.environ.get('CONFIGURATION_KEY')
         self.last_heartbeat = None
         self.poll_time = float(os.environ.get('POLL_TIME'))
+        self.scan_tick = float(os.environ.get('SCAN_TICK', self.poll_time))
         self.store_time = float(os.environ.get('STORE_TIME'))
         self.sync_time = float(os.environ.get('SYNC_TIME'))
         self.forward_time = float(os.environ.get('FORWARD_TIME'))
+        self.forward_batch_size = int(os.environ.get('FORWARD_BATCH_SIZE', 5000))
+        self.startup_workers = int(os.environ.get('STARTUP_WORKERS', 4))
+        self.source_processes = int(os.environ.get('SOURCE_PROCESSES', 0))
+        self.worker_restart_max = float(os.environ.get('WORKER_RESTART_MAX', 60))
+        self.config_notify = os.environ.get('CONFIG_NOTIFY', '0').lower() not in ('0', 'false', 'no')
+        self.sync_fallback_time = float(os.environ.get('SYNC_FALLBACK_TIME', 600))
+
+        # Configuration changes pushed by the cloud, polling slows down to the fallback while the listener is up
+        self.notifications = 0
+        self._listening = False
+        self._lastPoll = 0.0
+        self._polling = True
+
+        # Forwarding
+        self.forward_backlog = 0
+        self.forward_rate = 0.0
 
         # Data
         self.db = im_core.classes.Database()
-        self.logger = self._logger()
         self.store = im_core.classes.Store()
+        self._snapshotKey = 'daemon:' + str(self._configKey)
+        self._snapshot = self.store.loadConfig(self._snapshotKey)
+        self.logger = self._logger()
         self.sources = OrderedDict()
+        self.workers = []
+        self._startupLock = threading.Lock()
+        self._startupPending = 0
+        self._sourceIds = set()
+        self._registerMetrics()
 
         # Setup
         self.logger.write('Initializing the daemon...', 'info')
@@ -38,58 +66,284 @@ class Daemon:
         # Helper variables
         self._pausedCounter = 0
 
+    def _registerMetrics(self):
+        metrics = im_core.classes.Metrics()
+        self._forwardRows = metrics.histogram('imcore_forward_batch_rows', 'Rows sent to the cloud per forward batch', ('kind',), metrics.rowsBuckets)
+        self._forwardSeconds = metrics.histogram('imcore_forward_batch_seconds', 'Duration of forward batches', ('kind',))
+
+        # Everything below is read when scraped, the stages only keep their existing counters up to date
+        metrics.gauge('imcore_store_backlog_rows', 'Facts in the local store waiting to be forwarded', fn=lambda: self.forward_backlog)
+        metrics.gauge('imcore_forward_rows_per_second', 'Forward throughput of the last forward run', fn=lambda: self.forward_rate)
+        metrics.gauge('imcore_store_size_bytes', 'Size of the local store', fn=self.store.usedBytes)
+        metrics.counter('imcore_store_evicted_rows_total', 'Facts evicted from the local store over its budget', fn=lambda: self.store.evictedRows)
+        metrics.counter('imcore_store_downsampled_rows_total', 'Facts removed from the local store by downsampling', fn=lambda: self.store.downsampledRows)
+        metrics.gauge('imcore_logger_latency_seconds', 'Latency of the last persisted log line', fn=lambda: self.logger.lastLatency)
+        im_core.classes.Source.registerMetrics(lambda: list(self.sources.values()))
+        metrics.gauge('imcore_source_workers', 'Source worker processes', ('state',), fn=lambda: [
+            (('alive',), sum(1 for worker in self.workers if worker.alive)), (('down',), sum(1 for worker in self.workers if not worker.alive))
+        ])
+        metrics.counter('imcore_source_worker_restarts_total', 'Source worker processes restarted after exiting', fn=lambda: sum(worker.restarts for worker in self.workers))
+        metrics.gauge('imcore_config_listening', 'Whether configuration changes are pushed by the cloud', fn=lambda: int(self._listening))
+        metrics.counter('imcore_config_notifications_total', 'Configuration change notifications received from the cloud', fn=lambda: self.notifications)
+        metrics.gauge('imcore_postgres_connections', 'Cloud database pool connections', ('state',), fn=self._postgresConnections)
+
+    def _postgresConnections(self):
+        used, idle = self.db.conn.usage()
+        return [(('in_use',), used), (('idle',), idle)]
+
     def _logger(self):
-        try:
-            daemon = self.db.conn.execute(
+        # The last known daemon id starts the logger without waiting on the cloud
+        if self._snapshot is not None:
+            return im_core.classes.Logger(self._snapshot['id'])
+
+        while True:
+            try:
+                daemon = self.db.conn.execute(
                     "SELECT id FROM daemons WHERE config_key = %s",
                     [self._configKey]
-                )[0]
+                )
+
+                if daemon:
+                    return im_core.classes.Logger(daemon[0]['id'])
 
-            if daemon:
-                return im_core.classes.Logger(daemon['id'])
-            else:
                 print('Error configuring logger... does a daemon with this configuration key exist? Trying again in 5 seconds...')
-                time.sleep(5)
-                self._logger()
-        except Exception as e:
-            print('Error configuring logger... has the cloud database been initialized, and does a daemon with this configuration key exist? Trying again in 5 seconds...')
-            print(e)
+            except Exception as e:
+                print('Error configuring logger... has the cloud database been initialized, and does a daemon with this configuration key exist? Trying again in 5 seconds...')
+                print(e)
+
             time.sleep(5)
-            self._logger()
 
+    def _fetchConfiguration(self):
+        daemon = self.db.conn.execute(
+            "SELECT id, active FROM daemons WHERE config_key = %s",
+            [self._configKey]
+        )
+
+        if not daemon:
+            return None
+
+        sources = self.db.conn.execute(
+            "SELECT id FROM sources WHERE daemon_id = %s",
+            [daemon[0]['id']]
+        )
+
+        # Every configuration read from the cloud becomes the snapshot the next start uses
+        configuration = {'id': daemon[0]['id'], 'active': daemon[0]['active'], 'sources': [src['id'] for src in sources]}
+        self.store.saveConfig(self._snapshotKey, configuration)
+        return configuration
 
     def _configure(self):
-        try:
-            # Configure Daemon
-            daemon = self.db.conn.execute(
-                "SELECT id, active FROM daemons WHERE config_key = %s",
-                [self._configKey]
-            )[0]
+        configuration = self._snapshot
 
-            if daemon:
-                self.id = daemon['id']
-                self.active = daemon['active']
-                self._heartBeat()
+        if configuration is not None:
+            self.logger.write('Starting from the local configuration snapshot, the cloud is reconciled in the background...', 'info')
 
-                # Configure Sources
-                sources = self.db.conn.execute(
-                    "SELECT id FROM sources WHERE daemon_id = %s",
-                    [self.id]
-                )
+        while configuration is None:
+            try:
+                configuration = self._fetchConfiguration()
+                break
+            except OperationalError:
+                self.logger.write('Communication error with the cloud while configuring the daemon... trying again in 5 seconds', 'danger')
+                time.sleep(5)
+
+        if configuration is None:
+            return
+
+        self.id = configuration['id']
+        self.active = configuration['active']
+
+        if self._snapshot is None:
+            self._heartBeat()
+
+        if configuration['sources'] and self.source_processes > 0:
+            self._startWorkers(configuration['sources'])
+        elif configuration['sources']:
+            self._startSources(configuration['sources'])
+
+        if self._snapshot is not None:
+            threading.Thread(target=self._reconcile, name='reconcile', daemon=True).start()
+
+        if self.config_notify:
+            threading.Thread(target=self._listen, name='notify', daemon=True).start()
+
+    def _reconcile(self):
+        while True:
+            try:
+                configuration = self._fetchConfiguration()
+                break
+            except OperationalError:
+                time.sleep(5)
+
+        if configuration is None:
+            self.logger.write('The daemon with this configuration key no longer exists in the cloud...', 'danger')
+            return
+
+        self._heartBeat()
+        self._applyConfiguration(configuration)
+        self.logger.write('Daemon configuration reconciled with the cloud...', 'success')
+
+    def _applyConfiguration(self, configuration):
+        self.active = configuration['active']
+
+        for worker in self.workers:
+            worker.setActive(self.active)
+
+        # Sources added since they were last read are started, removed ones keep running until the next restart
+        added = [sid for sid in configuration['sources'] if sid not in self._sourceIds]
+        removed = [sid for sid in self._sourceIds if sid not in configuration['sources']]
+
+        if added and self.source_processes > 0:
+            self._startWorkers(added)
+        elif added:
+            self._startSources(added)
+
+        if removed:
+            self.logger.write('Sources with ids ' + ', '.join(str(sid) for sid in removed) + ' were removed in the cloud, they stop on the next restart...', 'warning')
+
+    def _listen(self):
+        # The cloud triggers notify with '<table>:<id>', only what changed is read again
+        while True:
+            try:
+                with self.db.conn.listen('imcore_config') as wait:
+                    # Changes made while nobody was listening are picked up by a poll on the next sync
+                    self._lastPoll = 0.0
+                    self._listening = True
+                    self.logger.write('Listening for configuration changes from the cloud...', 'info')
+
+                    for worker in self.workers:
+                        worker.setListening(True)
+
+                    while True:
+                        notifications = wait(self.sync_time)
+
+                        # A burst of changes, e.g. a bulk tag edit, is applied once
+                        if notifications:
+                            notifications += wait(0.25)
+                            self._applyNotifications({payload for channel, payload in notifications})
+            except OperationalError:
+                if self._listening:
+                    self.logger.write('Lost the configuration change listener... polling the cloud every ' + str(self.sync_time) + 's until it is back', 'warning')
+            except Exception as e:
+                # Anything else, e.g. a failure applying a change, must not end the thread and leave polling switched off
+                self.logger.write('Configuration change listener failed... ' + str(e) + ', polling the cloud every ' + str(self.sync_time) + 's until it is back', 'danger')
+            finally:
+                if self._listening:
+                    self._listening = False
+
+                    for worker in self.workers:
+                        worker.setListening(False)
 
-                if sources:
-                    for src in sources:
-                        self.sources[src['id']] = im_core.classes.Source(src['id'])
-        except OperationalError:
-            self.logger.write('Communication error with the cloud while configuring the daemon... trying again in 5 seconds', 'danger')
             time.sleep(5)
-            self._configure()
+
+    def _applyNotifications(self, payloads):
+        self.notifications += len(payloads)
+        reconfigure = False
+
+        for payload in payloads:
+            fields = payload.split(':')
+
+            try:
+                table, ident = fields[0], int(fields[1])
+            except (IndexError, ValueError):
+                continue
+
+            if table == 'daemons':
+                reconfigure = reconfigure or ident == self.id
+            elif table == 'sources' and ident not in self._sourceIds:
+                # A source added or moved to this daemon, notifications for other daemons' sources are ignored
+                reconfigure = reconfigure or fields[2:3] == [str(self.id)]
+            elif table in ('sources', 'tags') and ident in self.sources:
+                self.sources[ident].applyNotification(table)
+            elif table in ('sources', 'tags'):
+                for worker in self.workers:
+                    if ident in worker.sids:
+                        worker.notify(ident, table)
+
+        if reconfigure:
+            configuration = self._fetchConfiguration()
+
+            if configuration is not None:
+                self._applyConfiguration(configuration)
+                self.logger.write('Applied a configuration change to the daemon...', 'success')
+
+    def _startSources(self, sids):
+        # Sources come up concurrently and join the poll loop as soon as each one is ready
+        self._sourceIds.update(sids)
+
+        with self._startupLock:
+            if self._startupPending == 0:
+                self._startupStart = time.time()
+            self._startupPending += len(sids)
+
+        executor = ThreadPoolExecutor(self.startup_workers, thread_name_prefix='startup')
+
+        for sid in sids:
+            executor.submit(im_core.classes.Source, sid).add_done_callback(partial(self._sourceReady, sid))
+
+        executor.shutdown(wait=False)
+
+    def _sourceReady(self, sid, future):
+        try:
+            self.sources[sid] = future.result()
+        except Exception as e:
+            self.logger.write('Failed to initialize source with id ' + str(sid) + '... ' + str(e), 'danger')
+
+        with self._startupLock:
+            self._startupPending -= 1
+            done = self._startupPending == 0
+
+        if done:
+            self.logger.write('All sources started in ' + str(round(time.time() - self._startupStart, 2)) + 's...', 'success')
+
+    def _startWorkers(self, sids):
+        # Sources are spread over worker processes, each polls on its own interpreter and hands its samples back here
+        count = min(self.source_processes, len(sids))
+        offset = len(self.workers)
+        workers = [
+            im_core.classes.SourceWorker(offset + i, sids[i::count], self.id, self.worker_restart_max) for i in range(count)
+        ]
+        self.workers = self.workers + workers
+        self._sourceIds.update(sids)
+
+        for worker in workers:
+            worker.setActive(self.active)
+            worker.setListening(self._listening)
+            worker.start()
+
+        self.logger.write('Started ' + str(count) + ' worker processes for ' + str(len(sids)) + ' sources...', 'success')
+
+    def superviseWorkers(self):
+        now = time.monotonic()
+
+        for worker in self.workers:
+            if worker.supervise(now):
+                self.logger.write('Restarted the worker process for sources ' + ', '.join(str(sid) for sid in worker.sids) + '...', 'warning')
+
+    def _drainWorkers(self):
+        records = 0
+
+        for message in [message for worker in self.workers for message in worker.receive()]:
+            if message[0] == 'facts':
+                tags, stamps, values = message[1:]
+                self.store.writeFacts(zip(tags, stamps, values), len(tags))
+                records += len(tags)
+            elif message[0] == 'rollups':
+                self.store.writeRollups(message[1])
+            elif message[0] == 'logs':
+                self.store.writeLogs(message[1])
+            elif message[0] == 'config':
+                self.store.saveConfig(message[1], message[2])
+            elif message[0] == 'metrics':
+                im_core.classes.Metrics().merge(message[1])
+
+        return records
 
     def _heartBeat(self):
         try:
             now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-            if self.db.conn.execute(
+            if self.db.conn.executePrepared(
+                'daemon_heartbeat',
                 "UPDATE daemons SET last_communication = %s WHERE id = %s",
                 [now, self.id]
             ):
@@ -98,20 +352,42 @@ class Daemon:
             self.logger.write('Communication error with the cloud while recording daemon heartbeat', 'warning')
 
     def discoverSourceTags(self):
-        for source in self.sources.values():
+        for source in list(self.sources.values()):
             if source.active:
                 source.discoverTags()
 
+    def _pollDue(self):
+        # With the listener up polling only backs up the notifications, every SYNC_FALLBACK_TIME
+        now = time.monotonic()
+
+        if self._listening and now - self._lastPoll < self.sync_fallback_time:
+            return False
+
+        self._lastPoll = now
+        return True
+
     def syncDaemon(self):
+        self._polling = self._pollDue()
+
+        if not self._polling:
+            self._heartBeat()
+
+            if not self.active:
+                self.logger.write('Daemon is in a paused state. Operations are suspended...', 'warning')
+            return
+
         try:
-            daemon = self.db.conn.execute(
-                "SELECT active FROM daemons WHERE id = %s", [self.id]
+            daemon = self.db.conn.executePrepared(
+                'daemon_active', "SELECT active FROM daemons WHERE id = %s", [self.id]
             )[0]
 
             if daemon:
                 self.active = daemon['active']
                 self._heartBeat()
 
+            for worker in self.workers:
+                worker.setActive(self.active)
+
             if not self.active:
                 self.logger.write('Daemon is in a paused state. Operations are suspended...', 'warning')
 
@@ -120,12 +396,12 @@ class Daemon:
 
     def syncSources(self):
         if self.active:
-            for source in self.sources.values():
-                source.sync()
+            for source in list(self.sources.values()):
+                source.sync(self._polling)
 
     def pollSources(self):
         if self.active:
-            for source in self.sources.values():
+            for source in list(self.sources.values()):
                 if source.active:
                     source.poll()
                     self._pausedCounter = 0
@@ -140,30 +416,116 @@ class Daemon:
 
 
     def storeData(self):
-        for source in self.sources.values():
-            if self.active:
-                source.storeData()
+        if self.active:
+            start = time.time()
+            records = 0
+
+            try:
+                if self.workers:
+                    records += self._drainWorkers()
+
+                for source in list(self.sources.values()):
+                    records += source.storeData()
+
+                if self.store.commitFacts() > 0:
+                    self.logger.write(
+                        'Wrote ' + str(self.store.lastCommitRows) + ' records to store (' + str(round(time.time() - start, 2)) + 's, ' + str(round(self.store.lastCommitRate)) + ' rows/s)...',
+                        'success'
+                    )
+            except sqlite3.Error as e:
+                self.logger.write('Failed to write ' + str(records) + ' records to store... ' + str(e), 'danger')
+
+            try:
+                downsampled, evicted = self.store.enforceBudget()
+
+                if downsampled > 0:
+                    self.logger.write('Store is approaching its budget, downsampled ' + str(downsampled) + ' old records...', 'warning')
+                if evicted > 0:
+                    self.logger.write('Store is over its budget, evicted ' + str(evicted) + ' of the oldest records...', 'danger')
+            except sqlite3.Error as e:
+                self.logger.write('Failed to enforce the store budget... ' + str(e), 'danger')
+
+    def _forwardBatches(self, kind, read, ack, send, start):
+        forwarded = 0
+        watermark = 0
+        batchRows = self._forwardRows.labels(kind)
+        batchSeconds = self._forwardSeconds.labels(kind)
+
+        # Drain the backlog in bounded batches, each one is removed locally only once the cloud accepted it
+        while time.time() - start < self.forward_time:
+            records, watermark = read(self.forward_batch_size, watermark)
+
+            if len(records) == 0:
+                break
+
+            batchStart = time.perf_counter()
+            send(records)
+            ack(watermark)
+            batchSeconds.observe(time.perf_counter() - batchStart)
+            batchRows.observe(len(records))
+            forwarded += len(records)
+
+        return forwarded
+
+    def _sendRollups(self, records):
+        self.db.conn.executeValues(
+            'INSERT INTO rollups AS r (tag_id, period, time, min, max, avg, count, first, last) VALUES %s '
+            'ON CONFLICT (tag_id, period, time) DO UPDATE SET '
+            'min = LEAST(r.min, EXCLUDED.min), '
+            'max = GREATEST(r.max, EXCLUDED.max), '
+            'avg = (r.avg * r.count + EXCLUDED.avg * EXCLUDED.count) / (r.count + EXCLUDED.count), '
+            'count = r.count + EXCLUDED.count, '
+            'last = EXCLUDED.last',
+            records,
+            template='(%s, %s, to_timestamp(%s / 1000.0), %s, %s, %s, %s, %s, %s)'
+        )
+
+    def _sendFacts(self, records):
+        # Facts are the bulk of the traffic, they go over binary COPY and are converted to timestamps server side
+        self.db.conn.copyMerge(
+            'facts_staging',
+            [('tag_id', 'INT'), ('time', 'BIGINT'), ('val', 'DOUBLE PRECISION')],
+            records,
+            'INSERT INTO facts (tag_id, time, val) SELECT tag_id, to_timestamp(time / 1000.0), val FROM facts_staging '
+            'ON CONFLICT (tag_id, time) DO NOTHING'
+        )
 
     def forwardData(self):
-        start = time.time()
         if self.active:
+            start = time.time()
+            forwarded = 0
+            rollups = 0
+
             try:
-                now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                records = self.store.conn.execute('SELECT tag_id, time, val FROM facts WHERE time <= ?', [now]).fetchall()
-
-                if len(records) > 0:
-                    listTrimmed = str(records)[1:-1].replace('"', '')
-                    query = (
-                        f'INSERT INTO facts '
-                        f'(tag_id, time, val) '
-                        f'VALUES {listTrimmed} '
-                        f'ON CONFLICT (tag_id, time) DO NOTHING'
-                    )
-                    self.db.conn.execute(query)
-                    self.store.conn.execute('DELETE FROM facts WHERE time <= ?', [now])
-                    self.logger.write('Forwarded data to cloud (' + str(round(time.time() - start, 2)) + 's)...', 'success')
+                rollups = self._forwardBatches(
+                    'rollups',
+                    self.store.readRollups,
+                    self.store.ackRollups,
+                    self._sendRollups,
+                    start
+                )
+                forwarded = self._forwardBatches(
+                    'facts',
+                    self.store.readFacts,
+                    self.store.ackFacts,
+                    self._sendFacts,
+                    start
+                )
             except OperationalError:
                 self.logger.write('Failed to forward tag data to cloud... continuing to store locally', 'danger')
+            except Error as e:
+                # Any other database error leaves the batch unacknowledged too, it is sent again on the next cycle
+                self.logger.write('Failed to forward tag data to cloud... ' + str(e).strip() + '... continuing to store locally', 'danger')
+            finally:
+                elapsed = time.time() - start
+                self.forward_rate = forwarded / elapsed if elapsed > 0 else 0.0
+                self.forward_backlog = self.store.factBacklog()
+
+            if forwarded > 0 or rollups > 0:
+                self.logger.write(
+                    'Forwarded ' + str(forwarded) + ' records and ' + str(rollups) + ' rollups to cloud (' + str(round(elapsed, 2)) + 's, ' + str(round(self.forward_rate)) + ' rows/s, ' + str(self.forward_backlog) + ' remaining)...',
+                    'success'
+                )
 
     def forwardLogs(self):
         try:
@@ -15,11 +15,13 @@ class Database(metaclass=Singleton):
             self.DB_DATABASE = os.environ.get('DB_DATABASE')
             self.DB_USERNAME = os.environ.get('DB_USERNAME')
             self.DB_PASSWORD = os.environ.get('DB_PASSWORD')
+            self.DB_STATEMENT_TIMEOUT = float(os.environ.get('DB_STATEMENT_TIMEOUT', 60))
+            self.DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', 10))
 
             self.conn = None
 
             if self.DB_CONNECTION == "pgsql":
-                self.conn = im_core.drivers.PostGres(self.DB_HOST, self.DB_PORT, self.DB_DATABASE, self.DB_USERNAME, self.DB_PASSWORD)
+                self.conn = im_core.drivers.PostGres(self.DB_HOST, self.DB_PORT, self.DB_DATABASE, self.DB_USERNAME, self.DB_PASSWORD, self.DB_STATEMENT_TIMEOUT, self.DB_CONNECT_TIMEOUT)
             else:
                 print("DB_CONNECTION setting is invalid")
                 sys.exit()
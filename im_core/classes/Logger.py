@@ -1,4 +1,9 @@
-import inspect
+import os
+import sys
+import time
+import queue
+import atexit
+import threading
 from datetime import datetime
 from colored import fg, attr
 from im_core.classes.Singleton import Singleton
@@ -19,13 +24,93 @@ class Logger(metaclass=Singleton):
         self.success = fg('46')
         self.reset = attr('reset')
 
+        # Settings
+        self.flushTime = float(os.environ.get('LOG_FLUSH_TIME', 1))
+        self.dedupTime = float(os.environ.get('LOG_DEDUP_TIME', 30))
+        self.forwardBatchSize = int(os.environ.get('LOG_FORWARD_BATCH_SIZE', 1000))
+
+        # Write latency, measured from write() until the line is persisted
+        self.lastLatency = 0.0
+        self.maxLatency = 0.0
+        self.written = 0
+        self.suppressed = 0
+
+        # Messages are persisted and printed by a single writer thread
+        self._queue = queue.Queue()
+        self._recent = {}
+        self._writer = threading.Thread(target=self._run, name='logger', daemon=True)
+        self._writer.start()
+
+        # Flush queued messages on program exit
+        atexit.register(self._stop)
+
     def write(self, msg, level):
-        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        log = '[' + now + ']: <' + inspect.stack()[1][3] + '> ' + msg + self.reset
+        self._queue.put((time.time(), time.perf_counter(), sys._getframe(1).f_code.co_name, msg, level))
+
+    def _stop(self):
+        self._queue.put(None)
+        self._writer.join(5)
+
+    def _run(self):
+        running = True
+
+        while running:
+            batch = []
+
+            try:
+                batch.append(self._queue.get(timeout=self.flushTime))
+
+                while len(batch) < 1000:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            if None in batch:
+                batch.remove(None)
+                running = False
+
+            try:
+                self._flush(batch)
+            except Exception as e:
+                print(self.danger + 'Failed to write log messages to store... ' + str(e) + self.reset)
+
+    def _flush(self, batch):
+        now = time.time()
+        rows = []
 
-        self.store.conn.execute("""
-            INSERT INTO logs (time, message, level, daemon_id) VALUES (?, ?, ?, ?)
-        """, [now, msg, level, self.daemon_id])
+        for stamp, enqueued, caller, msg, level in batch:
+            # Repeats of the same message are counted and summarized once the window expires
+            key = (caller, msg, level)
+            recent = self._recent.get(key)
+
+            if recent is not None and stamp - recent[0] < self.dedupTime:
+                recent[1] += 1
+                self.suppressed += 1
+                continue
+
+            self._recent[key] = [stamp, 0]
+            rows.append(self._emit(stamp, caller, msg, level))
+
+        for key, recent in list(self._recent.items()):
+            if now - recent[0] >= self.dedupTime:
+                del self._recent[key]
+
+                if recent[1] > 0:
+                    caller, msg, level = key
+                    rows.append(self._emit(now, caller, msg + ' (repeated ' + str(recent[1]) + ' times)', level))
+
+        if len(rows) > 0:
+            self.store.writeLogs(rows)
+
+        if len(batch) > 0:
+            latencies = [time.perf_counter() - item[1] for item in batch]
+            self.lastLatency = max(latencies)
+            self.maxLatency = max(self.maxLatency, self.lastLatency)
+            self.written += len(rows)
+
+    def _emit(self, stamp, caller, msg, level):
+        now = datetime.fromtimestamp(stamp).strftime('%Y-%m-%d %H:%M:%S')
+        log = '[' + now + ']: <' + caller + '> ' + msg + self.reset
 
         if level == 'info':
             print(self.info + log)
@@ -38,18 +123,19 @@ class Logger(metaclass=Singleton):
         else:
             print(self.info + log)
 
+        return now, msg, level, self.daemon_id
+
     def forward(self):
-        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        records = self.store.conn.execute('SELECT time, message, level, daemon_id FROM logs WHERE time <= ?', [now]).fetchall()
-
-        if len(records) > 0:
-            listTrimmed = str(records)[1:-1].replace('"', '')
-            query = (
-                f'INSERT INTO logs '
-                f'(time, message, level, daemon_id) '
-                f'VALUES {listTrimmed} '
-                f'ON CONFLICT DO NOTHING'
-            )
-            self.db.conn.execute(query)
-            self.store.conn.execute('DELETE FROM logs WHERE time <= ?', [now])
+        watermark = 0
 
+        while True:
+            records, watermark = self.store.readLogs(self.forwardBatchSize, watermark)
+
+            if len(records) == 0:
+                break
+
+            self.db.conn.executeValues(
+                'INSERT INTO logs (time, message, level, daemon_id) VALUES %s ON CONFLICT DO NOTHING',
+                records
+            )
+            self.store.ackLogs(watermark)
@@ -0,0 +1,190 @@
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from twisted.web.resource import Resource
+from im_core.classes.Singleton import Singleton
+
+
+class _Value:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Metric:
+    def __init__(self, name, description, kind, labels=(), buckets=None, fn=None):
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self.labelNames = labels
+        self.buckets = buckets
+        self.fn = fn
+        self._children = OrderedDict()
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        # Children are created once per label set, later lookups are a single dict hit
+        child = self._children.get(values)
+
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = _Histogram(self.buckets) if self.kind == 'histogram' else _Value()
+                    self._children[values] = child
+
+        return child
+
+    def collect(self):
+        return list(self._children.items())
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _labelText(self, values, extra=None):
+        pairs = [name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for name, value in zip(self.labelNames, values)]
+
+        if extra is not None:
+            pairs.append(extra)
+
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def _samples(self):
+        # Callback gauges are read at scrape time so nothing is paid for them on the hot path
+        if self.fn is not None:
+            try:
+                samples = self.fn()
+            except Exception:
+                samples = []
+            samples = samples if isinstance(samples, list) else [((), samples)]
+        else:
+            samples = []
+
+        # Children set from worker snapshots are rendered next to whatever the callback returns
+        return samples + list(self._children.items())
+
+    def snapshot(self):
+        samples = []
+
+        for values, child in self._samples():
+            if self.kind == 'histogram':
+                samples.append((values, (list(child.counts), child.sum, child.count)))
+            else:
+                samples.append((values, float(child.value if isinstance(child, _Value) else child)))
+
+        return samples
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.description, '# TYPE ' + self.name + ' ' + self.kind]
+
+        for values, child in self._samples():
+            if self.kind == 'histogram':
+                cumulative = 0
+
+                for bound, count in zip(self.buckets, child.counts):
+                    cumulative += count
+                    lines.append(self.name + '_bucket' + self._labelText(values, 'le="' + str(bound) + '"') + ' ' + str(cumulative))
+
+                lines.append(self.name + '_bucket' + self._labelText(values, 'le="+Inf"') + ' ' + str(child.count))
+                lines.append(self.name + '_sum' + self._labelText(values) + ' ' + str(child.sum))
+                lines.append(self.name + '_count' + self._labelText(values) + ' ' + str(child.count))
+            else:
+                value = child.value if isinstance(child, _Value) else child
+                lines.append(self.name + self._labelText(values) + ' ' + str(float(value)))
+
+        return '\n'.join(lines)
+
+
+class Metrics(metaclass=Singleton):
+    secondsBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    rowsBuckets = (10, 100, 1000, 5000, 10000, 50000, 100000, 500000)
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _register(self, name, description, kind, labels=(), buckets=None, fn=None):
+        with self._lock:
+            metric = self._metrics.get(name)
+
+            if metric is None:
+                metric = Metric(name, description, kind, labels, buckets, fn)
+                self._metrics[name] = metric
+            elif fn is not None:
+                metric.fn = fn
+
+            return metric
+
+    def counter(self, name, description, labels=(), fn=None):
+        return self._register(name, description, 'counter', labels, fn=fn)
+
+    def gauge(self, name, description, labels=(), fn=None):
+        return self._register(name, description, 'gauge', labels, fn=fn)
+
+    def histogram(self, name, description, labels=(), buckets=secondsBuckets):
+        return self._register(name, description, 'histogram', labels, tuple(buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def snapshot(self, label):
+        # Metrics carrying the label as plain data, for a worker process to hand to the daemon
+        return [
+            (metric.name, metric.description, metric.kind, metric.labelNames, metric.buckets, metric.snapshot())
+            for metric in list(self._metrics.values()) if label in metric.labelNames
+        ]
+
+    def merge(self, snapshot):
+        # Snapshots are cumulative, each one replaces the values the same worker sent before
+        for name, description, kind, labels, buckets, samples in snapshot:
+            metric = self._register(name, description, kind, labels, buckets)
+
+            for values, sample in samples:
+                child = metric.labels(*values)
+
+                if kind == 'histogram':
+                    with child._lock:
+                        child.counts, child.sum, child.count = list(sample[0]), sample[1], sample[2]
+                else:
+                    child.set(sample)
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in list(self._metrics.values())) + '\n'
+
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+        return Metrics().render().encode('utf-8')
@@ -0,0 +1,87 @@
+import math
+from array import array
+from im_core.helpers import isValidValue
+
+
+class ReadBatch:
+    __slots__ = ('names', 'tags', 'buffer', '_paths', '_direct', '_ids', '_bulk', '_bulkIds', '_filtered')
+
+    def __init__(self, reads):
+        # Settings, results come back in request order so they are matched to tags by position
+        self.names = [request for request, targets in reads]
+        self.tags = [tag for request, targets in reads for tag, path in targets]
+        self.buffer = self.tags[0].buffer if self.tags else None
+
+        # Coalesced reads serve several tags, each keeps the path to its value in the read result
+        self._paths = [[path for tag, path in targets] for request, targets in reads]
+        self._direct = all(len(paths) == 1 and paths[0] == () for paths in self._paths)
+
+        # Tags archiving every sample skip Tag.record, their values go into the buffer as one column
+        self._ids = array('q', (tag.id for tag in self.tags))
+        self._bulk = [i for i, tag in enumerate(self.tags) if tag.mode == 'all']
+        self._bulkIds = array('q', (self._ids[i] for i in self._bulk))
+        self._filtered = [i for i, tag in enumerate(self.tags) if tag.mode != 'all']
+
+    def __len__(self):
+        return len(self.tags)
+
+    @staticmethod
+    def _column(values):
+        try:
+            column = array('d', values)
+        except (TypeError, OverflowError):
+            return None
+
+        # The sum is only finite when every value is, one call checks the whole batch
+        return column if math.isfinite(sum(column)) else None
+
+    def _unpack(self, results):
+        values = []
+
+        for result, paths in zip(results, self._paths):
+            for path in paths:
+                value = result.value
+
+                # A failed read has no value to walk into, its tags are counted as invalid
+                try:
+                    for key in path:
+                        value = value[key]
+                except (TypeError, KeyError, IndexError):
+                    value = None
+
+                values.append(value)
+
+        return values
+
+    def record(self, stamp, results):
+        # A failed read returns nothing for the whole batch
+        if len(results) != len(self.names):
+            return 0
+
+        values = [result.value for result in results] if self._direct else self._unpack(results)
+        column = self._column(values)
+        invalid = 0
+
+        if column is None:
+            # Only batches holding a missing or non finite value pay for the per value check
+            valid = [isValidValue(value) for value in values]
+            bulk = [i for i in self._bulk if valid[i]]
+            filtered = [i for i in self._filtered if valid[i]]
+            ids = array('q', (self._ids[i] for i in bulk))
+            column = array('d', (values[i] for i in bulk))
+            invalid = len(values) - len(bulk) - len(filtered)
+        elif self._filtered:
+            filtered = self._filtered
+            ids = self._bulkIds
+            column = array('d', (column[i] for i in self._bulk))
+        else:
+            filtered = ()
+            ids = self._bulkIds
+
+        if len(ids) > 0:
+            self.buffer.extend(ids, stamp, column)
+
+        for i in filtered:
+            self.tags[i].record(stamp, values[i])
+
+        return invalid
@@ -0,0 +1,42 @@
+class Rollup:
+    def __init__(self, windows, grace=0.0):
+        # Settings, windows and grace are in seconds while stamps are epoch milliseconds
+        self.windows = windows
+        self.grace = grace
+        self._windowsMs = [int(window * 1000) for window in windows]
+
+        # Open buckets keyed by (tag_id, window, bucket start) as [min, max, sum, count, first, last]
+        self._buckets = {}
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def add(self, tags, stamps, values):
+        buckets = self._buckets
+
+        for window, windowMs in zip(self.windows, self._windowsMs):
+            for tid, stamp, value in zip(tags, stamps, values):
+                key = (tid, window, stamp - stamp % windowMs)
+                bucket = buckets.get(key)
+
+                if bucket is None:
+                    buckets[key] = [value, value, value, 1, value, value]
+                else:
+                    if value < bucket[0]:
+                        bucket[0] = value
+                    elif value > bucket[1]:
+                        bucket[1] = value
+                    bucket[2] += value
+                    bucket[3] += 1
+                    bucket[5] = value
+
+    def close(self, now):
+        # A bucket is closed once its window plus the grace period has passed
+        closed = []
+        limit = now - self.grace * 1000
+
+        for key in [key for key in self._buckets.keys() if key[2] + key[1] * 1000 <= limit]:
+            bucket = self._buckets.pop(key)
+            closed.append((key[0], key[1], key[2], bucket[0], bucket[1], bucket[2] / bucket[3], bucket[3], bucket[4], bucket[5]))
+
+        return closed
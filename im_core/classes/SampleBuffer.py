@@ -0,0 +1,62 @@
+import threading
+from array import array
+
+
+class SampleBuffer:
+    def __init__(self, capacity=4096):
+        self._capacity = capacity
+        self._lock = threading.Lock()
+        self._allocate()
+
+    def __len__(self):
+        return self._size
+
+    def _allocate(self):
+        # Columns are preallocated and filled in place, samples never become per-sample objects
+        self._tags = array('q', bytes(8 * self._capacity))
+        self._stamps = array('q', bytes(8 * self._capacity))
+        self._values = array('d', bytes(8 * self._capacity))
+        self._size = 0
+
+    def _grow(self):
+        self._tags.extend(array('q', bytes(8 * self._capacity)))
+        self._stamps.extend(array('q', bytes(8 * self._capacity)))
+        self._values.extend(array('d', bytes(8 * self._capacity)))
+        self._capacity *= 2
+
+    def append(self, tid, stamp, value):
+        with self._lock:
+            if self._size == self._capacity:
+                self._grow()
+
+            i = self._size
+            self._tags[i] = tid
+            self._stamps[i] = stamp
+            self._values[i] = value
+            self._size = i + 1
+
+    def extend(self, tids, stamp, values):
+        # One stamp for a whole read batch, the columns are copied in with slice assignment
+        count = len(tids)
+
+        with self._lock:
+            while self._size + count > self._capacity:
+                self._grow()
+
+            start, end = self._size, self._size + count
+            self._tags[start:end] = tids
+            self._stamps[start:end] = array('q', (stamp,)) * count
+            self._values[start:end] = values
+            self._size = end
+
+    def drain(self):
+        # Swap in fresh columns sized to the peak so far and hand back the filled ones
+        with self._lock:
+            tags, stamps, values, size = self._tags, self._stamps, self._values, self._size
+            self._allocate()
+
+        del tags[size:]
+        del stamps[size:]
+        del values[size:]
+
+        return tags, stamps, values
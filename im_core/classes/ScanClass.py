@@ -0,0 +1,71 @@
+import math
+import time
+from collections import OrderedDict
+from im_core.helpers import chunkArray, planReads
+import im_core.classes
+
+
+class ScanClass:
+    def __init__(self, rate):
+        # Settings
+        self.rate = rate
+
+        # Read plan, swapped as one tuple so a running scan never sees half of a new plan
+        self.readPlan = (OrderedDict(), [])
+
+        # Schedule, deadlines sit on a fixed grid so the rate never drifts
+        self._start = time.monotonic()
+        self._slot = -1
+        self.busy = False
+
+        # Monitoring
+        self.cycles = 0
+        self.missed = 0
+        self.tagsRead = 0
+        self.lastDuration = 0.0
+        self.maxDuration = 0.0
+
+    @property
+    def size(self):
+        return len(self.readPlan[0])
+
+    @property
+    def load(self):
+        return self.lastDuration / self.rate
+
+    def plan(self, tags, tagsPerRequest, coalesce=True, maxGap=8, sizeOf=None, packetLimit=None):
+        # Array elements and structure members are grouped into range and whole structure reads where it pays off
+        names = list(tags.keys())
+        objects = list(tags.values())
+
+        if coalesce:
+            reads = planReads(names, maxGap, sizeOf=sizeOf, packetLimit=packetLimit)
+        else:
+            reads = [(name, [(position, ())]) for position, name in enumerate(names)]
+
+        reads = [(request, [(objects[position], path) for position, path in targets]) for request, targets in reads]
+        self.readPlan = (tags, [im_core.classes.ReadBatch(chunk) for chunk in chunkArray(reads, tagsPerRequest)])
+
+    def due(self, now):
+        slot = math.floor((now - self._start) / self.rate)
+
+        if slot <= self._slot:
+            return False
+
+        # Deadlines that passed without a scan are skipped and counted, never caught up on
+        if self._slot >= 0:
+            self.missed += slot - self._slot - 1
+        self._slot = slot
+
+        if self.busy:
+            self.missed += 1
+            return False
+
+        return True
+
+    def finish(self, duration, tagsRead):
+        self.cycles += 1
+        self.tagsRead += tagsRead
+        self.lastDuration = duration
+        self.maxDuration = max(self.maxDuration, duration)
+        self.busy = False
@@ -1,10 +1,13 @@
+import os
 import time
+import threading
 from collections import OrderedDict
 from datetime import datetime
-from psycopg2 import OperationalError
+from psycopg2 import OperationalError, ProgrammingError
 import im_core.classes.Database
 import im_core.classes.Store
 import im_core.drivers
+from im_core.helpers import epochMillis
 
 
 class Source:
@@ -21,44 +24,144 @@ class Source:
 
         self.db = im_core.classes.Database()
         self.store = im_core.classes.Store()
+        self.buffer = im_core.classes.SampleBuffer()
 
-        # Setup
-        self._configure()
-        self._upsertDiscoveredTags()
-        self._getMonitoringTags()
-        self.logger.write('Source with id ' + str(self.id) + ' is initialized...', 'success')
+        # Monitored tag sync, incremental on the tags updated_at watermark with a periodic full sync
+        self._fullSyncEvery = int(os.environ.get('SYNC_FULL_EVERY', 60))
+        self._syncCount = 0
+        self._tagsWatermark = None
 
-    def _configure(self):
-        try:
-            source = self.db.conn.execute(
-                "SELECT active, address, driver FROM sources WHERE id = %s",
-                [self.id]
-            )[0]
-            self.logger.write('Configuring driver for source with id ' + str(self.id) + '...', 'info')
+        # Edge rollups, tags with raw forwarding off are only kept as aggregates
+        windows = [int(window) for window in os.environ.get('ROLLUP_WINDOWS', '').split(',') if window.strip()]
+        self.rollup = im_core.classes.Rollup(windows, float(os.environ.get('ROLLUP_GRACE', 5))) if windows else None
+        self._rawDisabled = frozenset()
 
-            if source:
-                self.active = source['active']
-                self._address = source['address']
-                self._driver = source['driver']
+        # Last known cloud settings, with both snapshots the source starts without waiting on the cloud
+        self._syncLock = threading.Lock()
+        snapshot = self.store.loadConfig('source:' + str(self.id))
+        tagsSnapshot = self.store.loadConfig('tags:' + str(self.id))
+        self.fromSnapshot = snapshot is not None and tagsSnapshot is not None
+
+        # Setup, each phase is timed for the startup report
+        self.timings = OrderedDict()
+        start = time.time()
+        self._configure(snapshot if self.fromSnapshot else None)
+        self.timings['configure'] = time.time() - start
+
+        if self.fromSnapshot:
+            start = time.time()
+            self._restoreTags(tagsSnapshot)
+            self.timings['monitoring'] = time.time() - start
+            threading.Thread(target=self._reconcile, name='reconcile-' + str(self.id), daemon=True).start()
+        else:
+            start = time.time()
+            self._upsertDiscoveredTags()
+            self.timings['upsert'] = time.time() - start
+
+            start = time.time()
+            self._getMonitoringTags()
+            self.timings['monitoring'] = time.time() - start
+
+        if self.driver_instance is not None:
+            self.timings.update(self.driver_instance.timings)
 
-                if self._driver == 'Logix':
-                    self.driver_instance = im_core.drivers.Logix(self.id, self._address)
+        self.logger.write(
+            'Source with id ' + str(self.id) + ' is initialized (' + ', '.join(phase + ' ' + str(round(duration, 2)) + 's' for phase, duration in self.timings.items()) + ')...',
+            'success'
+        )
+
+    @staticmethod
+    def registerMetrics(sources):
+        # Per source gauges read at scrape time, sources returns the sources running in this process
+        metrics = im_core.classes.Metrics()
+        metrics.gauge('imcore_plc_connections', 'PLC connections per source', ('source', 'state'), fn=lambda: [
+            ((str(source.id), state), value) for source in sources() if source.driver_instance is not None
+            for state, value in (('open', source.driver_instance.commPool.size), ('in_use', source.driver_instance.commPool.inUse), ('target', source.driver_instance.commPool.target))
+        ])
+        metrics.gauge('imcore_plc_rtt_seconds', 'Smoothed PLC read round trip time per source', ('source',), fn=lambda: [
+            ((str(source.id),), source.driver_instance.commPool.rtt) for source in sources() if source.driver_instance is not None
+        ])
+        metrics.gauge('imcore_scan_missed_cycles', 'Missed cycles per scan class', ('source', 'scan_class'), fn=lambda: [
+            ((str(source.id), str(scanClass.rate)), scanClass.missed) for source in sources() if source.driver_instance is not None
+            for scanClass in list(source.driver_instance.scanClasses.values())
+        ])
+
+    def _fetchSource(self):
+        source = self.db.conn.execute(
+            "SELECT active, address, driver FROM sources WHERE id = %s",
+            [self.id]
+        )
+
+        if not source:
+            return None
+
+        source = {'active': source[0]['active'], 'address': source[0]['address'], 'driver': source[0]['driver']}
+        self.store.saveConfig('source:' + str(self.id), source)
+        return source
+
+    def _configure(self, source=None):
+        while source is None:
+            try:
+                source = self._fetchSource()
+                break
+            except OperationalError:
+                self.logger.write(
+                    'Communication error with the cloud while configuring source with id ' + str(self.id) + '... trying again in 5 seconds',
+                    'danger'
+                )
+                time.sleep(5)
+
+        self.logger.write('Configuring driver for source with id ' + str(self.id) + '...', 'info')
+
+        if source:
+            self.active = source['active']
+            self._address = source['address']
+            self._driver = source['driver']
+
+            if self._driver == 'Logix':
+                self.driver_instance = im_core.drivers.Logix(self.id, self._address)
+
+                # Started from the snapshot, the heartbeat waits for the reconcile
+                if not self.fromSnapshot:
                     self._heartBeat()
-                else:
-                    self.logger.write('Invalid source driver specified for source with id ' + str(self.id) + '...', 'danger')
-        except OperationalError:
-            self.logger.write(
-                'Communication error with the cloud while configuring source with id ' + str(self.id) + '...',
-                'danger'
-            )
-            time.sleep(5)
-            self._configure()
+            else:
+                self.logger.write('Invalid source driver specified for source with id ' + str(self.id) + '...', 'danger')
+
+    def _reconcile(self):
+        # The snapshot is checked against the cloud once it is reachable, then discovered and monitored tags are synced
+        while True:
+            try:
+                source = self._fetchSource()
+
+                if source is None:
+                    self.logger.write('Source with id ' + str(self.id) + ' no longer exists in the cloud...', 'danger')
+                    return
+
+                if source['address'] != self._address or source['driver'] != self._driver:
+                    self.logger.write('Address or driver of source with id ' + str(self.id) + ' changed in the cloud, it applies on the next restart...', 'warning')
+
+                self.active = source['active']
+                self._heartBeat()
+                self._upsertDiscoveredTags()
+
+                with self._syncLock:
+                    self._syncTags(True)
+                break
+            except OperationalError:
+                time.sleep(5)
+            except ProgrammingError as e:
+                # Retrying cannot help, the source keeps running on its snapshot until the cloud schema is updated
+                self.logger.write('Cloud schema is out of date for source with id ' + str(self.id) + ', apply the migrations in sql/... ' + str(e).strip(), 'danger')
+                return
+
+        self.logger.write('Source with id ' + str(self.id) + ' reconciled with the cloud...', 'success')
 
     def _heartBeat(self):
         try:
             now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-            if self.db.conn.execute(
+            if self.db.conn.executePrepared(
+                'source_heartbeat',
                 "UPDATE sources SET last_communication = %s WHERE id = %s",
                 [now, self.id]
             ):
@@ -71,51 +174,151 @@ class Source:
 
     def _upsertDiscoveredTags(self):
         try:
-            self.logger.write('Syncing tags for source with id ' + str(self.id) + ' with cloud...', 'info')
+            if len(self.driver_instance.changedTags) == 0:
+                self.logger.write('Tags unchanged since the last discovery for source with id ' + str(self.id) + '...', 'info')
+                self.driver_instance.saveDiscoveryCache()
+                return
+
+            self.logger.write('Syncing ' + str(len(self.driver_instance.changedTags)) + ' changed tags for source with id ' + str(self.id) + ' with cloud...', 'info')
+            start = time.time()
             now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            tags = []
-
-            for key, val in self.driver_instance.discoveredTags.items():
-                tags.append((key, val, self.id, now))
-
-            listTrimmed = str(tags)[1:-1]
-            query = (
-                f'INSERT INTO tags '
-                f'(name, data_type_name, source_id, created_at) '
-                f'VALUES {listTrimmed} '
-                f'ON CONFLICT (name, source_id) DO UPDATE SET '
-                f'data_type_name = EXCLUDED.data_type_name, '
-                f'updated_at = EXCLUDED.created_at;'
+
+            # Rows whose data type did not change are left untouched so their updated_at does not move
+            merged = self.db.conn.copyMerge(
+                'tags_staging',
+                [('name', 'TEXT'), ('data_type_name', 'TEXT')],
+                list(self.driver_instance.changedTags.items()),
+                'INSERT INTO tags (name, data_type_name, source_id, created_at) '
+                'SELECT name, data_type_name, %s, %s FROM tags_staging '
+                'ON CONFLICT (name, source_id) DO UPDATE SET '
+                'data_type_name = EXCLUDED.data_type_name, '
+                'updated_at = EXCLUDED.created_at '
+                'WHERE tags.data_type_name IS DISTINCT FROM EXCLUDED.data_type_name',
+                [self.id, now]
             )
 
-            self.db.conn.execute(query)
-            self.logger.write('Tags in cloud synced for source with id ' + str(self.id) + '...', 'success')
+            elapsed = time.time() - start
+            self.driver_instance.saveDiscoveryCache()
+            self.logger.write(
+                'Tags in cloud synced for source with id ' + str(self.id) + ' (' + str(merged) + ' written, ' + str(round(len(self.driver_instance.changedTags) / elapsed if elapsed > 0 else 0)) + ' tags/s)...',
+                'success'
+            )
         except OperationalError:
             self.logger.write(
                 'Communication error with the cloud while syncing tags for source with id ' + str(self.id) + '...',
                 'warning'
             )
 
-    def _getMonitoringTags(self):
-        try:
-            mTags = self.db.conn.execute(
-                "SELECT id, name FROM tags WHERE monitor = true"
-            )
+    @staticmethod
+    def _tagConfig(tag):
+        return {
+            'mode': tag['record_mode'] or 'all',
+            'deadband': tag['deadband'] or 0.0,
+            'deadbandType': tag['deadband_type'] or 'absolute',
+            'maxInterval': tag['max_interval'] or 0.0,
+            'scanRate': tag['scan_rate'],
+            'forwardRaw': tag['forward_raw'] is not False
+        }
 
-            for tag in mTags:
-                self.driver_instance.monitoringTags[tag['name']] = im_core.classes.Tag(tag['id'], tag['name'])
-        except OperationalError:
-            self.logger.write(
-                'Communication error with the cloud while getting monitored tag list for source with id ' + str(self.id) + '... trying again in 5 seconds',
-                'danger'
+    def _syncTags(self, full):
+        columns = "id, name, monitor, record_mode, deadband, deadband_type, max_interval, scan_rate, forward_raw, COALESCE(updated_at, created_at) AS changed_at"
+
+        if full or self._tagsWatermark is None:
+            full = True
+            self._syncCount = 0
+            rows = self.db.conn.execute(
+                "SELECT " + columns + " FROM tags WHERE source_id = %s AND monitor = true",
+                [self.id]
             )
-            time.sleep(5)
-            self._getMonitoringTags()
+        else:
+            # Unmonitored rows are included so tags that stopped being monitored are removed
+            rows = self.db.conn.execute(
+                "SELECT " + columns + " FROM tags WHERE source_id = %s AND COALESCE(updated_at, created_at) >= %s",
+                [self.id, self._tagsWatermark]
+            )
+
+        # Changes are made on a copy that is swapped in at once, the poll stage may be reading the current one
+        monitoringTags = OrderedDict(self.driver_instance.monitoringTags)
+        watermark = self._tagsWatermark
+        seen = set()
+        changed = False
+
+        for row in rows:
+            name = row['name']
+            tag = monitoringTags.get(name)
+
+            if row['changed_at'] is not None and (watermark is None or row['changed_at'] > watermark):
+                watermark = row['changed_at']
+
+            if row['monitor']:
+                seen.add(name)
+                config = self._tagConfig(row)
+
+                if tag is None or tag.id != row['id']:
+                    monitoringTags[name] = im_core.classes.Tag(row['id'], name, self.buffer, **config)
+                    changed = True
+                else:
+                    scanRate, mode = tag.scanRate, tag.mode
+                    tag.configure(**config)
+                    changed = changed or tag.scanRate != scanRate or tag.mode != mode
+            elif tag is not None:
+                del monitoringTags[name]
+                changed = True
+
+        # A full sync also catches tags that were deleted in the cloud
+        if full:
+            for name in [name for name in monitoringTags.keys() if name not in seen]:
+                del monitoringTags[name]
+                changed = True
+
+        self._tagsWatermark = watermark
+        self._rawDisabled = frozenset(tag.id for tag in monitoringTags.values() if not tag.forwardRaw)
+
+        # The driver only rebuilds its read plan when the monitored set actually changed
+        if changed:
+            self.driver_instance.setMonitoringTags(monitoringTags)
+
+        if changed or full:
+            self.store.saveConfig('tags:' + str(self.id), [
+                {'id': tag.id, 'name': tag.name, 'config': {
+                    'mode': tag.mode, 'deadband': tag.deadband, 'deadbandType': tag.deadbandType,
+                    'maxInterval': tag.maxInterval, 'scanRate': tag.scanRate, 'forwardRaw': tag.forwardRaw
+                }} for tag in monitoringTags.values()
+            ])
+
+        return changed
+
+    def _restoreTags(self, snapshot):
+        if self.driver_instance is None:
+            return
+
+        # The watermark stays empty so the reconcile does a full sync
+        monitoringTags = OrderedDict((tag['name'], im_core.classes.Tag(tag['id'], tag['name'], self.buffer, **tag['config'])) for tag in snapshot)
+        self._rawDisabled = frozenset(tag.id for tag in monitoringTags.values() if not tag.forwardRaw)
+        self.driver_instance.setMonitoringTags(monitoringTags)
+        self.logger.write(str(len(monitoringTags)) + ' monitored tags restored from the snapshot for source with id ' + str(self.id) + '...', 'info')
+
+    def _getMonitoringTags(self):
+        while True:
+            try:
+                self._syncTags(True)
+                return
+            except OperationalError:
+                self.logger.write(
+                    'Communication error with the cloud while getting monitored tag list for source with id ' + str(self.id) + '... trying again in 5 seconds',
+                    'danger'
+                )
+                time.sleep(5)
+
+    def sync(self, poll=True):
+        # Between fallback polls the cloud pushes its changes, only the heartbeat is recorded
+        if not poll:
+            self._heartBeat()
+            return
 
-    def sync(self):
         try:
-            source = self.db.conn.execute(
-                "SELECT active FROM sources WHERE id = %s", [self.id]
+            source = self.db.conn.executePrepared(
+                'source_active', "SELECT active FROM sources WHERE id = %s", [self.id]
             )[0]
 
             if source:
@@ -123,24 +326,22 @@ class Source:
                 self._heartBeat()
 
             if self.active:
-                mtags = self.db.conn.execute("SELECT id, name FROM tags WHERE monitor = true")
-                mTagsName = [name for sublist in self.db.conn.execute("SELECT name FROM tags WHERE monitor = true") for
-                             name
-                             in
-                             sublist]
-                tagsToRemove = [name for name in self.driver_instance.monitoringTags.keys() if name not in mTagsName]
-                tagsToAdd = [name for name in mTagsName if name not in self.driver_instance.monitoringTags.keys()]
-
-                for tag in tagsToRemove:
-                    del self.driver_instance.monitoringTags[tag]
-
-                for tag in mtags:
-                    if tag['name'] in tagsToAdd:
-                        self.driver_instance.monitoringTags[tag['name']] = im_core.classes.Tag(tag['id'], tag['name'])
-
-                self.logger.write(str(len(self.driver_instance.monitoringTags)) + ' tags being monitored on source with id ' + str(self.id) + '...', 'info')
-            else:
-                self.driver_instance.monitoringTags = OrderedDict()
+                self._syncCount += 1
+
+                with self._syncLock:
+                    changed = self._syncTags(self._syncCount >= self._fullSyncEvery)
+
+                if changed:
+                    self.logger.write(str(len(self.driver_instance.monitoringTags)) + ' tags being monitored on source with id ' + str(self.id) + '...', 'info')
+
+                for scanClass in self.driver_instance.scanClasses.values():
+                    self.logger.write(
+                        'Scan class ' + str(scanClass.rate) + 's on source with id ' + str(self.id) + ': ' + str(scanClass.size) + ' tags, ' + str(round(scanClass.load * 100)) + '% load, ' + str(scanClass.missed) + ' missed cycles...',
+                        'info'
+                    )
+            elif len(self.driver_instance.monitoringTags) > 0:
+                self.driver_instance.setMonitoringTags(OrderedDict())
+                self._tagsWatermark = None
 
             self.logger.write('Settings for source with id ' + str(self.id) + ' synced with cloud...', 'success')
 
@@ -150,6 +351,52 @@ class Source:
                 'danger'
             )
 
+    def refreshTags(self):
+        if not self.active or self.driver_instance is None:
+            return
+
+        # A notification can stand for a deleted tag or an edit that left updated_at alone, only a full sync sees those
+        with self._syncLock:
+            changed = self._syncTags(True)
+
+        if changed:
+            self.logger.write(str(len(self.driver_instance.monitoringTags)) + ' tags being monitored on source with id ' + str(self.id) + '...', 'info')
+
+    def reload(self):
+        source = self._fetchSource()
+
+        if source is None:
+            self.logger.write('Source with id ' + str(self.id) + ' no longer exists in the cloud...', 'danger')
+            return
+
+        if source['address'] != self._address or source['driver'] != self._driver:
+            self.logger.write('Address or driver of source with id ' + str(self.id) + ' changed in the cloud, it applies on the next restart...', 'warning')
+
+        self.active = source['active']
+
+        # A paused source drops its tags, the empty watermark makes the next sync after resuming a full one
+        if self.active:
+            self.refreshTags()
+        elif self.driver_instance is not None and len(self.driver_instance.monitoringTags) > 0:
+            with self._syncLock:
+                self.driver_instance.setMonitoringTags(OrderedDict())
+                self._tagsWatermark = None
+
+    def applyNotification(self, table):
+        # Only what the notification names is read again, the source row or the changed tags
+        try:
+            if table == 'sources':
+                self.reload()
+            elif table == 'tags':
+                self.refreshTags()
+
+            self.logger.write('Applied a configuration change to source with id ' + str(self.id) + '...', 'success')
+        except OperationalError:
+            self.logger.write(
+                'Communication error with the cloud while applying a configuration change to source with id ' + str(self.id) + '...',
+                'danger'
+            )
+
     def discoverTags(self):
         self.driver_instance.discoverTags()
         self._upsertDiscoveredTags()
@@ -158,21 +405,24 @@ class Source:
         self.driver_instance.poll()
 
     def storeData(self):
-        start = time.time()
-        allRecords = []
-
-        for tag in self.driver_instance.monitoringTags.values():
-            if len(tag.records) > 0:
-                allRecords.append(str(tag.records)[1:-1])
-                tag.records = []
-
-        if len(allRecords) > 0:
-            listTrimmed = str(allRecords)[1:-1].replace('"', '')
-            query = (
-                f'INSERT OR IGNORE INTO facts '
-                f'(tag_id, time, val) '
-                f'VALUES {listTrimmed}'
-            )
+        tags, stamps, values = self.buffer.drain()
+        rawDisabled = self._rawDisabled
+        count = len(tags)
+
+        if self.rollup is not None and count > 0:
+            self.rollup.add(tags, stamps, values)
+
+        if count > 0 and len(rawDisabled) > 0:
+            keep = [i for i, tid in enumerate(tags) if tid not in rawDisabled]
+            count = len(keep)
+            self.store.writeFacts(((tags[i], stamps[i], values[i]) for i in keep), count)
+        elif count > 0:
+            self.store.writeFacts(zip(tags, stamps, values), count)
+
+        if self.rollup is not None:
+            closed = self.rollup.close(epochMillis())
+
+            if len(closed) > 0:
+                self.store.writeRollups(closed)
 
-            self.store.conn.execute(query)
-            self.logger.write('Wrote data to store for source with id ' + str(self.id) + ' (' + str(round(time.time() - start, 2)) + 's)...', 'success')
+        return count
@@ -0,0 +1,288 @@
+import os
+import json
+import time
+import sqlite3
+import queue
+import threading
+import multiprocessing
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from im_core.classes.Singleton import Singleton
+import im_core.classes
+
+
+class WorkerStore:
+    def __init__(self, results):
+        # Stands in for the store inside a worker process, everything written is handed to the supervising daemon
+        self._results = results
+
+    def writeFacts(self, rows, count):
+        if count == 0:
+            return 0
+
+        # Columns pickle far smaller than row tuples
+        tags, stamps, values = zip(*rows)
+        self._results.put(('facts', array('q', tags), array('q', stamps), array('d', values)))
+        return 0
+
+    def commitFacts(self, force=False):
+        return 0
+
+    def writeRollups(self, rows):
+        self._results.put(('rollups', rows))
+
+    def writeLogs(self, rows):
+        self._results.put(('logs', rows))
+
+    def saveConfig(self, key, data):
+        self._results.put(('config', key, data))
+
+    def loadConfig(self, key):
+        # Snapshots are read straight from the daemon's store, read only
+        path = (os.environ.get('DATA_PATH') or str(Path(__file__).parents[1]) + '/data') + '/store.db'
+
+        try:
+            conn = sqlite3.connect('file:' + path + '?mode=ro', uri=True)
+        except sqlite3.Error:
+            return None
+
+        try:
+            row = conn.execute("SELECT data FROM config WHERE key = ?", [key]).fetchone()
+        except sqlite3.Error:
+            return None
+        finally:
+            conn.close()
+
+        return json.loads(row[0]) if row is not None else None
+
+
+class SourceShard:
+    def __init__(self, sids, daemonId, results, control, active):
+        # Settings
+        self.sids = sids
+        self.active = active
+        self._control = control
+        self.scan_tick = float(os.environ.get('SCAN_TICK', os.environ.get('POLL_TIME')))
+        self.store_time = float(os.environ.get('STORE_TIME'))
+        self.sync_time = float(os.environ.get('SYNC_TIME'))
+        self.sync_fallback_time = float(os.environ.get('SYNC_FALLBACK_TIME', 600))
+
+        # Set by the daemon while its configuration listener is up, changes then arrive as reload commands
+        self._listening = False
+        self._lastPoll = 0.0
+
+        # The store is replaced before anything in this process asks for it
+        Singleton._instances[im_core.classes.Store] = WorkerStore(results)
+        self.logger = im_core.classes.Logger(daemonId)
+        self.sources = OrderedDict()
+
+        # Per source metrics are sent to the daemon with every store cycle, it exports them in place of the worker
+        self._results = results
+        im_core.classes.Source.registerMetrics(lambda: list(self.sources.values()))
+
+        with ThreadPoolExecutor(int(os.environ.get('STARTUP_WORKERS', 4)), thread_name_prefix='startup') as executor:
+            for sid, future in [(sid, executor.submit(im_core.classes.Source, sid)) for sid in sids]:
+                try:
+                    self.sources[sid] = future.result()
+                except Exception as e:
+                    self.logger.write('Failed to initialize source with id ' + str(sid) + '... ' + str(e), 'danger')
+
+        # Reloads run off the poll stage, they wait on the cloud
+        self._reloads = ThreadPoolExecutor(1, thread_name_prefix='reload')
+
+    def _receive(self):
+        from twisted.internet import reactor
+
+        # Nothing is left to forward the samples once the daemon is gone
+        parent = multiprocessing.parent_process()
+
+        if parent is not None and not parent.is_alive():
+            reactor.callFromThread(reactor.stop)
+            return
+
+        while True:
+            try:
+                command, value = self._control.get_nowait()
+            except queue.Empty:
+                break
+
+            if command == 'active':
+                self.active = value
+            elif command == 'listening':
+                # Changes made while nobody was listening are picked up by a poll on the next sync
+                self._listening = value
+                self._lastPoll = 0.0
+            elif command == 'reload' and value[0] in self.sources:
+                self._reloads.submit(self.sources[value[0]].applyNotification, value[1])
+
+    def poll(self):
+        self._receive()
+
+        if self.active:
+            for source in list(self.sources.values()):
+                if source.active:
+                    source.poll()
+
+    def store(self):
+        for source in list(self.sources.values()):
+            source.storeData()
+
+        self._results.put(('metrics', im_core.classes.Metrics().snapshot('source')))
+
+    def _pollDue(self):
+        now = time.monotonic()
+
+        if self._listening and now - self._lastPoll < self.sync_fallback_time:
+            return False
+
+        self._lastPoll = now
+        return True
+
+    def sync(self):
+        if self.active:
+            poll = self._pollDue()
+
+            for source in list(self.sources.values()):
+                source.sync(poll)
+
+    def run(self):
+        from twisted.internet import reactor
+
+        stages = [
+            im_core.classes.Stage('poll', self.poll, self.scan_tick),
+            im_core.classes.Stage('store', self.store, self.store_time, False),
+            im_core.classes.Stage('sync', self.sync, self.sync_time, False)
+        ]
+
+        for stage in stages:
+            stage.start()
+
+        reactor.run(installSignalHandlers=False)
+
+
+def runSourceShard(sids, daemonId, results, control, active):
+    SourceShard(sids, daemonId, results, control, active).run()
+
+
+class SourceWorker:
+    # Workers start from a fresh interpreter, nothing of the daemon's threads, pools or store connection is inherited
+    context = multiprocessing.get_context('spawn')
+
+    def __init__(self, index, sids, daemonId, restartMax=60.0):
+        # Settings
+        self.index = index
+        self.sids = sids
+        self.daemonId = daemonId
+        self.restartMax = restartMax
+        self.logger = im_core.classes.Logger()
+
+        # Process, messages a dead process left in its queue wait in _orphans until they are received
+        self.process = None
+        self._results = None
+        self._control = None
+        self._orphans = []
+        self._active = True
+        self._listening = False
+
+        # Restarts back off exponentially and reset once a worker has stayed up for restartMax
+        self.restarts = 0
+        self._backoff = 1.0
+        self._started = 0.0
+        self._restartAt = None
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def start(self):
+        # Every process gets fresh queues, one killed in the middle of a put can leave its queue unusable
+        self._drainDead()
+        self._results = self.context.Queue()
+        self._control = self.context.Queue()
+        self.process = self.context.Process(
+            target=runSourceShard,
+            args=(self.sids, self.daemonId, self._results, self._control, self._active),
+            name='sources-' + str(self.index),
+            daemon=True
+        )
+        self.process.start()
+        self._started = time.monotonic()
+        self._restartAt = None
+
+        if self._listening:
+            self._control.put(('listening', True))
+
+    def setActive(self, active):
+        self._active = active
+
+        if self.alive:
+            self._control.put(('active', active))
+
+    @staticmethod
+    def _drain(results, messages):
+        while True:
+            try:
+                messages.append(results.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def _drainDead(self):
+        # What a dead process already sent is read once, aside, since a message cut off by the kill would block the read
+        if self._results is None or self.alive:
+            return
+
+        messages = []
+        reader = threading.Thread(target=self._drain, args=(self._results, messages), name='drain-' + str(self.index), daemon=True)
+        reader.start()
+        reader.join(5)
+
+        self._results = None
+        self._orphans.extend(messages)
+
+    def receive(self):
+        self._drainDead()
+        messages, self._orphans = self._orphans, []
+
+        if self.alive:
+            self._drain(self._results, messages)
+
+        return messages
+
+    def setListening(self, listening):
+        self._listening = listening
+
+        if self.alive:
+            self._control.put(('listening', listening))
+
+    def notify(self, sid, table):
+        if self.alive:
+            self._control.put(('reload', (sid, table)))
+
+    def supervise(self, now):
+        if self.alive:
+            if now - self._started >= self.restartMax:
+                self._backoff = 1.0
+            return False
+
+        if self._restartAt is None:
+            self._restartAt = now + self._backoff
+            self.logger.write(
+                'Worker process for sources ' + ', '.join(str(sid) for sid in self.sids) + ' exited with code ' + str(self.process.exitcode) + '... restarting in ' + str(round(self._backoff, 1)) + ' seconds',
+                'danger'
+            )
+            return False
+
+        if now < self._restartAt:
+            return False
+
+        self._backoff = min(self._backoff * 2, self.restartMax)
+        self.restarts += 1
+        self.start()
+        return True
+
+    def stop(self):
+        if self.alive:
+            self.process.terminate()
+            self.process.join(5)
@@ -0,0 +1,71 @@
+import time
+from twisted.internet import reactor, task
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+import im_core.classes
+
+
+class Stage:
+    def __init__(self, name, fn, interval, now=True):
+        # Settings
+        self.name = name
+        self.interval = interval
+        self._fn = fn
+        self._now = now
+        self.logger = im_core.classes.Logger()
+
+        # Each stage gets its own worker so a slow stage never holds up the others or the reactor
+        self._pool = ThreadPool(1, 1, name)
+        self._loop = task.LoopingCall(self._tick)
+        self._running = False
+
+        # Timing
+        self.runs = 0
+        self.skipped = 0
+        self.lastDuration = 0.0
+        self.maxDuration = 0.0
+        self._skippedSinceRun = 0
+
+        # Metrics
+        metrics = im_core.classes.Metrics()
+        self._durationMetric = metrics.histogram('imcore_stage_seconds', 'Duration of stage runs', ('stage',)).labels(name)
+        self._skippedMetric = metrics.counter('imcore_stage_skipped_total', 'Stage cycles skipped because the previous run overran', ('stage',)).labels(name)
+        self._failedMetric = metrics.counter('imcore_stage_failures_total', 'Stage runs that raised an error', ('stage',)).labels(name)
+
+    def start(self):
+        self._pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self._pool.stop)
+        self._loop.start(self.interval, self._now)
+
+    def _tick(self):
+        # Overlap protection, a stage still running when its next interval comes around skips that cycle
+        if self._running:
+            self.skipped += 1
+            self._skippedSinceRun += 1
+            self._skippedMetric.inc()
+            return
+
+        self._running = True
+        d = deferToThreadPool(reactor, self._pool, self._timed)
+        d.addCallbacks(self._done, self._failed)
+
+    def _timed(self):
+        start = time.perf_counter()
+        self._fn()
+        return time.perf_counter() - start
+
+    def _done(self, duration):
+        self._running = False
+        self.runs += 1
+        self.lastDuration = duration
+        self.maxDuration = max(self.maxDuration, duration)
+        self._durationMetric.observe(duration)
+
+        if self._skippedSinceRun > 0:
+            self._skippedSinceRun = 0
+            self.logger.write('The ' + self.name + ' stage is overrunning its ' + str(self.interval) + 's interval, cycles are being skipped...', 'warning')
+
+    def _failed(self, failure):
+        self._running = False
+        self._failedMetric.inc()
+        self.logger.write('The ' + self.name + ' stage failed... ' + failure.getErrorMessage(), 'danger')
@@ -1,31 +1,142 @@
+import os
+import json
 import sqlite3
 import atexit
+import time
+import threading
+from itertools import chain, islice
 from pathlib import Path
 from im_core.classes.Singleton import Singleton
+from im_core.helpers import epochMillis
+import im_core.classes
 
 
 class Store(metaclass=Singleton):
     def __init__(self):
-        self.conn = sqlite3.connect(str(Path(__file__).parents[1]) + '/data/store.db')
-        self.conn.isolation_level = None  # Auto Commit
+        # Settings
+        self.commitRows = int(os.environ.get('STORE_COMMIT_ROWS', 50000))
+        self.commitTime = float(os.environ.get('STORE_COMMIT_TIME', 0))
+        self.synchronous = os.environ.get('STORE_SYNCHRONOUS', 'NORMAL').upper()
+        self.mode = os.environ.get('STORE_MODE', 'rows').lower()
+
+        # Budget, 0 leaves a limit off
+        self.maxRows = int(os.environ.get('STORE_MAX_ROWS', 0))
+        self.maxBytes = int(os.environ.get('STORE_MAX_BYTES', 0))
+        self.highWater = float(os.environ.get('STORE_HIGH_WATER', 0.8))
+        self.downsampleAge = float(os.environ.get('STORE_DOWNSAMPLE_AGE', 3600))
+        self.downsampleInterval = int(os.environ.get('STORE_DOWNSAMPLE_INTERVAL', 60))
+
+        self.path = os.environ.get('DATA_PATH') or str(Path(__file__).parents[1]) + '/data'
+        self.conn = sqlite3.connect(self.path + '/store.db', check_same_thread=False)
+        self.conn.isolation_level = None  # Auto Commit, transactions are opened explicitly
+
+        # The connection is shared with the logger thread
+        self._lock = threading.RLock()
+
+        # Group commit
+        self._pendingFacts = []
+        self._pendingCount = 0
+        self._lastCommit = time.time()
+        self.lastCommitRows = 0
+        self.lastCommitRate = 0.0
+
+        # Metrics
+        metrics = im_core.classes.Metrics()
+        self._commitRowsMetric = metrics.histogram('imcore_store_batch_rows', 'Rows written per store commit', buckets=metrics.rowsBuckets)
+        self._commitSecondsMetric = metrics.histogram('imcore_store_batch_seconds', 'Duration of store commits')
+
+        # Budget counters
+        self.sizeBytes = 0
+        self.rows = 0
+        self.downsampledRows = 0
+        self.evictedRows = 0
+        self._downsampledUntil = 0
+
+        # Facts are kept one row per sample, packed per tag into compressed chunks, or appended to rotating segment files
+        backends = {'rows': im_core.classes.StoreRows, 'chunks': im_core.classes.StoreChunks, 'segments': im_core.classes.StoreSegments}
+
+        if self.mode not in backends:
+            self.mode = 'rows'
+        self.facts = backends[self.mode](self)
 
         self._configure()
 
-        # Close the database connection on program exit
-        atexit.register(self.conn.close)
+        # Flush pending facts and close the database connection on program exit
+        atexit.register(self._close)
 
     def _configure(self):
         cur = self.conn.cursor()
 
+        if self.synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+            self.synchronous = 'NORMAL'
+
         try:
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous=" + self.synchronous)
+
+            # Stores written before stamps were epoch milliseconds are moved aside and converted below
+            legacy = [table for table in ('facts', 'rollups') if self._legacyStamps(cur, table)]
+
+            if legacy:
+                cur.execute("BEGIN")
+
+            for table in legacy:
+                cur.execute("ALTER TABLE " + table + " RENAME TO " + table + "_legacy")
+                cur.execute("DROP INDEX IF EXISTS " + table + ("_tag_id_time_idx" if table == 'facts' else "_tag_id_period_time_idx"))
+
+            # The row table always exists, it also holds what is migrated from before stamps were epoch milliseconds
+            rows = self.facts if self.mode == 'rows' else im_core.classes.StoreRows(self)
+            rows.configure(cur)
+
+            if self.mode != 'rows':
+                self.facts.configure(cur)
+
+            # Rollups are forwarded by id like facts, stores from before they had their own key are rebuilt
+            columns = [column[1] for column in cur.execute("PRAGMA table_info(rollups)").fetchall()]
+            rebuild = len(columns) > 0 and 'id' not in columns
+
+            if rebuild and not legacy:
+                cur.execute("BEGIN")
+
+            if rebuild:
+                cur.execute("ALTER TABLE rollups RENAME TO rollups_rowid")
+                cur.execute("DROP INDEX IF EXISTS rollups_tag_id_period_time_idx")
+
             cur.execute("""
-                CREATE TABLE IF NOT EXISTS facts (
+                CREATE TABLE IF NOT EXISTS rollups (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
                     tag_id INT NOT NULL,
-                    time TIMESTAMPTZ NOT NULL,
-                    val DOUBLE PRECISION NOT NULL
+                    period INT NOT NULL,
+                    time INTEGER NOT NULL,
+                    min DOUBLE PRECISION NOT NULL,
+                    max DOUBLE PRECISION NOT NULL,
+                    avg DOUBLE PRECISION NOT NULL,
+                    count INT NOT NULL,
+                    first DOUBLE PRECISION NOT NULL,
+                    last DOUBLE PRECISION NOT NULL
+                )
+            """)
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS rollups_tag_id_period_time_idx ON rollups (tag_id, period, time)")
+
+            if rebuild:
+                cur.execute(
+                    "INSERT INTO rollups (id, tag_id, period, time, min, max, avg, count, first, last) "
+                    "SELECT rowid, tag_id, period, time, min, max, avg, count, first, last FROM rollups_rowid ORDER BY rowid"
+                )
+                cur.execute("DROP TABLE rollups_rowid")
+
+            if rebuild and not legacy:
+                cur.execute("COMMIT")
+
+            # Last known cloud configuration, one versioned JSON snapshot per key
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS config (
+                    key TEXT PRIMARY KEY,
+                    version INT NOT NULL,
+                    data TEXT NOT NULL,
+                    saved_at INTEGER NOT NULL
                 )
             """)
-            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS facts_tag_id_time_idx ON facts (tag_id, time)")
 
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS logs (
@@ -36,27 +147,295 @@ class Store(metaclass=Singleton):
                     daemon_id INT
                 )
             """)
+
+            for table in legacy:
+                self._migrateStamps(cur, table)
+
+            if legacy:
+                cur.execute("COMMIT")
         finally:
             self.conn.commit()
 
-    def execute(self, query, values=None):
-        cur = self.conn.cursor()
+        # Facts left behind by the other storage modes are moved over before anything new is written
+        if self.mode != 'rows':
+            self._adopt(rows)
+        if self.mode != 'chunks' and im_core.classes.StoreChunks.exists(self.conn):
+            self._adopt(im_core.classes.StoreChunks(self))
+        if self.mode != 'segments' and im_core.classes.StoreSegments.exists(self.conn):
+            segments = im_core.classes.StoreSegments(self)
+            segments.configure(self.conn.cursor())
+            segments.close()
+            self._adopt(segments)
+
+    def _adopt(self, other):
+        while True:
+            records, watermark = other.read(self.commitRows, 0)
+
+            if len(records) == 0:
+                break
+
+            self.facts.write(records)
+            other.ack(watermark)
+
+        # Leaves nothing behind for the next start to adopt again
+        other.compact()
+
+    @staticmethod
+    def _legacyStamps(cur, table):
+        return any(column[1] == 'time' and column[2] == 'TIMESTAMPTZ' for column in cur.execute("PRAGMA table_info(" + table + ")").fetchall())
 
+    @staticmethod
+    def _migrateStamps(cur, table):
+        # Legacy stamps are local time text with second resolution
+        columns = [column[1] for column in cur.execute("PRAGMA table_info(" + table + "_legacy)").fetchall()]
+        select = ["CAST(strftime('%s', time, 'utc') AS INTEGER) * 1000" if column == 'time' else column for column in columns]
+
+        cur.execute(
+            "INSERT OR IGNORE INTO " + table + " (" + ', '.join(columns) + ") "
+            "SELECT " + ', '.join(select) + " FROM " + table + "_legacy WHERE time IS NOT NULL ORDER BY rowid"
+        )
+        cur.execute("DROP TABLE " + table + "_legacy")
+
+    def _close(self):
         try:
-            if "CREATE" in query:
-                cur.execute(query, values)
-                return True
-            elif "INSERT" in query:
-                cur.execute(query, values)
-                return True
-            elif "SELECT" in query:
-                cur.execute(query, values)
-                rows = cur.fetchall()
-                return rows
-            elif "UPDATE" in query:
-                cur.execute(query, values)
-                return True
-            else:
-                print("Query is not allowed")
+            self.commitFacts(True)
         finally:
-            cur.close()
+            with self._lock:
+                self.conn.close()
+
+    def execute(self, query, values=None):
+        with self._lock:
+            cur = self.conn.cursor()
+
+            try:
+                if "CREATE" in query:
+                    cur.execute(query, values)
+                    return True
+                elif "INSERT" in query:
+                    cur.execute(query, values)
+                    return True
+                elif "SELECT" in query:
+                    cur.execute(query, values)
+                    rows = cur.fetchall()
+                    return rows
+                elif "UPDATE" in query:
+                    cur.execute(query, values)
+                    return True
+                else:
+                    print("Query is not allowed")
+            finally:
+                cur.close()
+
+    def _transaction(self, query, rows):
+        with self._lock:
+            cur = self.conn.cursor()
+
+            try:
+                cur.execute("BEGIN")
+                try:
+                    cur.executemany(query, rows)
+                    changed = cur.rowcount
+                    cur.execute("COMMIT")
+                except sqlite3.Error:
+                    cur.execute("ROLLBACK")
+                    raise
+            finally:
+                cur.close()
+
+        return changed
+
+    def writeFacts(self, rows, count):
+        # Rows are a lazy iterable of (tag_id, epoch milliseconds, val), they are held until the group commit is due
+        self._pendingFacts.append(rows)
+        self._pendingCount += count
+
+        if self._pendingCount >= self.commitRows:
+            return self.commitFacts(True)
+
+        return 0
+
+    def commitFacts(self, force=False):
+        if self._pendingCount == 0:
+            return 0
+
+        if not force and time.time() - self._lastCommit < self.commitTime:
+            return 0
+
+        rows = chain.from_iterable(self._pendingFacts)
+        count = self._pendingCount
+        self._pendingFacts = []
+        self._pendingCount = 0
+        start = time.time()
+
+        # One transaction per STORE_COMMIT_ROWS rows keeps the journal bounded on large backlogs
+        written = 0
+
+        while written < count:
+            batch = list(islice(rows, self.commitRows))
+
+            if len(batch) == 0:
+                break
+
+            try:
+                self.facts.write(batch)
+            except sqlite3.Error:
+                # The failed batch and everything after it go back in front of the queue for the next commit
+                self._pendingFacts = [batch, rows] + self._pendingFacts
+                self._pendingCount += count - written
+                raise
+
+            written += len(batch)
+
+        elapsed = time.time() - start
+        self._lastCommit = time.time()
+        self.lastCommitRows = count
+        self.lastCommitRate = count / elapsed if elapsed > 0 else float(count)
+        self._commitRowsMetric.observe(count)
+        self._commitSecondsMetric.observe(elapsed)
+
+        return count
+
+    def _readBatch(self, query, limit, after):
+        with self._lock:
+            rows = self.conn.execute(query, [after, limit]).fetchall()
+
+        if len(rows) == 0:
+            return [], after
+
+        return [row[1:] for row in rows], rows[-1][0]
+
+    def readFacts(self, limit, after=0):
+        return self.facts.read(limit, after)
+
+    def ackFacts(self, watermark):
+        self.facts.ack(watermark)
+
+    def factBacklog(self):
+        return self.facts.count()
+
+    def queryFacts(self, start=None, end=None, tid=None):
+        # Facts not yet forwarded as (tag_id, epoch milliseconds, val), optionally limited to a time range and tag
+        return self.facts.query(start, end, tid)
+
+    def writeRollups(self, rows):
+        # A bucket closed again by late samples is merged into the row that is already there
+        self._transaction("""
+            INSERT INTO rollups (tag_id, period, time, min, max, avg, count, first, last) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (tag_id, period, time) DO UPDATE SET
+                min = MIN(min, excluded.min),
+                max = MAX(max, excluded.max),
+                avg = (avg * count + excluded.avg * excluded.count) / (count + excluded.count),
+                count = count + excluded.count,
+                last = excluded.last
+        """, rows)
+
+    def readRollups(self, limit, after=0):
+        return self._readBatch(
+            "SELECT id, tag_id, period, time, min, max, avg, count, first, last FROM rollups WHERE id > ? ORDER BY id LIMIT ?",
+            limit,
+            after
+        )
+
+    def ackRollups(self, watermark):
+        with self._lock:
+            self.conn.execute("DELETE FROM rollups WHERE id <= ?", [watermark])
+
+    def writeLogs(self, rows):
+        self._transaction("INSERT INTO logs (time, message, level, daemon_id) VALUES (?, ?, ?, ?)", rows)
+
+    def readLogs(self, limit, after=0):
+        return self._readBatch("SELECT id, time, message, level, daemon_id FROM logs WHERE id > ? ORDER BY id LIMIT ?", limit, after)
+
+    def ackLogs(self, watermark):
+        with self._lock:
+            self.conn.execute("DELETE FROM logs WHERE id <= ?", [watermark])
+
+    def saveConfig(self, key, data):
+        # A snapshot only takes a new version when its contents changed
+        text = json.dumps(data, sort_keys=True, default=str)
+
+        with self._lock:
+            row = self.conn.execute("SELECT version, data FROM config WHERE key = ?", [key]).fetchone()
+
+            if row is not None and row[1] == text:
+                return row[0]
+
+            version = row[0] + 1 if row is not None else 1
+            self.conn.execute(
+                "INSERT INTO config (key, version, data, saved_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET version = excluded.version, data = excluded.data, saved_at = excluded.saved_at",
+                [key, version, text, epochMillis()]
+            )
+
+        return version
+
+    def loadConfig(self, key):
+        with self._lock:
+            row = self.conn.execute("SELECT data FROM config WHERE key = ?", [key]).fetchone()
+
+        return json.loads(row[0]) if row is not None else None
+
+    def usedBytes(self):
+        # Pages in use in store.db plus whatever the facts backend keeps in its own files
+        with self._lock:
+            pageSize = self.conn.execute("PRAGMA page_size").fetchone()[0]
+            pages = self.conn.execute("PRAGMA page_count").fetchone()[0] - self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+            return pages * pageSize + self.facts.sizeBytes()
+
+    def _usage(self):
+        with self._lock:
+            self.sizeBytes = self.usedBytes()
+            self.rows = self.facts.count()
+
+        usage = 0.0
+        if self.maxRows > 0:
+            usage = max(usage, self.rows / self.maxRows)
+        if self.maxBytes > 0:
+            usage = max(usage, self.sizeBytes / self.maxBytes)
+
+        return usage
+
+    def _downsample(self):
+        # Buckets are aligned to the interval so a bucket is never split between two passes
+        cutoff = int((time.time() - self.downsampleAge) // self.downsampleInterval * self.downsampleInterval)
+
+        if cutoff <= self._downsampledUntil:
+            return 0
+
+        # Only the min, max and last sample of every tag and bucket older than the cutoff are kept
+        removed = self.facts.downsample(self._downsampledUntil * 1000, cutoff * 1000, self.downsampleInterval * 1000)
+        self._downsampledUntil = cutoff
+        return removed
+
+    def _evict(self):
+        # Still over budget after downsampling, the oldest samples go first down to the high water mark
+        excess = 0
+        if self.maxRows > 0:
+            excess = max(excess, self.rows - int(self.maxRows * self.highWater))
+        if self.maxBytes > 0 and self.rows > 0:
+            bytesPerRow = self.sizeBytes / self.rows
+            excess = max(excess, int((self.sizeBytes - self.maxBytes * self.highWater) / bytesPerRow) + 1)
+
+        if excess <= 0:
+            return 0
+
+        return self.facts.evict(excess)
+
+    def enforceBudget(self):
+        self.facts.compact()
+
+        if self.maxRows <= 0 and self.maxBytes <= 0:
+            return 0, 0
+
+        downsampled = 0
+        evicted = 0
+
+        if self._usage() >= self.highWater:
+            downsampled = self._downsample()
+            self.downsampledRows += downsampled
+
+            if self._usage() >= 1.0:
+                evicted = self._evict()
+                self.evictedRows += evicted
+
+        return downsampled, evicted
@@ -0,0 +1,245 @@
+import os
+import sqlite3
+from im_core.helpers import encodeChunk, decodeChunk, epochMillis
+
+
+class StoreChunks:
+    table = 'chunks'
+
+    def __init__(self, store):
+        self.store = store
+
+        # Settings
+        self.maxSamples = int(os.environ.get('STORE_CHUNK_SAMPLES', 1000))
+        self.compactAge = float(os.environ.get('STORE_CHUNK_COMPACT_AGE', 300))
+
+        # Chunks are forwarded in the order they were written
+        self._seq = 0
+
+    @staticmethod
+    def exists(conn):
+        return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chunks'").fetchone() is not None
+
+    def configure(self, cur):
+        # One row per tag and chunk, the samples are packed in the blob
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS chunks (
+                tag_id INT NOT NULL,
+                start_time INTEGER NOT NULL,
+                end_time INTEGER NOT NULL,
+                count INT NOT NULL,
+                seq INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (tag_id, start_time)
+            ) WITHOUT ROWID
+        """)
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS chunks_seq_idx ON chunks (seq)")
+        self._seq = cur.execute("SELECT COALESCE(MAX(seq), 0) FROM chunks").fetchone()[0]
+
+    def _encode(self, tid, stamps, values):
+        for i in range(0, len(stamps), self.maxSamples):
+            chunkStamps = stamps[i:i + self.maxSamples]
+            self._seq += 1
+            yield tid, chunkStamps[0], chunkStamps[-1], len(chunkStamps), self._seq, encodeChunk(chunkStamps, values[i:i + self.maxSamples])
+
+    @staticmethod
+    def _series(rows):
+        series = {}
+
+        for tid, stamp, value in rows:
+            samples = series.get(tid)
+
+            if samples is None:
+                samples = series[tid] = ([], [])
+
+            samples[0].append(stamp)
+            samples[1].append(value)
+
+        return series
+
+    def write(self, rows):
+        # Every commit closes one chunk per tag, small chunks are merged once they are old enough
+        series = self._series(rows)
+
+        self.store._transaction(
+            "INSERT OR IGNORE INTO chunks (tag_id, start_time, end_time, count, seq, data) VALUES (?, ?, ?, ?, ?, ?)",
+            (chunk for tid, (stamps, values) in series.items() for chunk in self._encode(tid, stamps, values))
+        )
+
+    def read(self, limit, after=0):
+        chunks = []
+        count = 0
+
+        with self.store._lock:
+            cur = self.store.conn.execute("SELECT seq, tag_id, count, data FROM chunks WHERE seq > ? ORDER BY seq", [after])
+
+            for seq, tid, samples, data in cur:
+                chunks.append((seq, tid, data))
+                count += samples
+
+                if count >= limit:
+                    break
+            cur.close()
+
+        if len(chunks) == 0:
+            return [], after
+
+        # Decoded for the forwarder outside the lock, records come back as (tag_id, time, val) like the row store
+        records = []
+
+        for seq, tid, data in chunks:
+            stamps, values = decodeChunk(data)
+            records.extend(zip([tid] * len(stamps), stamps, values))
+
+        return records, chunks[-1][0]
+
+    def ack(self, watermark):
+        with self.store._lock:
+            self.store.conn.execute("DELETE FROM chunks WHERE seq <= ?", [watermark])
+
+    def count(self):
+        with self.store._lock:
+            return self.store.conn.execute("SELECT COALESCE(SUM(count), 0) FROM chunks").fetchone()[0]
+
+    def _rewrite(self, tid, where, values, keep=None):
+        # The chunks of a tag are decoded, optionally thinned and packed again, rewritten chunks get a new seq
+        # so a forward in progress sends them again, which the cloud ignores as duplicates
+        with self.store._lock:
+            chunks = self.store.conn.execute(
+                "SELECT start_time, data FROM chunks WHERE tag_id = ? AND " + where + " ORDER BY start_time",
+                [tid] + values
+            ).fetchall()
+
+            if len(chunks) == 0:
+                return 0
+
+            stamps = []
+            samples = []
+
+            for start, data in chunks:
+                chunkStamps, chunkValues = decodeChunk(data)
+                stamps.extend(chunkStamps)
+                samples.extend(chunkValues)
+
+            count = len(stamps)
+
+            if keep is not None:
+                stamps, samples = keep(stamps, samples)
+
+            cur = self.store.conn.cursor()
+
+            try:
+                cur.execute("BEGIN")
+                try:
+                    cur.executemany("DELETE FROM chunks WHERE tag_id = ? AND start_time = ?", [(tid, start) for start, data in chunks])
+                    cur.executemany(
+                        "INSERT INTO chunks (tag_id, start_time, end_time, count, seq, data) VALUES (?, ?, ?, ?, ?, ?)",
+                        list(self._encode(tid, stamps, samples)) if len(stamps) > 0 else []
+                    )
+                    cur.execute("COMMIT")
+                except sqlite3.Error:
+                    cur.execute("ROLLBACK")
+                    raise
+            finally:
+                cur.close()
+
+        return count - len(stamps)
+
+    def compact(self):
+        # Chunks that were not forwarded in time, usually during an outage, are merged up to STORE_CHUNK_SAMPLES
+        cutoff = epochMillis() - int(self.compactAge * 1000)
+
+        with self.store._lock:
+            tags = [row[0] for row in self.store.conn.execute(
+                "SELECT tag_id FROM chunks WHERE end_time < ? AND count < ? GROUP BY tag_id HAVING COUNT(*) > 1",
+                [cutoff, self.maxSamples]
+            )]
+
+        for tid in tags:
+            self._rewrite(tid, "end_time < ? AND count < ?", [cutoff, self.maxSamples])
+
+        return len(tags)
+
+    def sizeBytes(self):
+        return 0
+
+    def query(self, start=None, end=None, tid=None):
+        # Chunks overlapping the range are decoded and their samples filtered
+        where = ["1"]
+        values = []
+
+        if start is not None:
+            where.append("end_time >= ?")
+            values.append(start)
+        if end is not None:
+            where.append("start_time < ?")
+            values.append(end)
+        if tid is not None:
+            where.append("tag_id = ?")
+            values.append(tid)
+
+        with self.store._lock:
+            chunks = self.store.conn.execute("SELECT tag_id, data FROM chunks WHERE " + " AND ".join(where) + " ORDER BY seq", values).fetchall()
+
+        records = []
+
+        for chunkTid, data in chunks:
+            stamps, samples = decodeChunk(data)
+            records.extend(
+                (chunkTid, stamp, value) for stamp, value in zip(stamps, samples)
+                if (start is None or stamp >= start) and (end is None or stamp < end)
+            )
+
+        return records
+
+    @staticmethod
+    def _thin(start, end, interval):
+        def keep(stamps, values):
+            buckets = {}
+
+            for i, stamp in enumerate(stamps):
+                if start <= stamp < end:
+                    buckets.setdefault(stamp // interval, []).append(i)
+
+            # Same selection as the row store, the min, max and last sample of every bucket
+            dropped = set()
+
+            for members in buckets.values():
+                low = min(members, key=lambda i: (values[i], stamps[i]))
+                high = min(members, key=lambda i: (-values[i], stamps[i]))
+                last = max(members, key=lambda i: stamps[i])
+                dropped.update(i for i in members if i not in (low, high, last))
+
+            return [stamp for i, stamp in enumerate(stamps) if i not in dropped], [value for i, value in enumerate(values) if i not in dropped]
+
+        return keep
+
+    def downsample(self, start, end, interval):
+        with self.store._lock:
+            tags = [row[0] for row in self.store.conn.execute(
+                "SELECT DISTINCT tag_id FROM chunks WHERE start_time < ? AND end_time >= ?",
+                [end, start]
+            )]
+
+        keep = self._thin(start, end, interval)
+        return sum(self._rewrite(tid, "start_time < ? AND end_time >= ?", [end, start], keep) for tid in tags)
+
+    def evict(self, excess):
+        # The chunks holding the oldest samples go first
+        removed = 0
+        victims = []
+
+        with self.store._lock:
+            cur = self.store.conn.execute("SELECT tag_id, start_time, count FROM chunks ORDER BY end_time")
+
+            for tid, start, count in cur:
+                victims.append((tid, start))
+                removed += count
+
+                if removed >= excess:
+                    break
+            cur.close()
+
+            self.store._transaction("DELETE FROM chunks WHERE tag_id = ? AND start_time = ?", victims)
+
+        return removed
@@ -0,0 +1,111 @@
+class StoreRows:
+    table = 'facts'
+
+    def __init__(self, store):
+        self.store = store
+
+        # Rows in the table, counted once on first use and kept up to date by every path that adds or removes rows
+        self._rows = None
+
+    def configure(self, cur):
+        # Stores from before facts had their own key are rebuilt, ids keep the rowids so a forward resumes where it left off
+        columns = [column[1] for column in cur.execute("PRAGMA table_info(facts)").fetchall()]
+        rebuild = len(columns) > 0 and 'id' not in columns
+
+        if rebuild:
+            cur.execute("BEGIN")
+            cur.execute("ALTER TABLE facts RENAME TO facts_rowid")
+            cur.execute("DROP INDEX IF EXISTS facts_tag_id_time_idx")
+
+        # Times are epoch milliseconds, they are only converted to timestamps when forwarded
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS facts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tag_id INT NOT NULL,
+                time INTEGER NOT NULL,
+                val DOUBLE PRECISION NOT NULL
+            )
+        """)
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS facts_tag_id_time_idx ON facts (tag_id, time)")
+
+        if rebuild:
+            cur.execute("INSERT INTO facts (id, tag_id, time, val) SELECT rowid, tag_id, time, val FROM facts_rowid ORDER BY rowid")
+            cur.execute("DROP TABLE facts_rowid")
+            cur.execute("COMMIT")
+
+    def _adjust(self, delta):
+        if self._rows is not None:
+            self._rows += delta
+
+    def write(self, rows):
+        with self.store._lock:
+            self._adjust(self.store._transaction("INSERT OR IGNORE INTO facts (tag_id, time, val) VALUES (?, ?, ?)", rows))
+
+    def read(self, limit, after=0):
+        # Ids are never reused, not even once acks empty the table, so a watermark held across batches stays valid
+        return self.store._readBatch("SELECT id, tag_id, time, val FROM facts WHERE id > ? ORDER BY id LIMIT ?", limit, after)
+
+    def ack(self, watermark):
+        with self.store._lock:
+            self._adjust(-self.store.conn.execute("DELETE FROM facts WHERE id <= ?", [watermark]).rowcount)
+
+    def count(self):
+        with self.store._lock:
+            if self._rows is None:
+                self._rows = self.store.conn.execute("SELECT COUNT(*) FROM facts").fetchone()[0]
+
+            return self._rows
+
+    def compact(self):
+        return 0
+
+    def sizeBytes(self):
+        return 0
+
+    def query(self, start=None, end=None, tid=None):
+        where = ["1"]
+        values = []
+
+        if start is not None:
+            where.append("time >= ?")
+            values.append(start)
+        if end is not None:
+            where.append("time < ?")
+            values.append(end)
+        if tid is not None:
+            where.append("tag_id = ?")
+            values.append(tid)
+
+        with self.store._lock:
+            return self.store.conn.execute("SELECT tag_id, time, val FROM facts WHERE " + " AND ".join(where) + " ORDER BY id", values).fetchall()
+
+    def downsample(self, start, end, interval):
+        # Only the min, max and last sample of every tag and bucket in the range are kept
+        with self.store._lock:
+            removed = self.store.conn.execute("""
+                DELETE FROM facts WHERE id IN (
+                    SELECT r FROM (
+                        SELECT r,
+                            ROW_NUMBER() OVER (PARTITION BY tag_id, bucket ORDER BY val, time) AS low,
+                            ROW_NUMBER() OVER (PARTITION BY tag_id, bucket ORDER BY val DESC, time) AS high,
+                            ROW_NUMBER() OVER (PARTITION BY tag_id, bucket ORDER BY time DESC) AS last
+                        FROM (
+                            SELECT id AS r, tag_id, time, val, time / ? AS bucket
+                            FROM facts WHERE time >= ? AND time < ?
+                        )
+                    ) WHERE low > 1 AND high > 1 AND last > 1
+                )
+            """, [interval, start, end]).rowcount
+            self._adjust(-removed)
+
+        return removed
+
+    def evict(self, excess):
+        with self.store._lock:
+            removed = self.store.conn.execute(
+                "DELETE FROM facts WHERE id IN (SELECT id FROM facts ORDER BY id LIMIT ?)",
+                [excess]
+            ).rowcount
+            self._adjust(-removed)
+
+        return removed
@@ -0,0 +1,297 @@
+import os
+import sqlite3
+from im_core.helpers import epochMillis
+
+
+class StoreSegments:
+    table = 'segments'
+
+    def __init__(self, store):
+        self.store = store
+
+        # Settings, a segment is closed once it is STORE_SEGMENT_SECONDS old or has taken STORE_SEGMENT_ROWS rows
+        self.segmentSeconds = float(os.environ.get('STORE_SEGMENT_SECONDS', 3600))
+        self.segmentRows = int(os.environ.get('STORE_SEGMENT_ROWS', 1000000))
+        self.path = store.path + '/segments'
+
+        # Open segment connections by seq, the last segment is the one being written
+        self._conns = {}
+        self._current = None
+
+    @staticmethod
+    def exists(conn):
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'segments'").fetchone() is None:
+            return False
+        return conn.execute("SELECT 1 FROM segments LIMIT 1").fetchone() is not None
+
+    def configure(self, cur):
+        # Segments are listed in the main store, acked is the last rowid the cloud accepted from each of them and rows
+        # counts the rows written to them, deleted rows included
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS segments (
+                seq INTEGER PRIMARY KEY,
+                start_time INTEGER NOT NULL,
+                rows INT NOT NULL DEFAULT 0,
+                acked INTEGER NOT NULL DEFAULT 0,
+                closed BOOLEAN NOT NULL DEFAULT 0
+            )
+        """)
+        os.makedirs(self.path, exist_ok=True)
+
+        # Whichever of the listing and the files was left behind by a crash between the two is cleaned up
+        known = set()
+
+        for seq, in cur.execute("SELECT seq FROM segments").fetchall():
+            if os.path.exists(self._file(seq)):
+                known.add(seq)
+            else:
+                cur.execute("DELETE FROM segments WHERE seq = ?", [seq])
+
+        for name in os.listdir(self.path):
+            if name.startswith('facts_') and name.split('.')[0][6:].isdigit() and int(name.split('.')[0][6:]) not in known:
+                os.unlink(self.path + '/' + name)
+
+        current = cur.execute("SELECT seq, start_time, rows FROM segments WHERE closed = 0 ORDER BY seq DESC LIMIT 1").fetchone()
+        self._current = list(current) if current is not None else None
+
+        # The listing is updated after the segment commits, after a crash in between the segment's own rowids are right
+        if self._current is not None:
+            rows = self._connect(self._current[0]).execute("SELECT MAX(rowid) FROM facts").fetchone()[0] or 0
+
+            if rows != self._current[2]:
+                cur.execute("UPDATE segments SET rows = ? WHERE seq = ?", [rows, self._current[0]])
+                self._current[2] = rows
+
+    def _file(self, seq):
+        return self.path + '/facts_' + str(seq).zfill(10) + '.db'
+
+    def _connect(self, seq):
+        conn = self._conns.get(seq)
+
+        if conn is None:
+            conn = self._conns[seq] = sqlite3.connect(self._file(seq), check_same_thread=False)
+            conn.isolation_level = None
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=" + self.store.synchronous)
+
+            # Segments are append only, rows leave with the whole file so no index is kept up to date
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS facts (
+                    tag_id INT NOT NULL,
+                    time INTEGER NOT NULL,
+                    val DOUBLE PRECISION NOT NULL
+                )
+            """)
+
+        return conn
+
+    def _segments(self, after=0):
+        return self.store.conn.execute("SELECT seq, acked, closed FROM segments WHERE seq >= ? ORDER BY seq", [after]).fetchall()
+
+    def _remove(self, seq):
+        conn = self._conns.pop(seq, None)
+
+        if conn is not None:
+            conn.close()
+
+        # Listed first and unlinked second, a crash in between leaves a file that is removed on the next start
+        self.store.conn.execute("DELETE FROM segments WHERE seq = ?", [seq])
+
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.unlink(self._file(seq) + suffix)
+            except FileNotFoundError:
+                pass
+
+    def _drained(self, seq, acked):
+        return self._connect(seq).execute("SELECT 1 FROM facts WHERE rowid > ? LIMIT 1", [acked]).fetchone() is None
+
+    def _rotate(self, now):
+        if self._current is not None:
+            self.store.conn.execute("UPDATE segments SET closed = 1 WHERE seq = ?", [self._current[0]])
+
+        seq = self.store.conn.execute("INSERT INTO segments (start_time) VALUES (?)", [now]).lastrowid
+        self._current = [seq, now, 0]
+        self._connect(seq)
+
+    def close(self):
+        # The segment being written is closed so it is unlinked once drained
+        with self.store._lock:
+            self.store.conn.execute("UPDATE segments SET closed = 1 WHERE closed = 0")
+            self._current = None
+
+    def write(self, rows):
+        rows = list(rows)
+
+        if len(rows) == 0:
+            return
+
+        with self.store._lock:
+            now = epochMillis()
+
+            if self._current is None or now - self._current[1] >= self.segmentSeconds * 1000 or self._current[2] >= self.segmentRows:
+                self._rotate(now)
+
+            seq = self._current[0]
+            cur = self._connect(seq).cursor()
+
+            try:
+                cur.execute("BEGIN")
+                try:
+                    cur.executemany("INSERT INTO facts (tag_id, time, val) VALUES (?, ?, ?)", rows)
+                    written = cur.execute("SELECT MAX(rowid) FROM facts").fetchone()[0]
+                    cur.execute("COMMIT")
+                except sqlite3.Error:
+                    cur.execute("ROLLBACK")
+                    raise
+            finally:
+                cur.close()
+
+            self._current[2] = written
+            self.store.conn.execute("UPDATE segments SET rows = ? WHERE seq = ?", [written, seq])
+
+    def read(self, limit, after=0):
+        # The watermark is (seq, rowid), segments are drained oldest first and a batch may span several of them
+        afterSeq, afterRow = after if after else (0, 0)
+        records = []
+        watermark = after
+
+        with self.store._lock:
+            for seq, acked, closed in self._segments(afterSeq):
+                start = max(acked, afterRow if seq == afterSeq else 0)
+                rows = self._connect(seq).execute(
+                    "SELECT rowid, tag_id, time, val FROM facts WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                    [start, limit - len(records)]
+                ).fetchall()
+
+                if len(rows) > 0:
+                    records.extend(row[1:] for row in rows)
+                    watermark = (seq, rows[-1][0])
+
+                if len(records) >= limit:
+                    break
+
+        return records, watermark
+
+    def ack(self, watermark):
+        if not watermark:
+            return
+
+        seq, rowid = watermark
+
+        # Segments before the watermark were read to their end, closed ones that are fully acknowledged are unlinked
+        with self.store._lock:
+            self.store.conn.execute("UPDATE segments SET acked = MAX(acked, ?) WHERE seq = ?", [rowid, seq])
+
+            for other, acked, closed in self.store.conn.execute("SELECT seq, acked, closed FROM segments WHERE seq <= ? ORDER BY seq", [seq]).fetchall():
+                if closed and (other < seq or self._drained(other, acked)):
+                    self._remove(other)
+
+    def count(self):
+        with self.store._lock:
+            return sum(self._connect(seq).execute("SELECT COUNT(*) FROM facts WHERE rowid > ?", [acked]).fetchone()[0] for seq, acked, closed in self._segments())
+
+    def sizeBytes(self):
+        size = 0
+
+        with self.store._lock:
+            for seq, acked, closed in self._segments():
+                for suffix in ('', '-wal'):
+                    try:
+                        size += os.path.getsize(self._file(seq) + suffix)
+                    except FileNotFoundError:
+                        pass
+
+        return size
+
+    def compact(self):
+        # Called every store cycle, an idle segment is closed on time and drained closed segments are unlinked
+        removed = 0
+
+        with self.store._lock:
+            now = epochMillis()
+
+            if self._current is not None and now - self._current[1] >= self.segmentSeconds * 1000:
+                self.store.conn.execute("UPDATE segments SET closed = 1 WHERE seq = ?", [self._current[0]])
+                self._current = None
+
+            for seq, acked, closed in self._segments():
+                if closed and self._drained(seq, acked):
+                    self._remove(seq)
+                    removed += 1
+
+        return removed
+
+    def query(self, start=None, end=None, tid=None):
+        # Readers see every sample not yet acknowledged, across all segments in the order they were written
+        where = ["rowid > ?"]
+        values = []
+
+        if start is not None:
+            where.append("time >= ?")
+            values.append(start)
+        if end is not None:
+            where.append("time < ?")
+            values.append(end)
+        if tid is not None:
+            where.append("tag_id = ?")
+            values.append(tid)
+
+        records = []
+
+        with self.store._lock:
+            for seq, acked, closed in self._segments():
+                records.extend(self._connect(seq).execute(
+                    "SELECT tag_id, time, val FROM facts WHERE " + " AND ".join(where) + " ORDER BY rowid",
+                    [acked] + values
+                ).fetchall())
+
+        return records
+
+    def downsample(self, start, end, interval):
+        # Only the min, max and last sample of every tag and bucket in the range are kept
+        removed = 0
+
+        with self.store._lock:
+            for seq, acked, closed in self._segments():
+                removed += self._connect(seq).execute("""
+                    DELETE FROM facts WHERE rowid IN (
+                        SELECT r FROM (
+                            SELECT r,
+                                ROW_NUMBER() OVER (PARTITION BY tag_id, bucket ORDER BY val, time) AS low,
+                                ROW_NUMBER() OVER (PARTITION BY tag_id, bucket ORDER BY val DESC, time) AS high,
+                                ROW_NUMBER() OVER (PARTITION BY tag_id, bucket ORDER BY time DESC) AS last
+                            FROM (
+                                SELECT rowid AS r, tag_id, time, val, time / ? AS bucket
+                                FROM facts WHERE rowid > ? AND time >= ? AND time < ?
+                            )
+                        ) WHERE low > 1 AND high > 1 AND last > 1
+                    )
+                """, [interval, acked, start, end]).rowcount
+
+        return removed
+
+    def evict(self, excess):
+        # Whole segments go first, the rest is skipped over by moving the oldest remaining segment's acked rowid
+        removed = 0
+
+        with self.store._lock:
+            for seq, acked, closed in self._segments():
+                if removed >= excess:
+                    break
+
+                pending = self._connect(seq).execute("SELECT COUNT(*) FROM facts WHERE rowid > ?", [acked]).fetchone()[0]
+
+                if closed and removed + pending <= excess:
+                    self._remove(seq)
+                    removed += pending
+                elif pending > 0:
+                    skip = min(excess - removed, pending)
+                    rowid = self._connect(seq).execute(
+                        "SELECT rowid FROM facts WHERE rowid > ? ORDER BY rowid LIMIT 1 OFFSET ?",
+                        [acked, skip - 1]
+                    ).fetchone()[0]
+                    self.store.conn.execute("UPDATE segments SET acked = ? WHERE seq = ?", [rowid, seq])
+                    removed += skip
+
+        return removed
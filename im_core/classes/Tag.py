@@ -1,9 +1,99 @@
 class Tag:
-    def __init__(self, tid, name):
+    __slots__ = ('id', 'name', 'buffer', 'mode', 'deadband', 'deadbandType', 'maxInterval', 'scanRate',
+                 'forwardRaw', '_last', '_held', '_upperSlope', '_lowerSlope')
+
+    modes = ('all', 'change', 'deadband', 'swinging_door')
+
+    def __init__(self, tid, name, buffer, mode='all', deadband=0.0, deadbandType='absolute', maxInterval=0.0, scanRate=None, forwardRaw=True):
         # Settings
         self.id = tid
         self.name = name
-        self.records = []
+        self.buffer = buffer
+
+        # Last archived sample as (epoch milliseconds, value)
+        self._last = None
+
+        # Swinging door state
+        self._held = None
+        self._upperSlope = None
+        self._lowerSlope = None
+
+        self.configure(mode, deadband, deadbandType, maxInterval, scanRate, forwardRaw)
+
+    def configure(self, mode='all', deadband=0.0, deadbandType='absolute', maxInterval=0.0, scanRate=None, forwardRaw=True):
+        mode = mode if mode in self.modes else 'all'
+
+        # Tags archiving every sample are written in bulk without tracking their last sample
+        if mode != getattr(self, 'mode', None):
+            # The sample swinging door held back is the end of its last line, it is archived rather than dropped
+            if self._held is not None:
+                self._archive(*self._held)
+
+            self._last = None
+            self._held = None
+            self._upperSlope = None
+            self._lowerSlope = None
+
+        self.mode = mode
+        self.deadband = abs(float(deadband or 0.0))
+        self.deadbandType = 'percent' if deadbandType == 'percent' else 'absolute'
+        self.maxInterval = float(maxInterval or 0.0)
+        self.scanRate = float(scanRate) if scanRate else None
+        self.forwardRaw = forwardRaw
+
+    def _band(self, reference):
+        if self.deadbandType == 'percent':
+            return abs(reference) * self.deadband / 100.0
+        return self.deadband
+
+    def _archive(self, stamp, value):
+        self.buffer.append(self.id, stamp, value)
+        self._last = (stamp, value)
+
+    def _heartbeatDue(self, stamp):
+        return 0 < self.maxInterval * 1000 <= stamp - self._last[0]
+
+    def record(self, stamp, value):
+        if self.mode == 'all' or self._last is None:
+            self._archive(stamp, value)
+        elif self.mode == 'change':
+            if value != self._last[1] or self._heartbeatDue(stamp):
+                self._archive(stamp, value)
+        elif self.mode == 'deadband':
+            if abs(value - self._last[1]) > self._band(self._last[1]) or self._heartbeatDue(stamp):
+                self._archive(stamp, value)
+        else:
+            self._swingingDoor(stamp, value)
+
+    def _openDoor(self, stamp, value):
+        dt = stamp - self._last[0]
+        band = self._band(self._last[1])
+        upper = (value + band - self._last[1]) / dt
+        lower = (value - band - self._last[1]) / dt
+
+        self._upperSlope = upper if self._upperSlope is None else min(self._upperSlope, upper)
+        self._lowerSlope = lower if self._lowerSlope is None else max(self._lowerSlope, lower)
+
+    def _swingingDoor(self, stamp, value):
+        if stamp <= self._last[0]:
+            return
+
+        if self._heartbeatDue(stamp):
+            if self._held is not None:
+                self._archive(*self._held)
+            self._archive(stamp, value)
+            self._held = None
+            self._upperSlope = None
+            self._lowerSlope = None
+            return
+
+        self._openDoor(stamp, value)
+
+        # Once the doors are parallel the held sample is the last point the line could pass through
+        if self._lowerSlope > self._upperSlope and self._held is not None:
+            self._archive(*self._held)
+            self._upperSlope = None
+            self._lowerSlope = None
+            self._openDoor(stamp, value)
 
-    def record(self, time, value):
-        self.records.append((self.id, time, value))
+        self._held = (stamp, value)
@@ -1,7 +1,17 @@
 from .Singleton import *
+from .Metrics import *
 from .Daemon import *
 from .Database import *
 from .Source import *
 from .Tag import *
+from .SampleBuffer import *
+from .ReadBatch import *
+from .ScanClass import *
+from .Rollup import *
+from .StoreRows import *
+from .StoreChunks import *
+from .StoreSegments import *
 from .Store import *
 from .Logger import *
+from .Stage import *
+from .SourceWorker import *
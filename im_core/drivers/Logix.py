@@ -1,10 +1,17 @@
+import os
 import re
-from collections import OrderedDict
-from datetime import datetime
+from collections import OrderedDict, deque
 import time
 import atexit
-from pycomm3 import LogixDriver, CommError
+import hashlib
+import json
+import pickle
+from pathlib import Path
+import im_core.drivers
+from pycomm3 import LogixDriver, CommError, Services
 from multiprocessing.pool import ThreadPool
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from im_core.helpers import *
 import im_core.classes
 
@@ -17,154 +24,318 @@ class Logix:
         self.logger = im_core.classes.Logger()
 
         # Ignore & whitelist removes many tags we typically are not interested in
-        self.tagIgnoreRegex = [re.compile(r"^R.*_S.*_"), re.compile(r"^R.*_.*:.*"), re.compile(r"^raC.*")]
-        self.propIgnoreRegex = [re.compile(r"__BitHost.*"), re.compile(r"Cfg_.*"), re.compile(r"PCmd.*"),
-                                re.compile(r"MCmd.*"), re.compile(r"Nrdy_.*"), re.compile(r"Rdy_.*"),
-                                re.compile(r"Inp_.*"), re.compile(r"OCmd_.*"), re.compile(r"SrcQ.*"),
-                                re.compile(r"Err_.*"), re.compile(r"Wrk_.*"), re.compile(r"Inf_.*"),
-                                re.compile(r"PSet_.*"), re.compile(r"MSet_.*"), re.compile(r"OSet_.*"),
-                                re.compile(r"Set_.*"), re.compile(r"Out_.*"), re.compile(r"Ack_.*"),
-                                re.compile(r"P_.*"), re.compile(r"ZZZZZZZZZZ.*")]
-        self.dataTypeWhitelist = ['DINT', 'SINT', 'DWORD', 'REAL', 'INT', 'BOOL']
+        self.tagIgnoreRegex = re.compile(r"R.*_S.*_|R.*_.*:.*|raC.*")
+        self.propIgnoreRegex = re.compile(r"__BitHost|Cfg_|PCmd|MCmd|Nrdy_|Rdy_|Inp_|OCmd_|SrcQ|Err_|Wrk_|Inf_|"
+                                          r"PSet_|MSet_|OSet_|Set_|Out_|Ack_|P_|ZZZZZZZZZZ")
+        self.dataTypeWhitelist = {'DINT', 'SINT', 'DWORD', 'REAL', 'INT', 'BOOL'}
+
+        # Discovery results are cached on disk per source and reused while the controller program is unchanged
+        self._cachePath = (os.environ.get('DATA_PATH') or str(Path(__file__).parents[1]) + '/data') + '/tags_' + str(self.id) + '.pickle'
+        self._cache = {}
+        self._pendingCache = None
+        self._signature = None
+        self._cacheValid = False
+        self._discovered = False
 
         # Ordered dicts to maintain order
         self.discoveredTags = OrderedDict()
+        self.changedTags = OrderedDict()
         self.monitoringTags = OrderedDict()
+        self.scanClasses = OrderedDict()
+        self.requestRate = 0.0
+
+        # Metrics, per source children are resolved once so the poll path only observes
+        metrics = im_core.classes.Metrics()
+        self._readSeconds = metrics.histogram('imcore_plc_read_seconds', 'Latency of PLC read requests per chunk', ('source',)).labels(str(self.id))
+        self._scanSeconds = metrics.histogram('imcore_scan_cycle_seconds', 'Duration of scan class cycles', ('source', 'scan_class'))
+        self._tagsRead = metrics.counter('imcore_tags_read_total', 'Tag values read from the PLC', ('source',)).labels(str(self.id))
+        self._invalidValues = metrics.counter('imcore_invalid_values_total', 'Tag values rejected as invalid', ('source',)).labels(str(self.id))
+        self._readErrors = metrics.counter('imcore_plc_read_errors_total', 'PLC read requests that failed', ('source',)).labels(str(self.id))
 
-        # Setup
+        # Setup, with per phase timings for startup reporting
+        self.timings = OrderedDict()
         self._initialize()
+        start = time.time()
         self.discoverTags()
+        self.timings['discover'] = time.time() - start
 
         # Close all of the open connections on program exit
         atexit.register(self._close)
 
     def _initialize(self):
         # Initialize
+        self.threads = int(os.environ.get('LOGIX_MAX_CONNECTIONS', 20))
+        self.tagsPerRequest = 1000
+        self.coalesce = os.environ.get('LOGIX_COALESCE', '1').lower() not in ('0', 'false', 'no')
+        self.coalesceGap = int(os.environ.get('LOGIX_COALESCE_GAP', 8))
+        self.defaultScanRate = float(os.environ.get('POLL_TIME'))
+
+        while True:
+            commPool = None
+            self.comm = None
+
+            try:
+                # The pool connections open in parallel with the tag upload, they receive the tag list once it is known
+                with ThreadPoolExecutor(1) as executor:
+                    start = time.time()
+                    commPool = executor.submit(
+                        im_core.drivers.LogixConnectionPool,
+                        self.id,
+                        self.address,
+                        {},
+                        int(os.environ.get('LOGIX_MIN_CONNECTIONS', 2)),
+                        self.threads,
+                        float(os.environ.get('LOGIX_RECONNECT_MAX', 60))
+                    )
+
+                    self.comm = LogixDriver(self.address, init_tags=False)
+                    self.comm.open()
+                    self.timings['connect'] = time.time() - start
+
+                    self._loadTagDefinitions()
+                    self.timings['definitions'] = time.time() - start - self.timings['connect']
+
+                    self.commPool = commPool.result()
+                    self.commPool.setTags(self.comm.tags)
+                break
+            except CommError:
+                self.logger.write('Communication error while initializing PLC driver for source with id ' + str(self.id) + '... trying again in 5 seconds', 'danger')
+
+                # The attempt's pool and connection are closed, otherwise the pool's opener keeps reconnecting for nothing
+                if commPool is not None and commPool.exception() is None:
+                    commPool.result().close()
+
+                try:
+                    if self.comm is not None:
+                        self.comm.close()
+                except CommError:
+                    pass
+
+                time.sleep(5)
+
+        # Long lived readers and connections, both are reused by every poll
+        self.workers = ThreadPool(self.threads)
+        self.scanners = ThreadPool(int(os.environ.get('LOGIX_SCAN_THREADS', 4)))
+
+    def _programSignature(self):
+        # The controller object's change counters move on every program download or online edit
         try:
-            self.comm = LogixDriver(self.address)
-            self.comm.open()
-            self.commStack = []
-            self.threads = 20
-            self.tagsPerRequest = 1000
-
-            i = 0
-            while i < self.threads:
-                comm = LogixDriver(self.address, init_tags=False)
-                comm._tags = self.comm.tags
-                comm.open()
-                self.commStack.append(comm)
-                i += 1
-        except CommError:
-            self.logger.write('Communication error while initializing PLC driver for source with id ' + str(self.id) + '... trying again in 5 seconds', 'danger')
-            time.sleep(5)
-            self._initialize()
+            response = self.comm.generic_message(
+                service=Services.get_attribute_list,
+                class_code=b'\xac',
+                instance=1,
+                request_data=b'\x04\x00\x01\x00\x02\x00\x03\x00\x04\x00',
+                name='program_signature'
+            )
+        except Exception:
+            return None
 
-    def discoverTags(self):
-        def get_tags(g_tag, g_obj, dim=0, dimensions=None):
-            for prop, sub_obj in g_obj.items():
-                hasPropIgnore = any(regex.match(prop) for regex in self.propIgnoreRegex)
+        if not response or response.error or not response.value:
+            return None
 
-                if hasPropIgnore or sub_obj['data_type_name'] not in self.dataTypeWhitelist:
-                    continue
-                else:
-                    g_i = 0
-                    if dim > 0:
-                        for g_d in dimensions:
-                            if g_d > 0:
-                                while g_d > g_i:
-                                    self.discoveredTags[g_tag + '[' + str(g_i) + ']' + '.' + prop] = sub_obj[
-                                        'data_type_name']
-
-                                    if isinstance(sub_obj['data_type'], dict):
-                                        get_tags(g_tag + '[' + str(g_i) + ']' + '.' + prop,
-                                                 sub_obj['data_type']['internal_tags'])
-                                    g_i += 1
-                    else:
-                        self.discoveredTags[g_tag + '.' + prop] = sub_obj['data_type_name']
-
-                        if isinstance(sub_obj['data_type'], dict):
-                            get_tags(g_tag + '.' + prop, sub_obj['data_type']['internal_tags'], dim, dimensions)
-
-        # TODO: What if new tag is added while daemon is already running?
-        tags_json = self.comm.tags_json
-
-        for tag_name, obj in tags_json.items():
-            if any(regex.match(tag_name) for regex in self.tagIgnoreRegex):
+        info = self.comm.info
+        identity = str(info.get('serial')) + str(info.get('revision')) + str(info.get('name'))
+        return hashlib.sha1(identity.encode() + bytes(response.value)).hexdigest()
+
+    def _readDiscoveryCache(self):
+        try:
+            with open(self._cachePath, 'rb') as file:
+                return pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return {}
+
+    def saveDiscoveryCache(self):
+        if self._pendingCache is None:
+            return
+
+        try:
+            data = pickle.dumps(self._pendingCache)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            # Tag definitions that cannot be pickled still leave the discovery results worth caching
+            self._pendingCache = {key: val for key, val in self._pendingCache.items() if key not in ('tags', 'dataTypes')}
+            data = pickle.dumps(self._pendingCache)
+
+        # The cloud already has the tags, a cache that cannot be written only costs a full discovery on the next start
+        try:
+            with open(self._cachePath + '.tmp', 'wb') as file:
+                file.write(data)
+            os.replace(self._cachePath + '.tmp', self._cachePath)
+        except OSError as e:
+            self.logger.write('Failed to write the tag discovery cache for source with id ' + str(self.id) + '... ' + str(e), 'warning')
+
+        self._cache = self._pendingCache
+        self._pendingCache = None
+
+    def _loadTagDefinitions(self):
+        self._cache = self._readDiscoveryCache()
+        self._signature = self._programSignature()
+        self._cacheValid = self._signature is not None and self._cache.get('signature') == self._signature and 'tags' in self._cache
+
+        if self._cacheValid:
+            self.comm._tags = self._cache['tags']
+            self.comm._data_types = self._cache['dataTypes']
+            self.logger.write('Controller program unchanged for source with id ' + str(self.id) + ', using cached tag definitions...', 'info')
+        else:
+            self.comm.get_tag_list(program='*')
+
+    def _walkTags(self, tagsJson):
+        discoveredTags = OrderedDict()
+        work = deque()
+
+        for tag_name, obj in tagsJson.items():
+            if self.tagIgnoreRegex.match(tag_name):
                 continue
+            elif isinstance(obj['data_type'], dict):
+                work.append((tag_name, obj['data_type']['internal_tags'], max(obj['dimensions']) if obj['dim'] > 0 else 0))
+            elif obj['dim'] > 0:
+                for i in range(max(obj['dimensions'])):
+                    discoveredTags[tag_name + '[' + str(i) + ']'] = obj['data_type_name']
             else:
-                if isinstance(obj['data_type'], dict):
-                    get_tags(tag_name, obj['data_type']['internal_tags'], obj['dim'], obj['dimensions'])
-                elif obj['dim'] > 0:
-                    for d in obj['dimensions']:
-                        i = 0
-                        if d > 0:
-                            while d > i:
-                                self.discoveredTags[tag_name + '[' + str(i) + ']'] = obj['data_type_name']
-                                i += 1
-                else:
-                    self.discoveredTags[tag_name] = obj['data_type_name']
-
-    def _getMonitoringTagNamesAsList(self):
-        tagNamesList = []
-        for tag in self.monitoringTags.values():
-            tagNamesList.append(tag.name)
-        return tagNamesList
+                discoveredTags[tag_name] = obj['data_type_name']
+
+        # Structures are walked iteratively, array element prefixes are built once per structure
+        while work:
+            prefix, members, count = work.popleft()
+            prefixes = [prefix + '[' + str(i) + ']' for i in range(count)] if count > 0 else [prefix]
+
+            for prop, sub_obj in members.items():
+                if sub_obj['data_type_name'] not in self.dataTypeWhitelist or self.propIgnoreRegex.match(prop):
+                    continue
+
+                nested = sub_obj['data_type']['internal_tags'] if isinstance(sub_obj['data_type'], dict) else None
+
+                for element in prefixes:
+                    name = element + '.' + prop
+                    discoveredTags[name] = sub_obj['data_type_name']
+
+                    if nested is not None:
+                        work.append((name, nested, 0))
+
+        return discoveredTags
+
+    def discoverTags(self):
+        # Later discoveries re-check the controller and only upload the tag list again if its program changed
+        if self._discovered:
+            signature = self._programSignature()
+
+            if signature is None or signature != self._signature:
+                self.comm.get_tag_list(program='*')
+                self.commPool.setTags(self.comm.tags)
+                self._signature = signature
+                self._cacheValid = False
+
+        if self._cacheValid:
+            tagsHash = self._cache.get('tagsHash')
+            discoveredTags = self._cache['discoveredTags']
+        else:
+            tagsJson = self.comm.tags_json
+            tagsHash = hashlib.sha1(json.dumps(tagsJson, sort_keys=True, default=str).encode()).hexdigest()
+
+            if self._cache.get('tagsHash') == tagsHash:
+                discoveredTags = self._cache['discoveredTags']
+            else:
+                discoveredTags = self._walkTags(tagsJson)
+
+        # Only tags that are new or changed type since the last cached discovery need to reach the cloud
+        previous = self._cache.get('discoveredTags', {})
+        self.changedTags = OrderedDict((name, dataType) for name, dataType in discoveredTags.items() if previous.get(name) != dataType)
+        self.discoveredTags = discoveredTags
+        self._pendingCache = {
+            'signature': self._signature,
+            'tagsHash': tagsHash,
+            'tags': self.comm.tags,
+            'dataTypes': self.comm.data_types,
+            'discoveredTags': discoveredTags
+        }
+        self._discovered = True
 
     def _close(self):
+        self.scanners.terminate()
+        self.workers.terminate()
+
         try:
-            for comm in self.commStack:
-                comm.close()
+            self.commPool.close()
+            self.comm.close()
         except CommError:
             self.logger.write('Failed to close the connection to the PLC on exit for source with id ' + str(self.id), 'danger')
 
-
     def _read(self, tags):
-        tagValues = []
-        comm = None
+        start = time.perf_counter()
 
         try:
-            comm = self.commStack.pop()
-            tagValues = comm.read(*tags)
+            tagValues = self.commPool.read(tags)
+            self._readSeconds.observe(time.perf_counter() - start)
         except CommError:
+            self._readErrors.inc()
             self.logger.write('Communication error while reading from the PLC for source with id ' + str(self.id) + '... is it offline?', 'danger')
-        finally:
-            self.commStack.append(comm)
+            return []
+
+        # Pycomm returns a list of objects when tags to read are >1 in a single poll
+        # When tags to read equals 1, Pycomm returns a single object
+        if isinstance(tagValues, list):
+            return tagValues
+        return [tagValues]
 
-        return tagValues
+    def setMonitoringTags(self, monitoringTags):
+        groups = OrderedDict()
+
+        for name, tag in monitoringTags.items():
+            groups.setdefault(tag.scanRate or self.defaultScanRate, OrderedDict())[name] = tag
+
+        # Existing scan classes keep their schedule and counters when their rate is still in use
+        scanClasses = OrderedDict()
+        requestRate = 0.0
+
+        # Group reads are sized from the tag definitions and have to fit the connection's packets
+        sizeOf = partial(tagSize, definitions=self.comm.tags)
+
+        for rate in sorted(groups.keys()):
+            scanClass = self.scanClasses.get(rate) or im_core.classes.ScanClass(rate)
+            scanClass.plan(groups[rate], self.tagsPerRequest, self.coalesce, self.coalesceGap, sizeOf, self.comm.connection_size)
+            scanClasses[rate] = scanClass
+            requestRate += len(scanClass.readPlan[1]) / (rate * 0.8)
+
+        self.monitoringTags = monitoringTags
+        self.scanClasses = scanClasses
+        self.requestRate = requestRate
 
     def poll(self):
-        polledTags = []
-        tags = self._getMonitoringTagNamesAsList()
-
-        if len(tags) > 0:
-            # Decide if we should run multiple threads to get the results faster
-            if len(tags) > self.tagsPerRequest:
-                pool = ThreadPool(self.threads)
-                chunks = chunkArray(tags, self.tagsPerRequest)
-
-                for chunk in chunks:
-                    polledTags.append(pool.apply_async(self._read, args=(chunk,)))
-
-                pool.close()
-                pool.join()
-                polledTags = [r.get() for r in polledTags]
-
-                now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-                for thread in polledTags:
-                    # Pycomm returns a list of objects when tags to read are >1 in a single poll
-                    # When tags to read equals 1, Pycomm returns a single object
-                    # Therefore, we do this additional check incase len(tags) - self.tagsPerRequest = 1
-                    if isinstance(thread, list):
-                        for result in thread:
-                            if isValidValue(result.value):
-                                self.monitoringTags[result.tag].record(now, result.value)
-                    else:
-                        if isValidValue(thread.value):
-                            self.monitoringTags[thread.tag].record(now, thread.value)
+        # Size the connection pool for the read requests per second and the measured round trip time
+        self.commPool.resize(self.commPool.targetSize(self.requestRate))
+
+        now = time.monotonic()
+
+        for scanClass in list(self.scanClasses.values()):
+            if scanClass.due(now):
+                scanClass.busy = True
+                self.scanners.apply_async(self._pollScanClass, (scanClass,))
+
+    def _pollScanClass(self, scanClass):
+        start = time.perf_counter()
+        tagsRead = 0
+        invalid = 0
+
+        try:
+            batches = scanClass.readPlan[1]
+
+            if len(batches) > 1:
+                polledTags = self.workers.map(self._read, [batch.names for batch in batches])
+            elif len(batches) == 1:
+                polledTags = [self._read(batches[0].names)]
             else:
-                now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                polledTags = self._read(tags)
-                for result in polledTags:
-                    if isValidValue(result.value):
-                        self.monitoringTags[result.tag].record(now, result.value)
+                polledTags = []
+
+            # One stamp per read batch, in epoch milliseconds
+            stamp = epochMillis()
+
+            for batch, results in zip(batches, polledTags):
+                tagsRead += len(batch) if len(results) > 0 else 0
+                invalid += batch.record(stamp, results)
+        except Exception as e:
+            self.logger.write('Failed to poll scan class ' + str(scanClass.rate) + 's for source with id ' + str(self.id) + '... ' + str(e), 'danger')
+        finally:
+            duration = time.perf_counter() - start
+            scanClass.finish(duration, tagsRead)
+            self._scanSeconds.labels(str(self.id), str(scanClass.rate)).observe(duration)
+            self._tagsRead.inc(tagsRead)
+            self._invalidValues.inc(invalid)
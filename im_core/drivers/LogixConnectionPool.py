@@ -0,0 +1,197 @@
+import math
+import queue
+import threading
+import time
+from pycomm3 import LogixDriver, CommError
+import im_core.classes
+
+
+class LogixConnectionPool:
+    def __init__(self, sid, address, tags, minSize=2, maxSize=20, maxBackoff=60.0):
+        # Settings
+        self.id = sid
+        self.address = address
+        self.tags = tags
+        self.minSize = max(1, minSize)
+        self.maxSize = max(self.minSize, maxSize)
+        self.maxBackoff = maxBackoff
+        self.logger = im_core.classes.Logger()
+
+        # Connections
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.target = self.minSize
+
+        # Reconnect backoff
+        self._backoff = 0.0
+        self._retryAt = 0.0
+
+        # Statistics
+        self.inUse = 0
+        self.reconnects = 0
+        self.failures = 0
+        self.rtt = 0.0
+
+        # Missing connections are opened by one long lived thread, resizing only wakes it up
+        self._wake = threading.Event()
+        self._closed = False
+        self._opener = threading.Thread(target=self._fill, name='logix-open-' + str(sid), daemon=True)
+        self._opener.start()
+
+        self.resize(self.minSize)
+
+    def _open(self):
+        comm = LogixDriver(self.address, init_tags=False)
+        comm._tags = self.tags
+        comm.open()
+        return comm
+
+    def _tryOpen(self):
+        # Only one connection attempt at a time while the PLC is failing, and never before the backoff expired
+        with self._lock:
+            if self.size >= self.target or time.time() < self._retryAt:
+                return None
+            self.size += 1
+
+        try:
+            comm = self._open()
+        except CommError:
+            with self._lock:
+                self.size -= 1
+                self.failures += 1
+
+                # Attempts that fail together only back off once
+                if time.time() >= self._retryAt:
+                    self._backoff = min(self.maxBackoff, self._backoff * 2 if self._backoff else 1.0)
+                    self._retryAt = time.time() + self._backoff
+                backoff = self._backoff
+
+            self.logger.write('Failed to open a connection to the PLC for source with id ' + str(self.id) + '... retrying in ' + str(backoff) + 's', 'danger')
+            return None
+
+        with self._lock:
+            reconnected = self._backoff > 0
+            self._backoff = 0.0
+            self._retryAt = 0.0
+
+        if reconnected:
+            self.reconnects += 1
+            self.logger.write('Reconnected to the PLC for source with id ' + str(self.id) + '...', 'success')
+
+        return comm
+
+    def _fill(self):
+        while not self._closed:
+            self._wake.wait()
+            self._wake.clear()
+
+            while not self._closed and self.size < self.target:
+                # While the PLC is failing the next attempt waits out the backoff
+                wait = self._retryAt - time.time()
+
+                if wait > 0:
+                    time.sleep(wait)
+                    continue
+
+                comm = self._tryOpen()
+
+                if comm is not None and self._closed:
+                    self._discard(comm)
+                elif comm is not None:
+                    self._idle.put(comm)
+
+    def _discard(self, comm):
+        with self._lock:
+            self.size -= 1
+
+        try:
+            comm.close()
+        except Exception:
+            pass
+
+    def setTags(self, tags):
+        # Connections pick up a new tag list as they are next handed out
+        self.tags = tags
+
+    def targetSize(self, requestRate):
+        # Enough connections to serve the read requests per second at the measured round trip time
+        if self.rtt <= 0:
+            return self.target
+
+        return min(self.maxSize, max(self.minSize, math.ceil(requestRate * self.rtt)))
+
+    def resize(self, target):
+        self.target = min(self.maxSize, max(self.minSize, target))
+
+        # Called every poll tick, it never waits on the PLC
+        if self.size < self.target:
+            self._wake.set()
+
+        while self.size > self.target:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    def acquire(self, timeout=5.0):
+        try:
+            comm = self._idle.get_nowait()
+        except queue.Empty:
+            comm = self._tryOpen()
+
+            if comm is None:
+                if self.size == 0:
+                    raise CommError('No connection to the PLC could be opened')
+
+                try:
+                    comm = self._idle.get(timeout=timeout)
+                except queue.Empty:
+                    raise CommError('Timed out waiting for a PLC connection')
+
+        # Health check, a dropped connection is replaced instead of being handed out
+        if not comm.connected:
+            self._discard(comm)
+            return self.acquire(timeout)
+
+        comm._tags = self.tags
+
+        with self._lock:
+            self.inUse += 1
+
+        return comm
+
+    def release(self, comm, healthy=True):
+        with self._lock:
+            self.inUse -= 1
+
+        if healthy:
+            self._idle.put(comm)
+        else:
+            self._discard(comm)
+
+    def read(self, tags):
+        comm = self.acquire()
+        start = time.perf_counter()
+
+        try:
+            values = comm.read(*tags)
+        except Exception:
+            self.release(comm, False)
+            raise
+
+        rtt = time.perf_counter() - start
+        self.rtt = rtt if self.rtt == 0 else 0.8 * self.rtt + 0.2 * rtt
+        self.release(comm)
+
+        return values
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
@@ -1,45 +1,218 @@
+import io
+import re
+import select
+from psycopg2 import Error, InterfaceError, OperationalError
 from psycopg2.pool import ThreadedConnectionPool
-from psycopg2.extras import DictCursor
+from psycopg2.extensions import connection
+from psycopg2.extras import DictCursor, execute_values, execute_batch
 import atexit
+import threading
+from contextlib import contextmanager
+from functools import partial
+from im_core.helpers import encodeCopy
+
+
+class PreparingConnection(connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Server side prepared statements only live as long as the connection they were prepared on
+        self.prepared = set()
 
 
 class PostGres:
-    def __init__(self, db_host, db_port, db_database, db_username, db_password):
+    placeholderPattern = re.compile(r'%s')
+
+    def __init__(self, db_host, db_port, db_database, db_username, db_password, statement_timeout=0, connect_timeout=10):
+        # A statement running longer than the timeout is cancelled by the server, 0 leaves it off
         self.connectionPool = ThreadedConnectionPool(
-            5,  # Minimum connections in pool
+            0,  # Nothing is opened here, so a daemon starting offline is not held up
             20,  # Maximum connections in pool
             host=db_host,
             port=db_port,
             user=db_username,
             password=db_password,
             database=db_database,
-            cursor_factory=DictCursor
+            cursor_factory=DictCursor,
+            connection_factory=PreparingConnection,
+            connect_timeout=connect_timeout,
+            options='-c statement_timeout=' + str(int(statement_timeout * 1000))
         )
 
+        # Connections checked out and kept idle, counted here since the pool keeps its own bookkeeping private
+        self._countLock = threading.Lock()
+        self._inUse = 0
+        self._idle = 0
+
+        # Up to 5 connections are kept once opened, the pool is filled up front when the cloud is reachable
+        self.connectionPool.minconn = 5
+        self._warm()
+
         # Close all of the database connections on program exit
         atexit.register(self._close)
 
+    def _warm(self):
+        conns = []
+
+        try:
+            while len(conns) < self.connectionPool.minconn:
+                conns.append(self._getconn())
+        except OperationalError:
+            pass
+        finally:
+            for conn in conns:
+                self._putconn(conn)
+
+    def _getconn(self):
+        conn = self.connectionPool.getconn()
+
+        with self._countLock:
+            self._inUse += 1
+            self._idle = max(0, self._idle - 1)
+
+        return conn
+
+    def _putconn(self, conn, close=False):
+        # The pool keeps up to minconn connections and closes the rest
+        with self._countLock:
+            self._inUse -= 1
+
+            if not close and not conn.closed and self._idle < self.connectionPool.minconn:
+                self._idle += 1
+
+        self.connectionPool.putconn(conn, close=close)
+
     def _close(self):
         self.connectionPool.closeall()
 
+    def usage(self):
+        # Connections checked out and idle in the pool
+        with self._countLock:
+            return self._inUse, self._idle
+
+    @contextmanager
+    def cursor(self):
+        conn = self._getconn()
+        conn.autocommit = True
+
+        try:
+            with conn.cursor() as cursor:
+                yield cursor
+        finally:
+            self._putconn(conn)
+
+    @staticmethod
+    def _result(cursor):
+        # Statements that return rows hand them back, everything else reports success
+        if cursor.description is not None:
+            return cursor.fetchall()
+        return True
+
     def execute(self, query, values=None):
-        conn = self.connectionPool.getconn()
+        with self.cursor() as cursor:
+            cursor.execute(query, values)
+            return self._result(cursor)
+
+    def executePrepared(self, name, query, values=None):
+        # Recurring statements are parsed and planned once per connection
+        with self.cursor() as cursor:
+            if name not in cursor.connection.prepared:
+                count = iter(range(1, query.count('%s') + 1))
+                cursor.execute('PREPARE ' + name + ' AS ' + self.placeholderPattern.sub(lambda match: '$' + str(next(count)), query))
+                cursor.connection.prepared.add(name)
+
+            if values:
+                cursor.execute('EXECUTE ' + name + ' (' + ', '.join(['%s'] * len(values)) + ')', values)
+            else:
+                cursor.execute('EXECUTE ' + name)
+
+            return self._result(cursor)
+
+    def executeValues(self, query, values, pageSize=1000, template=None):
+        with self.cursor() as cursor:
+            execute_values(cursor, query, values, template=template, page_size=pageSize)
+            return True
+
+    def executeMany(self, query, values, pageSize=1000):
+        # Statements are sent pageSize at a time instead of one round trip per row
+        with self.cursor() as cursor:
+            execute_batch(cursor, query, values, page_size=pageSize)
+            return True
+
+    @contextmanager
+    def transaction(self):
+        conn = self._getconn()
+
+        try:
+            conn.autocommit = False
+
+            with conn.cursor() as cursor:
+                yield cursor
+            conn.commit()
+        except Exception as e:
+            # Rolling back a connection the server dropped raises as well, the transaction is gone with it anyway
+            try:
+                conn.rollback()
+            except Error:
+                pass
+
+            # A lost connection is reported as OperationalError, the error callers retry on, whatever psycopg2 raised
+            if conn.closed and isinstance(e, Error) and not isinstance(e, OperationalError):
+                raise OperationalError('Connection lost during transaction: ' + str(e).strip()) from e
+            raise
+        finally:
+            try:
+                conn.autocommit = True
+            except InterfaceError:
+                pass
+
+            # A closed connection is discarded, the pool slot it held is always given back
+            self._putconn(conn, close=conn.closed != 0)
+
+    @contextmanager
+    def listen(self, channel):
+        # One pooled connection is held in LISTEN mode for as long as the caller waits on it
+        conn = self._getconn()
         conn.autocommit = True
 
         try:
             with conn.cursor() as cursor:
-                if "INSERT" in query:
-                    cursor.execute(query, values)
-                    return True
-                elif "SELECT" in query:
-                    cursor.execute(query, values)
-                    rows = cursor.fetchall()
-                    return rows
-                elif "UPDATE" in query:
-                    cursor.execute(query, values)
-                    return True
-                else:
-                    print("Query is not allowed")
+                cursor.execute('LISTEN ' + channel)
+
+            yield partial(self._notifications, conn)
         finally:
-            cursor.close()
-            self.connectionPool.putconn(conn)
+            # Closed instead of returned, so no other caller inherits the subscription
+            self._putconn(conn, close=True)
+
+    @staticmethod
+    def _notifications(conn, timeout):
+        # Waits up to timeout for notifications and returns them as (channel, payload)
+        if len(conn.notifies) == 0 and select.select([conn], [], [], timeout) == ([], [], []):
+            # Nothing arrived, a round trip makes sure the connection is still there
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+
+        conn.poll()
+        notifications = [(notify.channel, notify.payload) for notify in conn.notifies]
+        conn.notifies.clear()
+        return notifications
+
+    def copyMerge(self, staging, columns, values, mergeQuery, mergeValues=None, pageSize=100000):
+        # Columns are (name, type), rows are streamed into a temporary table with binary COPY and merged server side
+        names = [name for name, columnType in columns]
+        types = [columnType for name, columnType in columns]
+        values = iter(values)
+
+        with self.transaction() as cursor:
+            cursor.execute('CREATE TEMP TABLE ' + staging + ' (' + ', '.join(name + ' ' + columnType for name, columnType in columns) + ') ON COMMIT DROP')
+
+            while True:
+                page = [row for _, row in zip(range(pageSize), values)]
+
+                if len(page) == 0:
+                    break
+
+                cursor.copy_expert('COPY ' + staging + ' (' + ', '.join(names) + ') FROM STDIN WITH (FORMAT binary)', io.BytesIO(encodeCopy(page, types)))
+
+            cursor.execute(mergeQuery, mergeValues)
+            return cursor.rowcount
@@ -1,2 +1,3 @@
+from .LogixConnectionPool import *
 from .Logix import *
 from .PostGres import *
@@ -1,2 +1,8 @@
 from .isValidValue import isValidValue
 from .chunkArray import chunkArray
+from .epochMillis import epochMillis
+from .encodeChunk import encodeChunk
+from .decodeChunk import decodeChunk
+from .planReads import planReads
+from .encodeCopy import encodeCopy
+from .tagSize import tagSize
@@ -0,0 +1,53 @@
+import struct
+from array import array
+
+
+# Inverse of encodeChunk, returns the stamps and values of a chunk as two lists
+def decodeChunk(data):
+    count, stamp, previousBits = struct.unpack_from('<IqQ', data)
+    body = data[20:]
+    stream = bin(int.from_bytes(body, 'big'))[2:].zfill(len(body) * 8) if len(body) > 0 else ''
+
+    stamps = [stamp]
+    bits = array('Q', [previousBits])
+    delta = 0
+    leading = 0
+    trailing = 0
+    pos = 0
+
+    for _ in range(1, count):
+        if stream[pos] == '0':
+            pos += 1
+        elif stream[pos + 1] == '0':
+            delta += int(stream[pos + 2:pos + 9], 2) - 63
+            pos += 9
+        elif stream[pos + 2] == '0':
+            delta += int(stream[pos + 3:pos + 12], 2) - 255
+            pos += 12
+        elif stream[pos + 3] == '0':
+            delta += int(stream[pos + 4:pos + 16], 2) - 2047
+            pos += 16
+        else:
+            delta += int(stream[pos + 4:pos + 68], 2) - (1 << 63)
+            pos += 68
+
+        stamp += delta
+        stamps.append(stamp)
+
+        if stream[pos] == '0':
+            pos += 1
+        else:
+            if stream[pos + 1] == '1':
+                leading = int(stream[pos + 2:pos + 7], 2)
+                trailing = 64 - leading - int(stream[pos + 7:pos + 13], 2) - 1
+                pos += 13
+            else:
+                pos += 2
+
+            length = 64 - leading - trailing
+            previousBits ^= int(stream[pos:pos + length], 2) << trailing
+            pos += length
+
+        bits.append(previousBits)
+
+    return stamps, array('d', bits.tobytes()).tolist()
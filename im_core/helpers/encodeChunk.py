@@ -0,0 +1,58 @@
+import struct
+from array import array
+
+
+# Gorilla style chunk, delta-of-delta stamps and XOR'd value bits after a fixed header of count, first stamp and first value
+def encodeChunk(stamps, values):
+    count = len(stamps)
+    bits = array('Q', array('d', values).tobytes())
+    parts = []
+    append = parts.append
+
+    previousStamp = stamps[0]
+    previousDelta = 0
+    previousBits = bits[0]
+    leading = -1
+    trailing = 0
+
+    for i in range(1, count):
+        delta = stamps[i] - previousStamp
+        dod = delta - previousDelta
+        previousStamp = stamps[i]
+        previousDelta = delta
+
+        if dod == 0:
+            append('0')
+        elif -63 <= dod <= 64:
+            append('10' + format(dod + 63, '07b'))
+        elif -255 <= dod <= 256:
+            append('110' + format(dod + 255, '09b'))
+        elif -2047 <= dod <= 2048:
+            append('1110' + format(dod + 2047, '012b'))
+        else:
+            append('1111' + format(dod + (1 << 63), '064b'))
+
+        xor = bits[i] ^ previousBits
+        previousBits = bits[i]
+
+        if xor == 0:
+            append('0')
+            continue
+
+        lead = min(31, 64 - xor.bit_length())
+        trail = (xor & -xor).bit_length() - 1
+
+        # Reuse the previous window while the meaningful bits still fit inside it
+        if leading >= 0 and lead >= leading and trail >= trailing:
+            length = 64 - leading - trailing
+            append('10' + format(xor >> trailing, '0' + str(length) + 'b'))
+        else:
+            leading, trailing = lead, trail
+            length = 64 - lead - trail
+            append('11' + format(lead, '05b') + format(length - 1, '06b') + format(xor >> trail, '0' + str(length) + 'b'))
+
+    stream = ''.join(parts)
+    size = (len(stream) + 7) // 8
+    body = int(stream.ljust(size * 8, '0'), 2).to_bytes(size, 'big') if size > 0 else b''
+
+    return struct.pack('<IqQ', count, stamps[0], bits[0]) + body
@@ -0,0 +1,56 @@
+import struct
+from itertools import chain
+
+copyHeader = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+copyTrailer = struct.pack('>h', -1)
+
+# Binary COPY field layouts, text has no fixed width and is sent as its UTF-8 bytes
+copyFormats = {
+    'SMALLINT': 'h',
+    'INT': 'i',
+    'INTEGER': 'i',
+    'BIGINT': 'q',
+    'REAL': 'f',
+    'DOUBLE PRECISION': 'd',
+    'BOOLEAN': '?',
+    'TEXT': None
+}
+
+
+# Rows in PostgreSQL's binary COPY format, every field is its byte length followed by its big endian value
+def encodeCopy(rows, types):
+    formats = [copyFormats[columnType.upper()] for columnType in types]
+    parts = [copyHeader]
+    append = parts.append
+
+    if None not in formats:
+        # Fixed width rows pack with one precompiled struct, a row with a NULL falls back to the field loop
+        row = struct.Struct('>h' + ''.join('i' + code for code in formats))
+        lengths = [struct.calcsize(code) for code in formats]
+
+        for values in rows:
+            try:
+                append(row.pack(len(formats), *chain.from_iterable(zip(lengths, values))))
+            except struct.error:
+                append(_encodeRow(values, formats))
+    else:
+        for values in rows:
+            append(_encodeRow(values, formats))
+
+    append(copyTrailer)
+    return b''.join(parts)
+
+
+def _encodeRow(values, formats):
+    fields = [struct.pack('>h', len(formats))]
+
+    for value, code in zip(values, formats):
+        if value is None:
+            fields.append(struct.pack('>i', -1))
+        elif code is None:
+            data = str(value).encode()
+            fields.append(struct.pack('>i', len(data)) + data)
+        else:
+            fields.append(struct.pack('>i' + code, struct.calcsize(code), value))
+
+    return b''.join(fields)
@@ -0,0 +1,32 @@
+import time
+import threading
+
+_lock = threading.Lock()
+_offset = time.time() - time.monotonic()
+_last = 0
+_lastMonotonic = time.monotonic()
+
+# Stamps follow a clock stepped back at this share of real time slower, until they are within a second of it again
+_slewRate = 0.5
+
+
+# Stamps advance with the monotonic clock, anchored to the wall clock. A step forward of more than a second is followed
+# at once, a step back is slewed so stamps keep advancing instead of repeating
+def epochMillis():
+    global _offset, _last, _lastMonotonic
+
+    with _lock:
+        now = time.monotonic()
+        drift = time.time() - now - _offset
+
+        if drift > 1.0:
+            _offset += drift
+        elif drift < -1.0:
+            _offset -= min(-drift, (now - _lastMonotonic) * _slewRate)
+
+        _lastMonotonic = now
+
+        # Several threads stamp samples, none of them ever gets a stamp older than one already handed out
+        stamp = max(int((now + _offset) * 1000), _last)
+        _last = stamp
+        return stamp
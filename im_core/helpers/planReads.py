@@ -0,0 +1,98 @@
+import re
+from collections import OrderedDict
+
+rootPattern = re.compile(r'(?:Program:[^.]+\.)?[^.\[]+')
+stepPattern = re.compile(r'\[(\d+)\]|\.([^.\[]+)')
+
+# Bytes a read costs besides its name and value, request and reply header in a multiple service packet
+requestOverhead = 16
+
+
+def _parse(name):
+    # A tag name is its root followed by array indices and member names
+    root = rootPattern.match(name)
+
+    if root is None:
+        return None, []
+
+    steps = []
+    position = root.end()
+
+    while position < len(name):
+        step = stepPattern.match(name, position)
+
+        if step is None:
+            return None, []
+
+        steps.append(int(step.group(1)) if step.group(1) is not None else step.group(2))
+        position = step.end()
+
+    return root.group(0), steps
+
+
+def _pays(request, size, names, sizeOf, packetLimit):
+    # A group read has to fit one reply and cost fewer bytes than reading its names one by one
+    if sizeOf is None:
+        return True
+
+    sizes = [sizeOf(name) for name in names]
+
+    if size is None or None in sizes or (packetLimit is not None and size > packetLimit):
+        return False
+
+    return len(request) + requestOverhead + size <= sum(len(name) + requestOverhead for name in names) + sum(sizes)
+
+
+def planReads(names, maxGap=8, minGroup=2, sizeOf=None, packetLimit=None):
+    # Returns (request, [(position, path)]), the path leads from a request's value to the value of the name at position
+    # sizeOf returns the bytes read for a name or None, without it groups are read whole regardless of size
+    reads = []
+    arrays = OrderedDict()
+    structures = OrderedDict()
+
+    for position, name in enumerate(names):
+        root, steps = _parse(name)
+
+        if root is not None and len(steps) == 1 and isinstance(steps[0], int):
+            arrays.setdefault(root, []).append((steps[0], position, ()))
+        elif root is not None and len(steps) == 2 and isinstance(steps[0], int) and isinstance(steps[1], str):
+            arrays.setdefault(root, []).append((steps[0], position, (steps[1],)))
+        elif root is not None and len(steps) > 0 and isinstance(steps[-1], str):
+            structures.setdefault(name[:name.rindex('.')], []).append((position, steps[-1]))
+        else:
+            reads.append((name, [(position, ())]))
+
+    # Elements of one array are read as ranges, gaps of up to maxGap unmonitored elements are read along
+    for root, elements in arrays.items():
+        elements.sort()
+        runs = [[elements[0]]]
+
+        for element in elements[1:]:
+            if element[0] - runs[-1][-1][0] - 1 <= maxGap:
+                runs[-1].append(element)
+            else:
+                runs.append([element])
+
+        for run in runs:
+            start, end = run[0][0], run[-1][0]
+            element = root + '[' + str(start) + ']'
+            request = element if start == end else element + '{' + str(end - start + 1) + '}'
+
+            size = sizeOf(element) if sizeOf is not None else None
+            grouped = len(run) >= minGroup and _pays(request, size * (end - start + 1) if size is not None else None, [names[position] for index, position, path in run], sizeOf, packetLimit)
+
+            if grouped and start == end:
+                reads.append((request, [(position, path) for index, position, path in run]))
+            elif grouped:
+                reads.append((request, [(position, (index - start,) + path) for index, position, path in run]))
+            else:
+                reads.extend((names[position], [(position, ())]) for index, position, path in run)
+
+    # Members of one structure are read with the whole structure, unless it is large next to the members or the packet
+    for container, members in structures.items():
+        if len(members) >= minGroup and _pays(container, sizeOf(container) if sizeOf is not None else None, [names[position] for position, member in members], sizeOf, packetLimit):
+            reads.append((container, [(position, (member,)) for position, member in members]))
+        else:
+            reads.extend((names[position], [(position, ())]) for position, member in members)
+
+    return reads
@@ -0,0 +1,34 @@
+import math
+from pycomm3.cip.data_types import DataTypes
+from .planReads import _parse
+
+
+def _elementSize(definition):
+    if definition.get('tag_type') == 'struct':
+        return (definition['data_type'].get('template') or {}).get('structure_size')
+
+    dataType = DataTypes.get(definition.get('data_type'))
+    return dataType.size if dataType is not None else None
+
+
+# Bytes the controller returns for a tag name, None when the definitions do not tell
+def tagSize(name, definitions):
+    root, steps = _parse(name)
+    definition = definitions.get(root) if root is not None else None
+
+    if definition is None:
+        return None
+
+    elements = math.prod(dimension for dimension in definition.get('dimensions', ()) if dimension) if definition.get('dim') else 1
+
+    for step in steps:
+        if isinstance(step, int):
+            elements = 1
+        elif definition.get('tag_type') == 'struct' and step in definition['data_type'].get('internal_tags', {}):
+            definition = definition['data_type']['internal_tags'][step]
+            elements = definition.get('array') or 1
+        else:
+            return None
+
+    size = _elementSize(definition)
+    return size * elements if size is not None else None
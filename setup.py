@@ -8,6 +8,6 @@ setup(
     author='Sami Aji',
     author_email='sami@ajility.dev',
     license='MIT',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     zip_safe=False,
 )
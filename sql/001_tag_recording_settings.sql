@@ -0,0 +1,13 @@
+-- Per tag recording settings read by the daemon's monitored tag sync
+-- Every column has a default that matches the daemon's behaviour before these settings existed.
+
+ALTER TABLE tags ADD COLUMN IF NOT EXISTS record_mode TEXT NOT NULL DEFAULT 'all';
+ALTER TABLE tags ADD COLUMN IF NOT EXISTS deadband DOUBLE PRECISION NOT NULL DEFAULT 0;
+ALTER TABLE tags ADD COLUMN IF NOT EXISTS deadband_type TEXT NOT NULL DEFAULT 'absolute';
+ALTER TABLE tags ADD COLUMN IF NOT EXISTS max_interval DOUBLE PRECISION NOT NULL DEFAULT 0;
+
+-- Seconds between reads, NULL polls the tag at the daemon's POLL_TIME
+ALTER TABLE tags ADD COLUMN IF NOT EXISTS scan_rate DOUBLE PRECISION;
+
+-- Tags with raw forwarding off are only sent to the cloud as rollups
+ALTER TABLE tags ADD COLUMN IF NOT EXISTS forward_raw BOOLEAN NOT NULL DEFAULT true;
@@ -0,0 +1,15 @@
+-- Edge rollups forwarded by daemons running with ROLLUP_WINDOWS set
+-- period is the window in seconds, time is the start of the bucket.
+
+CREATE TABLE IF NOT EXISTS rollups (
+    tag_id INT NOT NULL,
+    period INT NOT NULL,
+    time TIMESTAMPTZ NOT NULL,
+    min DOUBLE PRECISION NOT NULL,
+    max DOUBLE PRECISION NOT NULL,
+    avg DOUBLE PRECISION NOT NULL,
+    count INT NOT NULL,
+    first DOUBLE PRECISION NOT NULL,
+    last DOUBLE PRECISION NOT NULL,
+    UNIQUE (tag_id, period, time)
+);
@@ -0,0 +1,70 @@
+-- Configuration change notifications for daemons running with CONFIG_NOTIFY=1
+--
+-- Changes to daemons, sources and tags are sent on the imcore_config channel as '<table>:<id>':
+--   daemons:<daemon id>
+--   sources:<source id>:<daemon id>
+--   tags:<source id>
+-- Postgres delivers identical payloads from one transaction once, so a bulk tag edit notifies each source once.
+-- Heartbeats and tag discovery only touch columns the triggers ignore, they do not notify.
+
+CREATE OR REPLACE FUNCTION imcore_notify_config() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'daemons' THEN
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM pg_notify('imcore_config', 'daemons:' || OLD.id);
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            PERFORM pg_notify('imcore_config', 'daemons:' || NEW.id);
+        END IF;
+    ELSIF TG_TABLE_NAME = 'sources' THEN
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM pg_notify('imcore_config', 'sources:' || OLD.id || ':' || OLD.daemon_id);
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            PERFORM pg_notify('imcore_config', 'sources:' || NEW.id || ':' || NEW.daemon_id);
+        END IF;
+    ELSE
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM pg_notify('imcore_config', 'tags:' || OLD.source_id);
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            PERFORM pg_notify('imcore_config', 'tags:' || NEW.source_id);
+        END IF;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS imcore_notify_config ON daemons;
+CREATE TRIGGER imcore_notify_config
+    AFTER INSERT OR DELETE OR UPDATE OF active, config_key ON daemons
+    FOR EACH ROW EXECUTE PROCEDURE imcore_notify_config();
+
+DROP TRIGGER IF EXISTS imcore_notify_config ON sources;
+CREATE TRIGGER imcore_notify_config
+    AFTER INSERT OR DELETE OR UPDATE OF active, address, driver, daemon_id ON sources
+    FOR EACH ROW EXECUTE PROCEDURE imcore_notify_config();
+
+-- Only monitored tags matter to a daemon, newly discovered tags are inserted unmonitored
+DROP TRIGGER IF EXISTS imcore_notify_config ON tags;
+DROP TRIGGER IF EXISTS imcore_notify_config_insert ON tags;
+DROP TRIGGER IF EXISTS imcore_notify_config_delete ON tags;
+
+CREATE TRIGGER imcore_notify_config
+    AFTER UPDATE OF name, source_id, monitor, record_mode, deadband, deadband_type, max_interval, scan_rate, forward_raw ON tags
+    FOR EACH ROW
+    WHEN (OLD.monitor OR NEW.monitor)
+    EXECUTE PROCEDURE imcore_notify_config();
+
+CREATE TRIGGER imcore_notify_config_insert
+    AFTER INSERT ON tags
+    FOR EACH ROW
+    WHEN (NEW.monitor)
+    EXECUTE PROCEDURE imcore_notify_config();
+
+CREATE TRIGGER imcore_notify_config_delete
+    AFTER DELETE ON tags
+    FOR EACH ROW
+    WHEN (OLD.monitor)
+    EXECUTE PROCEDURE imcore_notify_config();
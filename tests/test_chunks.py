@@ -0,0 +1,76 @@
+import math
+import random
+import struct
+import pytest
+from im_core.helpers import encodeChunk, decodeChunk
+
+
+def bits(values):
+    # Values are compared bit for bit, so NaN and -0.0 count as round tripped only if they come back unchanged
+    return [struct.pack('<d', value) for value in values]
+
+
+def roundTrip(stamps, values):
+    decodedStamps, decodedValues = decodeChunk(encodeChunk(stamps, values))
+    assert decodedStamps == list(stamps)
+    assert bits(decodedValues) == bits(values)
+
+
+def test_single_sample():
+    roundTrip([1700000000000], [42.5])
+
+
+def test_header_holds_count_and_first_sample():
+    data = encodeChunk([1700000000000, 1700000001000], [1.5, 2.5])
+    assert struct.unpack_from('<IqQ', data) == (2, 1700000000000, struct.unpack('<Q', struct.pack('<d', 1.5))[0])
+
+
+def test_regular_stamps_and_constant_values_cost_two_bits_per_sample():
+    count = 1000
+    data = encodeChunk([1700000000000 + 1000 * i for i in range(count)], [3.0] * count)
+
+    # One delta-of-delta bit and one value bit after the second sample, which carries the first delta
+    assert len(data) <= 20 + 2 + (count * 2) // 8 + 1
+    roundTrip([1700000000000 + 1000 * i for i in range(count)], [3.0] * count)
+
+
+@pytest.mark.parametrize('dod', [-63, 64, -64, 65, -255, 256, -256, 257, -2047, 2048, -2048, 2049, 10 ** 9, -10 ** 9])
+def test_delta_of_delta_bucket_boundaries(dod):
+    # The first delta is 1000, the second is 1000 + dod, then back to regular
+    stamps = [0, 1000, 2000 + dod, 3000 + dod, 4000 + dod]
+    roundTrip(stamps, [1.0, 2.0, 3.0, 4.0, 5.0])
+
+
+def test_stamps_going_back_and_repeating():
+    roundTrip([5000, 4000, 4000, 9000, 1, 2 ** 40], [1.0, 1.0, 1.0, 1.0, 1.0, 1.0])
+
+
+def test_special_values():
+    roundTrip(list(range(0, 9000, 1000)), [0.0, -0.0, math.inf, -math.inf, math.nan, 5e-324, 1.7976931348623157e308, -1.0, 0.0])
+
+
+def test_value_window_is_reused_and_reset():
+    # Small changes keep the previous window, a change in the top bits needs a new, wider one
+    roundTrip(list(range(0, 6000, 1000)), [1.0, 1.0000001, 1.0000002, 1e300, 1e300, 1.0000003])
+
+
+def test_random_round_trips():
+    generator = random.Random(20261017)
+
+    for _ in range(300):
+        count = generator.randint(1, 200)
+        stamp = generator.randint(0, 2 ** 42)
+        stamps = []
+        values = []
+
+        for _ in range(count):
+            stamp += generator.choice([1000, 1000, 1000, 999, 1001, generator.randint(-5000, 5000), generator.randint(0, 2 ** 33)])
+            stamps.append(stamp)
+            values.append(generator.choice([
+                values[-1] if values else 0.0,
+                round(generator.uniform(-100, 100), 1),
+                generator.uniform(-1e12, 1e12),
+                float(generator.randint(0, 1))
+            ]))
+
+        roundTrip(stamps, values)
@@ -0,0 +1,80 @@
+import importlib
+import threading
+import pytest
+
+clock = importlib.import_module('im_core.helpers.epochMillis')
+
+
+class FakeTime:
+    def __init__(self, wall, monotonic):
+        self.wall = wall
+        self.mono = monotonic
+
+    def time(self):
+        return self.wall
+
+    def monotonic(self):
+        return self.mono
+
+    def advance(self, seconds):
+        self.wall += seconds
+        self.mono += seconds
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    fake = FakeTime(1700000000.0, 100.0)
+    monkeypatch.setattr(clock, 'time', fake)
+    monkeypatch.setattr(clock, '_offset', fake.wall - fake.mono)
+    monkeypatch.setattr(clock, '_last', 0)
+    monkeypatch.setattr(clock, '_lastMonotonic', fake.mono)
+    return fake
+
+
+def test_stamps_follow_the_wall_clock(fake):
+    assert clock.epochMillis() == 1700000000000
+    fake.advance(0.25)
+    assert clock.epochMillis() == 1700000000250
+
+
+def test_small_drift_is_ignored(fake):
+    fake.wall += 0.5
+    assert clock.epochMillis() == 1700000000000
+
+
+def test_step_forward_is_followed_at_once(fake):
+    clock.epochMillis()
+    fake.wall += 3600
+    assert clock.epochMillis() == 1700003600000
+
+
+def test_step_back_is_slewed_and_stamps_keep_advancing(fake):
+    stamps = [clock.epochMillis()]
+    fake.wall -= 10
+
+    for _ in range(40):
+        fake.advance(1)
+        stamps.append(clock.epochMillis())
+
+    # Half a second is given back per second, so the stamps still advance and close in on the wall clock to within
+    # the second of drift that is never corrected
+    assert all(later > earlier for earlier, later in zip(stamps, stamps[1:]))
+    assert stamps[1] == 1700000000500
+    assert 0 <= stamps[-1] - fake.wall * 1000 <= 1000
+
+
+def test_stamps_never_go_back_across_threads():
+    stamps = []
+
+    def stamp():
+        stamps.extend(clock.epochMillis() for _ in range(2000))
+
+    threads = [threading.Thread(target=stamp) for _ in range(4)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(stamps) == 8000
+    assert clock.epochMillis() >= max(stamps)
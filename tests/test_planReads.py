@@ -0,0 +1,119 @@
+from functools import partial
+from im_core.helpers import planReads, tagSize
+
+
+def atomic(dataType, elements=0):
+    return {'data_type': dataType, 'tag_type': 'atomic', 'dim': 1 if elements else 0, 'dimensions': [elements, 0, 0]}
+
+
+def struct(name, size, members, elements=0):
+    dataType = {'name': name, 'template': {'structure_size': size}, 'internal_tags': members}
+    return {'data_type': dataType, 'data_type_name': name, 'tag_type': 'struct', 'dim': 1 if elements else 0, 'dimensions': [elements, 0, 0]}
+
+
+motor = {'Speed': {'data_type': 'REAL', 'tag_type': 'atomic'}, 'Running': {'data_type': 'BOOL', 'tag_type': 'atomic'}, 'Hours': {'data_type': 'DINT', 'tag_type': 'atomic'}}
+definitions = {
+    'Level': atomic('REAL'),
+    'Counts': atomic('DINT', 100),
+    'Motor': struct('MOTOR', 12, motor),
+    'Motors': struct('MOTOR', 12, motor, 10),
+    'Program:Main.Pump': struct('MOTOR', 12, motor),
+    'Recipe': struct('RECIPE', 2000, {
+        'Step': {'data_type': 'DINT', 'tag_type': 'atomic'},
+        'Target': {'data_type': 'REAL', 'tag_type': 'atomic'},
+        'Table': {'data_type': 'REAL', 'tag_type': 'atomic', 'array': 400}
+    }),
+    'Batch': struct('BATCH', 1608, {
+        'Step': {'data_type': 'DINT', 'tag_type': 'atomic'},
+        'Target': {'data_type': 'REAL', 'tag_type': 'atomic'},
+        'Table': {'data_type': 'REAL', 'tag_type': 'atomic', 'array': 400}
+    })
+}
+sizeOf = partial(tagSize, definitions=definitions)
+
+
+def requests(reads):
+    return [request for request, targets in reads]
+
+
+def test_tag_sizes():
+    assert sizeOf('Level') == 4
+    assert sizeOf('Counts') == 400
+    assert sizeOf('Counts[3]') == 4
+    assert sizeOf('Motor') == 12
+    assert sizeOf('Motor.Running') == 1
+    assert sizeOf('Motors') == 120
+    assert sizeOf('Motors[2].Hours') == 4
+    assert sizeOf('Program:Main.Pump.Speed') == 4
+    assert sizeOf('Recipe.Table') == 1600
+
+
+def test_unknown_tags_have_no_size():
+    assert sizeOf('Missing') is None
+    assert sizeOf('Motor.Missing') is None
+    assert sizeOf('Level.Member') is None
+    assert sizeOf('Bad[name') is None
+
+
+def test_scalars_are_read_as_they_are():
+    assert planReads(['Level', 'Other']) == [('Level', [(0, ())]), ('Other', [(1, ())])]
+
+
+def test_array_elements_are_read_as_ranges_with_small_gaps():
+    reads = planReads(['Counts[1]', 'Counts[3]', 'Counts[20]', 'Counts[21]', 'Counts[50]'], maxGap=8)
+    assert reads == [
+        ('Counts[1]{3}', [(0, (0,)), (1, (2,))]),
+        ('Counts[20]{2}', [(2, (0,)), (3, (1,))]),
+        ('Counts[50]', [(4, ())])
+    ]
+
+
+def test_repeated_element_is_read_once():
+    assert planReads(['Counts[4]', 'Counts[4]']) == [('Counts[4]', [(0, ()), (1, ())])]
+
+
+def test_structure_members_are_read_with_the_structure():
+    reads = planReads(['Motor.Speed', 'Level', 'Motor.Hours', 'Program:Main.Pump.Speed'])
+    assert reads == [
+        ('Level', [(1, ())]),
+        ('Motor', [(0, ('Speed',)), (2, ('Hours',))]),
+        ('Program:Main.Pump.Speed', [(3, ())])
+    ]
+
+
+def test_array_of_structure_members_keep_their_member_path():
+    reads = planReads(['Motors[0].Speed', 'Motors[2].Running'])
+    assert reads == [('Motors[0]{3}', [(0, (0, 'Speed')), (1, (2, 'Running'))])]
+
+
+def test_sized_plan_keeps_small_structures_whole():
+    reads = planReads(['Motor.Speed', 'Motor.Hours'], sizeOf=sizeOf, packetLimit=4000)
+    assert requests(reads) == ['Motor']
+
+
+def test_large_structure_is_read_by_member():
+    # Two members of a 2000 byte structure cost far less than the structure
+    reads = planReads(['Recipe.Step', 'Recipe.Target'], sizeOf=sizeOf, packetLimit=4000)
+    assert requests(reads) == ['Recipe.Step', 'Recipe.Target']
+
+
+def test_structure_over_the_packet_limit_is_read_by_member():
+    names = ['Batch.Step', 'Batch.Target', 'Batch.Table']
+    assert requests(planReads(names, sizeOf=sizeOf, packetLimit=4000)) == ['Batch']
+    assert requests(planReads(names, sizeOf=sizeOf, packetLimit=1000)) == names
+
+
+def test_structures_of_unknown_size_are_read_by_member():
+    reads = planReads(['Unknown.A', 'Unknown.B'], sizeOf=sizeOf, packetLimit=4000)
+    assert requests(reads) == ['Unknown.A', 'Unknown.B']
+
+
+def test_sparse_array_of_structures_is_read_by_element():
+    # Two members nine elements apart read 120 bytes to use 5
+    reads = planReads(['Motors[0].Running', 'Motors[9].Running'], maxGap=8, sizeOf=sizeOf, packetLimit=4000)
+    assert requests(reads) == ['Motors[0].Running', 'Motors[9].Running']
+
+
+def test_dense_array_is_still_read_as_a_range_when_sized():
+    reads = planReads(['Counts[' + str(i) + ']' for i in range(10)], sizeOf=sizeOf, packetLimit=4000)
+    assert requests(reads) == ['Counts[0]{10}']
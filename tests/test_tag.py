@@ -0,0 +1,95 @@
+from im_core.classes import SampleBuffer, Tag
+
+
+def archived(buffer):
+    tags, stamps, values = buffer.drain()
+    return list(zip(stamps, values))
+
+
+def record(tag, samples):
+    for stamp, value in samples:
+        tag.record(stamp, value)
+
+
+def test_all_archives_every_sample():
+    buffer = SampleBuffer()
+    record(Tag(1, 'Tag', buffer), [(0, 1.0), (1000, 1.0), (2000, 1.0)])
+    assert archived(buffer) == [(0, 1.0), (1000, 1.0), (2000, 1.0)]
+
+
+def test_change_skips_repeats_until_the_heartbeat():
+    buffer = SampleBuffer()
+    tag = Tag(1, 'Tag', buffer, mode='change', maxInterval=3)
+    record(tag, [(0, 1.0), (1000, 1.0), (2000, 2.0), (3000, 2.0), (4000, 2.0), (5000, 2.0)])
+    assert archived(buffer) == [(0, 1.0), (2000, 2.0), (5000, 2.0)]
+
+
+def test_absolute_deadband_is_measured_from_the_last_archived_value():
+    buffer = SampleBuffer()
+    tag = Tag(1, 'Tag', buffer, mode='deadband', deadband=0.5)
+    record(tag, [(0, 10.0), (1000, 10.4), (2000, 10.5), (3000, 10.6), (4000, 9.4)])
+    assert archived(buffer) == [(0, 10.0), (3000, 10.6), (4000, 9.4)]
+
+
+def test_percent_deadband():
+    buffer = SampleBuffer()
+    tag = Tag(1, 'Tag', buffer, mode='deadband', deadband=10, deadbandType='percent')
+    record(tag, [(0, 200.0), (1000, 219.0), (2000, 221.0), (3000, 240.0)])
+    assert archived(buffer) == [(0, 200.0), (2000, 221.0)]
+
+
+def test_unknown_mode_falls_back_to_all():
+    tag = Tag(1, 'Tag', SampleBuffer(), mode='sometimes')
+    assert tag.mode == 'all'
+
+
+def test_swinging_door_drops_points_on_a_line():
+    buffer = SampleBuffer()
+    tag = Tag(1, 'Tag', buffer, mode='swinging_door', deadband=0.1)
+    record(tag, [(i * 1000, float(i)) for i in range(10)])
+    assert archived(buffer) == [(0, 0.0)]
+
+    # The held sample is archived once a point leaves the corridor
+    tag.record(10000, 0.0)
+    assert archived(buffer) == [(9000, 9.0)]
+
+
+def test_swinging_door_archives_the_turning_point():
+    buffer = SampleBuffer()
+    tag = Tag(1, 'Tag', buffer, mode='swinging_door', deadband=0.5)
+    record(tag, [(0, 0.0), (1000, 1.0), (2000, 2.0), (3000, 1.0), (4000, 0.0)])
+    assert archived(buffer) == [(0, 0.0), (2000, 2.0)]
+
+
+def test_swinging_door_heartbeat_archives_the_held_sample_first():
+    buffer = SampleBuffer()
+    tag = Tag(1, 'Tag', buffer, mode='swinging_door', deadband=0.1, maxInterval=5)
+    record(tag, [(i * 1000, float(i)) for i in range(7)])
+    assert archived(buffer) == [(0, 0.0), (4000, 4.0), (5000, 5.0)]
+
+
+def test_swinging_door_ignores_stamps_that_do_not_advance():
+    buffer = SampleBuffer()
+    tag = Tag(1, 'Tag', buffer, mode='swinging_door', deadband=0.1)
+    record(tag, [(1000, 1.0), (1000, 5.0), (500, 7.0)])
+    assert archived(buffer) == [(1000, 1.0)]
+
+
+def test_mode_change_archives_the_sample_swinging_door_held():
+    buffer = SampleBuffer()
+    tag = Tag(1, 'Tag', buffer, mode='swinging_door', deadband=0.1)
+    record(tag, [(0, 0.0), (1000, 1.0), (2000, 2.0)])
+
+    tag.configure(mode='change')
+    tag.record(3000, 2.0)
+    assert archived(buffer) == [(0, 0.0), (2000, 2.0), (3000, 2.0)]
+
+
+def test_reconfiguring_the_same_mode_keeps_the_state():
+    buffer = SampleBuffer()
+    tag = Tag(1, 'Tag', buffer, mode='change')
+    record(tag, [(0, 1.0)])
+
+    tag.configure(mode='change', maxInterval=10)
+    tag.record(1000, 1.0)
+    assert archived(buffer) == [(0, 1.0)]